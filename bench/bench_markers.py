@@ -0,0 +1,55 @@
+"""Micro-benchmark du parsing des markers dynmap sur un marker_world.json enregistré.
+
+	python bench/bench_markers.py [fixture.json] [-n 50]
+
+Compare l'ancien parsing (import + regex via le cache de re + unescape complet à chaque appel),
+le parsing à froid (memo vidé) et le parsing à chaud (desc inchangées entre deux fetchs).
+"""
+import sys,os,json,time,argparse,statistics
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import main
+
+def _legacy_parse(desc):
+	import html as _html,re as _re
+	desc=_html.unescape(desc)
+	m=_re.search(r'Membres<\/span><br\/>\s*(.*?)<br',desc,_re.S)
+	members=[x.strip()for x in m.group(1).split(',')if x.strip()]if m else[]
+	c=_re.search(r'Claims<\/b>\s*(\d+)',desc)
+	p=_re.search(r'Power<\/b>\s*(\d+)\s*\/\s*(\d+)',desc)
+	mmr=_re.search(r'MMR<\/b>\s*(\d+)',desc)
+	l=_re.search(r"src='https:\/\/skins\.nationsglory\.fr\/face\/([^/]+)\/",desc)
+	return{'members':members,'claims':int(c.group(1))if c else 0,'power':int(p.group(1))if p else 0,
+		'maxpower':int(p.group(2))if p else 0,'mmr':int(mmr.group(1))if mmr else 0,'leader':l.group(1)if l else ''}
+
+def _legacy_markerset(markers):
+	out={}
+	for k,v in markers.items():
+		desc=v.get('desc','')
+		parsed=_legacy_parse(desc)if desc else{'members':[],'claims':0,'power':0,'maxpower':0,'mmr':0,'leader':''}
+		out[k]={'key':k,'name':v.get('label',k).replace(' [home]','').strip(),'home':k.startswith('default_')and k.endswith('__home'),
+			'has_desc':bool(desc),'x':v.get('x',0),'z':v.get('z',0),**parsed}
+	return out
+
+def _cold(markers):main._marker_memo.clear();return main._parse_markerset(markers)
+
+def bench(name,fn,markers,n):
+	fn(markers)
+	times=[]
+	for _ in range(n):
+		t0=time.perf_counter();fn(markers);times.append((time.perf_counter()-t0)*1000)
+	times.sort()
+	print(f"{name:<8} médiane {statistics.median(times):8.3f} ms  p90 {times[int(len(times)*.9)-1]:8.3f} ms  ({len(markers)/statistics.median(times)*1000:,.0f} markers/s)")
+	return statistics.median(times)
+
+if __name__=='__main__':
+	ap=argparse.ArgumentParser()
+	ap.add_argument('fixture',nargs='?',default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures','marker_world.json'))
+	ap.add_argument('-n',type=int,default=50)
+	a=ap.parse_args()
+	markers=json.load(open(a.fixture,encoding='utf-8'))['sets']['factions.markerset']['markers']
+	assert _legacy_markerset(markers)==_cold(markers),"le parsing diffère de l'implémentation de référence"
+	print(f"{len(markers)} markers, {sum(1 for v in markers.values()if v.get('desc'))} avec desc, {a.n} itérations")
+	base=bench('legacy',_legacy_markerset,markers,a.n)
+	cold=bench('froid',_cold,markers,a.n)
+	warm=bench('chaud',main._parse_markerset,markers,a.n)
+	print(f"gain froid x{base/cold:.1f}, chaud x{base/warm:.1f} — {main.marker_stats()}")
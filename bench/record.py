@@ -0,0 +1,30 @@
+"""Enregistre de vraies réponses dynmap/publicapi dans bench/fixtures/ pour le stub (réseau requis).
+
+	NG_API_KEY=... python bench/record.py [--server lime] [--player Pseudo]
+"""
+import os,json,asyncio,argparse
+import aiohttp
+
+FIXTURES=os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+
+async def record(server,player):
+	key=os.getenv('NG_API_KEY','');api={'Authorization':f"Bearer {key}",'accept':'application/json'}
+	dyn=f"https://{server}.nationsglory.fr"
+	targets=[('dynmap_world.json',f"{dyn}/standalone/dynmap_world.json",{}),('marker_world.json',f"{dyn}/tiles/_markers_/marker_world.json",{})]
+	targets+=[(f"marker_{d}.json",f"{dyn}/tiles/_markers_/marker_{d}.json",{})for d in('DIM-28','DIM-29','DIM-31')]
+	if key:targets+=[('country_list.json',f"https://publicapi.nationsglory.fr/country/list/{server}",api),('playercount.json','https://publicapi.nationsglory.fr/playercount',api)]
+	if key and player:targets.append(('user.json',f"https://publicapi.nationsglory.fr/user/{player}",api))
+	os.makedirs(FIXTURES,exist_ok=True)
+	async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))as s:
+		for name,url,headers in targets:
+			try:
+				async with s.get(url,headers=headers)as r:
+					if r.status!=200:print(f"{name}: HTTP {r.status}, ignoré");continue
+					data=await r.json(content_type=None)
+			except Exception as e:print(f"{name}: {e}");continue
+			with open(os.path.join(FIXTURES,name),'w',encoding='utf-8')as f:json.dump(data,f,ensure_ascii=False,separators=(',',':'))
+			print(f"{name}: OK")
+
+if __name__=='__main__':
+	ap=argparse.ArgumentParser();ap.add_argument('--server',default='lime');ap.add_argument('--player',default='')
+	a=ap.parse_args();asyncio.run(record(a.server,a.player))
@@ -0,0 +1,165 @@
+"""Banc hors ligne : le vrai scanner et la vraie API contre le stub (bench/stub.py) et mongomock (ou un mongod local).
+
+	pip install mongomock   # si --mongo n'est pas donné
+	python bench/run.py [--duration 60] [--rps 20] [--players 60] [--churn 0.1] [--latency 30] [--mongo mongodb://localhost:27017] [--json out.json]
+
+Rapporte ticks de scan/s, p50/p99 par endpoint, opérations MongoDB par tick et RSS max.
+Discord n'est pas connecté : les alertes et messages de statut sont abandonnés faute de salon, comme sans bot.
+"""
+import sys,os,io,json,time,socket,random,argparse,asyncio,resource,tempfile,threading,subprocess,contextlib,shutil
+HERE=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,HERE);sys.path.insert(0,os.path.dirname(HERE))
+import aiohttp
+import stub
+
+def free_port():
+	with socket.socket()as s:s.bind(('127.0.0.1',0));return s.getsockname()[1]
+
+def rss_mb():
+	with open('/proc/self/statm')as f:return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+
+def pct(vals,p):
+	if not vals:return 0.0
+	vals=sorted(vals);return vals[min(len(vals)-1,int(len(vals)*p/100))]
+
+def start_stub(a,port):
+	cmd=[sys.executable,os.path.join(HERE,'stub.py'),'--port',str(port),'--players',str(a.players),'--churn',str(a.churn),'--churn-every',str(a.churn_every),
+		'--latency',str(a.latency),'--jitter',str(a.jitter),'--errors',str(a.errors),'--seed',str(a.seed)]
+	proc=subprocess.Popen(cmd,stdout=subprocess.DEVNULL)
+	for _ in range(100):
+		try:
+			with socket.create_connection(('127.0.0.1',port),timeout=0.1):return proc
+		except OSError:time.sleep(0.1)
+	proc.kill();raise RuntimeError('le stub ne démarre pas')
+
+def endpoints(rng,countries):
+	members=[p for ms in countries.values()for p in ms]
+	return[
+		('health',lambda:'/health'),
+		('online_all',lambda:'/api/online_all'),
+		('online',lambda:'/api/online/lime'),
+		('checkall',lambda:f"/api/checkall/{rng.choice(members)}"),
+		('countries',lambda:'/api/countries/lime'),
+		('souspower',lambda:'/api/souspower/lime'),
+		('souspower_col',lambda:'/api/souspower/lime?fmt=col'),
+		('dim_markers',lambda:'/api/dim_markers/lime/DIM-28?fmt=col'),
+		('check',lambda:f"/api/check/lime/{rng.choice(list(countries))}"),
+		('activity',lambda:'/api/activity?hours=24&fmt=col'),
+		('playercount',lambda:'/api/playercount'),
+		('grades',lambda:f"/api/grades/{rng.choice(members)}"),
+		('history',lambda:f"/api/history/{rng.choice(members)}?days=7"),
+		('pronostic',lambda:f"/api/pronostic/{rng.choice(members)}"),
+	]
+
+def client_load(base,token,eps,a,stop,lat,status):
+	"""Charge HTTP en boucle ouverte (cadence fixe, indépendante des réponses) dans son propre thread/event loop :
+	   la latence mesurée inclut l'attente sur la boucle du bot. Au-delà de --concurrency requêtes en vol, l'envoi est compté 'saturé'."""
+	def count(name,key):st=status.setdefault(name,{});st[key]=st.get(key,0)+1
+	async def one(session,name,path):
+		t0=time.perf_counter()
+		try:
+			async with session.get(base+path,headers={'Authorization':f"Bearer {token}",'Accept-Encoding':'br, gzip'})as r:await r.read();count(name,r.status)
+		except Exception as e:count(name,type(e).__name__)
+		lat.setdefault(name,[]).append((time.perf_counter()-t0)*1000)
+	async def run():
+		inflight=set();k=0;t_next=time.perf_counter()
+		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30),connector=aiohttp.TCPConnector(limit=a.concurrency))as session:
+			while not stop.is_set():
+				name,path=eps[k%len(eps)];k+=1
+				if len(inflight)>=a.concurrency:count(name,'saturé')
+				else:t=asyncio.create_task(one(session,name,path()));inflight.add(t);t.add_done_callback(inflight.discard)
+				t_next+=1/a.rps;await asyncio.sleep(max(0.0,t_next-time.perf_counter()))
+			if inflight:await asyncio.wait(inflight,timeout=30)
+	asyncio.run(run())
+
+def mongomock_client():
+	"""mongomock à la place de pymongo.MongoClient (init_mongo l'importe à l'appel)."""
+	import inspect,mongomock,pymongo
+	from mongomock.collection import BulkOperationBuilder
+	if 'sort'not in inspect.signature(BulkOperationBuilder.add_update).parameters:
+		add=BulkOperationBuilder.add_update  # pymongo >= 4.9 passe sort= aux UpdateOne d'un bulk_write
+		BulkOperationBuilder.add_update=lambda self,*a,sort=None,**kw:add(self,*a,**kw)
+	pymongo.MongoClient=mongomock.MongoClient
+
+def counters(m):
+	return{'ticks':m._diff_stats['ticks'],'db_ops':{n:st['ops']for n,st in m._db_stats.items()},'http':m._http_stats['requests']}
+
+async def bench(m,a,stub_port,countries):
+	from aiohttp import web
+	loop=asyncio.get_running_loop()
+	await loop.run_in_executor(m._db_executor,m.init_mongo)
+	if not m.mongo_ok:raise RuntimeError('MongoDB indisponible')
+	async def _ready():return None
+	m.client.wait_until_ready=_ready  # pas de connexion Discord
+	rng=random.Random(a.seed);members=sorted(p for ms in countries.values()for p in ms)
+	m.WL[:]=rng.sample(members,min(a.watch,len(members)))
+	await m.cfg_set('country_watches',[{'server':'lime','country':c,'members':[],'last_alert':False}for c in rng.sample(sorted(countries),min(a.country_watches,len(countries)))])
+	http_session=m.http_session()
+	runner=web.AppRunner(m.make_app());await runner.setup();port=free_port();await web.TCPSite(runner,'127.0.0.1',port).start()
+	tasks=[asyncio.create_task(f())for f in(m.scanner_loop,m.referent_tracker_loop,m.activity_recorder_loop,m.dynmap_cache_loop,m.write_behind_loop,m.journal_loop,m.loop_lag_loop)]
+	m.start_loop_watchdog();peak=[rss_mb()]
+	async def sample():
+		while True:peak.append(rss_mb());await asyncio.sleep(0.5)
+	tasks.append(asyncio.create_task(sample()))
+	print(f"échauffement {a.warmup}s...",file=sys.stderr,flush=True);await asyncio.sleep(a.warmup)
+	c0=counters(m);rss0=rss_mb();t0=time.perf_counter()
+	stop=threading.Event();lat={};status={}
+	token=m._jwt_sign({'sub':'bench','exp':time.time()+86400})
+	th=threading.Thread(target=client_load,args=(f"http://127.0.0.1:{port}",token,endpoints(random.Random(a.seed),countries),a,stop,lat,status),daemon=True)
+	if a.rps:th.start()
+	print(f"mesure {a.duration}s...",file=sys.stderr,flush=True);await asyncio.sleep(a.duration)
+	stop.set();elapsed=time.perf_counter()-t0;c1=counters(m);rss1=rss_mb()
+	async with http_session.get(f"http://127.0.0.1:{port}/metrics",headers={'Authorization':f"Bearer {os.environ['METRICS_TOKEN']}"})as r:metrics=await r.text()
+	if a.rps:await loop.run_in_executor(None,th.join,35)
+	async with http_session.get(f"http://127.0.0.1:{stub_port}/_stats")as r:upstream=await r.json()
+	for t in tasks:t.cancel()
+	await asyncio.gather(*tasks,return_exceptions=True)
+	await m.wb_flush();await m.http_close();await runner.cleanup()
+	ticks=c1['ticks']-c0['ticks'];ops={n:c1['db_ops'].get(n,0)-c0['db_ops'].get(n,0)for n in c1['db_ops']}
+	total_ops=sum(ops.values())
+	return{
+		'config':{k:v for k,v in vars(a).items()if k!='json'},
+		'elapsed_s':round(elapsed,2),
+		'ticks':ticks,'ticks_per_s':round(ticks/elapsed,2),
+		'db_ops':total_ops,'db_ops_per_tick':round(total_ops/ticks,3)if ticks else None,
+		'db_ops_by_collection':{n:v for n,v in sorted(ops.items())if v},
+		'upstream_requests':c1['http']-c0['http'],'upstream_hits':upstream['hits'],
+		'endpoints':{n:{'n':len(v),'p50_ms':round(pct(v,50),2),'p99_ms':round(pct(v,99),2),'max_ms':round(max(v),2),'status':status.get(n,{})}for n,v in sorted(lat.items())},
+		'rss_mb':{'start':round(rss0,1),'end':round(rss1,1),'peak':round(max(peak),1),'peak_maxrss':round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,1)},
+		'loop_lag_max_ms':round(m._loop_lag['max']*1000,2),'loop_stalls':m._wd['stalls'],'max_stall_ms':m._wd['max_ms'],'diff':m.diff_stats(),'markers':m.marker_stats(),
+	}
+
+def report(res):
+	print(f"\n⏱  {res['elapsed_s']}s — {res['ticks']} ticks de scan ({res['ticks_per_s']}/s), {res['upstream_requests']} requêtes amont")
+	print(f"🗄  {res['db_ops']} opérations MongoDB ({res['db_ops_per_tick']}/tick) : {res['db_ops_by_collection']}")
+	print(f"🐢 retard max de la boucle asyncio {res['loop_lag_max_ms']} ms, {res['loop_stalls']} blocages > SLOW_CALLBACK_MS (max {res['max_stall_ms']} ms)")
+	print(f"🧠 RSS début {res['rss_mb']['start']} Mo, fin {res['rss_mb']['end']} Mo, max {res['rss_mb']['peak_maxrss']} Mo")
+	if res['endpoints']:
+		print(f"\n{'endpoint':<15}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}  statuts")
+		for n,e in res['endpoints'].items():print(f"{n:<15}{e['n']:>6}{e['p50_ms']:>10}{e['p99_ms']:>10}{e['max_ms']:>10}  {e['status']}")
+
+def main():
+	ap=argparse.ArgumentParser()
+	ap.add_argument('--duration',type=float,default=60);ap.add_argument('--warmup',type=float,default=10)
+	ap.add_argument('--rps',type=float,default=20,help='requêtes/s envoyées à l\'API (0 = scanner seul)');ap.add_argument('--concurrency',type=int,default=32,help='requêtes en vol max')
+	ap.add_argument('--watch',type=int,default=10,help='joueurs placés dans la watchlist');ap.add_argument('--country-watches',type=int,default=3)
+	ap.add_argument('--scan-budget',type=float,default=0,help='SCAN_BUDGET_RPS du scanner (défaut : celui de main.py)')
+	ap.add_argument('--verbose',action='store_true',help='affiche les logs du bot')
+	ap.add_argument('--mongo',default='',help='URL d\'un mongod local (sinon mongomock)');ap.add_argument('--json',default='',help='écrit le résultat en JSON')
+	stub.add_args(ap);a=ap.parse_args()
+	tmp=tempfile.mkdtemp(prefix='mossad-bench-');port=free_port()
+	os.environ.update(DYNMAP_URL=f"http://127.0.0.1:{port}/dynmap/{{server}}",NG_API_URL=f"http://127.0.0.1:{port}/api",NG_API_KEY='bench',
+		MONGO_URL=a.mongo or'mongodb://mongomock',MONGO_TLS='0',STATE_PATH=os.path.join(tmp,'state.json'),JOURNAL_PATH=os.path.join(tmp,'journal.ndjson'),METRICS_TOKEN='bench')
+	if a.scan_budget:os.environ['SCAN_BUDGET_RPS']=str(a.scan_budget)
+	if not a.mongo:mongomock_client()
+	proc=start_stub(a,port)
+	try:
+		with contextlib.redirect_stdout(sys.stdout if a.verbose else io.StringIO()):
+			import main as m
+			res=asyncio.run(bench(m,a,port,stub.fixture_countries()))
+	finally:proc.terminate();proc.wait();shutil.rmtree(tmp,ignore_errors=True)
+	report(res)
+	if a.json:
+		with open(a.json,'w',encoding='utf-8')as f:json.dump(res,f,indent=1,default=str)
+
+if __name__=='__main__':main()
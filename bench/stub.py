@@ -0,0 +1,141 @@
+"""Stub local de dynmap et de publicapi, à partir des réponses enregistrées dans bench/fixtures/.
+
+	python bench/stub.py --port 8765 [--players 60] [--churn 0.1] [--churn-every 5] [--latency 30]
+
+Routes (DYNMAP_URL=http://127.0.0.1:PORT/dynmap/{server}, NG_API_URL=http://127.0.0.1:PORT/api) :
+	/dynmap/{server}/standalone/dynmap_world.json   joueurs en ligne, renouvelés de --churn toutes les --churn-every s
+	/dynmap/{server}/tiles/_markers_/marker_*.json  marker_world.json et marker_DIM-*.json
+	/api/country/list/{server}  /api/user/{player}  /api/playercount
+	/_stats                                         requêtes servies par route
+
+Un fichier absent de fixtures/ (record.py ne tourne qu'avec le réseau) est synthétisé à partir de marker_world.json.
+"""
+import os,json,time,random,asyncio,argparse,hashlib
+from aiohttp import web
+
+FIXTURES=os.path.join(os.path.dirname(os.path.abspath(__file__)),'fixtures')
+SERVERS=('blue','coral','orange','red','yellow','mocha','white','jade','black','cyan','lime')
+DIMS=('DIM-28','DIM-29','DIM-31')
+
+def load_fixture(name):
+	path=os.path.join(FIXTURES,name)
+	if not os.path.exists(path):return None
+	with open(path,encoding='utf-8')as f:return json.load(f)
+
+def fixture_countries(markers=None):
+	"""{nom du pays: [membres]} d'après les markers home de marker_world.json (partagé avec run.py)."""
+	import re
+	markers=markers if markers is not None else load_fixture('marker_world.json')['sets']['factions.markerset']['markers']
+	out={}
+	for k,v in markers.items():
+		if not(k.startswith('default_')and k.endswith('__home')and v.get('desc')):continue
+		m=re.search(r'Membres</span><br/>\s*(.*?)<br',v['desc'],re.S)
+		out[v.get('label',k).replace(' [home]','').strip()]=[x.strip()for x in m.group(1).split(',')if x.strip()]if m else[]
+	return out
+
+class Upstream:
+	def __init__(self,players=60,churn=0.1,churn_every=5.0,latency=30.0,jitter=10.0,errors=0.0,seed=1):
+		self.rng=random.Random(seed);self.players=players;self.churn=churn;self.churn_every=churn_every
+		self.latency=latency/1000;self.jitter=jitter/1000;self.errors=errors;self.hits={}
+		self.marker_world=load_fixture('marker_world.json')
+		self.countries=fixture_countries(self.marker_world['sets']['factions.markerset']['markers'])
+		self.member_of={p:c for c,ms in self.countries.items()for p in ms}
+		self.pool=sorted(self.member_of)+[f"Visiteur{i}"for i in range(max(200,players*4))]
+		self.world_tpl=load_fixture('dynmap_world.json')or{'currentcount':0,'hasStorm':False,'isThundering':False,'confighash':0,'servertime':6000,'updates':[],'players':[]}
+		self.user_tpl=load_fixture('user.json')
+		self.playercount_tpl=load_fixture('playercount.json')
+		self.ctry_list=load_fixture('country_list.json')or{'claimed':[{'name':c}for c in sorted(self.countries)],'availables':[]}
+		self.dims={d:load_fixture(f"marker_{d}.json")or self._dim_areas(d)for d in DIMS}
+		self.online={s:self.rng.sample(self.pool,min(players,len(self.pool)))for s in SERVERS}
+		self.version={s:0 for s in SERVERS};self.churned_at=time.monotonic()
+
+	def _dim_areas(self,dim):
+		areas={}
+		for i,(k,v)in enumerate(self.marker_world['sets']['factions.markerset']['markers'].items()):
+			if not k.endswith('__home'):continue
+			x,z=v.get('x',0),v.get('z',0);w=self.rng.randint(16,160)
+			areas[f"{dim}_{i}"]={'label':v.get('label','').replace(' [home]',''),'x':[x,x+w,x+w,x],'z':[z,z,z+w,z+w],'fillcolor':'#ff0000','desc':''}
+		return{'timestamp':int(time.time()*1000),'sets':{'factions.markerset':{'areas':areas,'markers':{},'lines':{}}}}
+
+	def _tick(self):
+		"""Renouvelle une fraction des joueurs de chaque serveur, une fois par churn_every écoulé."""
+		now=time.monotonic()
+		while now-self.churned_at>=self.churn_every:
+			self.churned_at+=self.churn_every
+			for s,cur in self.online.items():
+				n=int(len(cur)*self.churn+self.rng.random())
+				if not n:continue
+				on=set(cur);leave=set(self.rng.sample(cur,min(n,len(cur))))
+				join=[p for p in self.rng.sample(self.pool,n*3)if p not in on][:n]
+				self.online[s]=[p for p in cur if p not in leave]+join;self.version[s]+=1
+
+	async def _delay(self):
+		if self.latency:await asyncio.sleep(max(0.0,self.rng.gauss(self.latency,self.jitter)))
+
+	@web.middleware
+	async def middleware(self,r,handler):
+		route=r.match_info.route.resource.canonical if r.match_info.route.resource else r.path
+		self.hits[route]=self.hits.get(route,0)+1
+		if route!='/_stats':
+			await self._delay()
+			if self.errors and self.rng.random()<self.errors:return web.Response(status=500)
+		return await handler(r)
+
+	async def dynmap_world(self,r):
+		s=r.match_info['server']
+		if s not in self.online:return web.Response(status=404)
+		self._tick();etag=f'"{s}-{self.version[s]}"'
+		if r.headers.get('If-None-Match')==etag:return web.Response(status=304,headers={'ETag':etag})
+		doc=dict(self.world_tpl,timestamp=int(time.time()*1000),currentcount=len(self.online[s]))
+		doc['players']=[{'world':'world','armor':0,'name':p,'account':p,'health':20,'sort':0,'type':'player',
+			'x':(i*37)%3000-1500,'y':64,'z':(i*53)%3000-1500}for i,p in enumerate(self.online[s])]
+		return web.Response(body=json.dumps(doc).encode(),content_type='application/json',headers={'ETag':etag})
+
+	async def markers(self,r):
+		name=r.match_info['name']
+		if name=='marker_world.json':return web.json_response(self.marker_world)
+		dim=name[len('marker_'):-len('.json')]
+		if dim in self.dims:return web.json_response(self.dims[dim])
+		return web.Response(status=404)
+
+	async def country_list(self,r):return web.json_response(self.ctry_list)
+
+	async def user(self,r):
+		p=r.match_info['player'];country=self.member_of.get(p)
+		h=int(hashlib.md5(p.encode()).hexdigest()[:8],16)
+		servers={s:{'country':country or '','country_rank':('leader','officer','member','recruit')[h%4]if country else ''}for s in SERVERS}
+		doc=dict(self.user_tpl or{},username=p,servers=servers)
+		return web.json_response(doc)
+
+	async def playercount(self,r):
+		self._tick()
+		if self.playercount_tpl:return web.json_response(self.playercount_tpl)
+		return web.json_response({s:{'players':len(v),'online':True}for s,v in self.online.items()})
+
+	async def stats(self,r):return web.json_response({'hits':self.hits,'version':self.version})
+
+	def app(self):
+		app=web.Application(middlewares=[self.middleware])
+		app.router.add_get('/dynmap/{server}/standalone/dynmap_world.json',self.dynmap_world)
+		app.router.add_get('/dynmap/{server}/tiles/_markers_/{name}',self.markers)
+		app.router.add_get('/api/country/list/{server}',self.country_list)
+		app.router.add_get('/api/user/{player}',self.user)
+		app.router.add_get('/api/playercount',self.playercount)
+		app.router.add_get('/_stats',self.stats)
+		return app
+
+def add_args(ap):
+	ap.add_argument('--players',type=int,default=60,help='joueurs en ligne par serveur')
+	ap.add_argument('--churn',type=float,default=0.1,help='fraction des joueurs remplacée à chaque renouvellement')
+	ap.add_argument('--churn-every',type=float,default=5.0,help='secondes entre deux renouvellements')
+	ap.add_argument('--latency',type=float,default=30.0,help='latence amont moyenne (ms)')
+	ap.add_argument('--jitter',type=float,default=10.0,help='écart-type de la latence (ms)')
+	ap.add_argument('--errors',type=float,default=0.0,help='fraction de réponses HTTP 500')
+	ap.add_argument('--seed',type=int,default=1)
+
+def from_args(a):return Upstream(a.players,a.churn,a.churn_every,a.latency,a.jitter,a.errors,a.seed)
+
+if __name__=='__main__':
+	ap=argparse.ArgumentParser();ap.add_argument('--host',default='127.0.0.1');ap.add_argument('--port',type=int,default=8765);add_args(ap)
+	a=ap.parse_args()
+	web.run_app(from_args(a).app(),host=a.host,port=a.port,access_log=None,print=lambda *_:print(f"stub prêt sur {a.host}:{a.port}",flush=True))
@@ -1,11 +1,22 @@
-import discord,aiohttp,asyncio,time,json,os,sys,hmac,hashlib,base64,secrets
+import discord,aiohttp,asyncio,time,json,os,sys,hmac,hashlib,base64,secrets,re,random,signal,html,threading
 from discord import app_commands
 from aiohttp import web
 from datetime import timedelta,datetime
+from collections import OrderedDict,deque
+from concurrent.futures import ThreadPoolExecutor
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError,DuplicateKeyError,OperationFailure
+from bson import json_util
+try:import orjson
+except ImportError:orjson=None
+try:import brotli
+except ImportError:brotli=None
 TOKEN=os.getenv('DISCORD_TOKEN')
 NG_KEY=os.getenv('NG_API_KEY')
 RENDER_URL=os.getenv('RENDER_EXTERNAL_URL','')
 MONGO_URL=os.getenv('MONGO_URL')
+MONGO_TLS=os.getenv('MONGO_TLS','1')!='0'  # 0 pour un mongod local sans TLS
 CH_RAPPORT=0x14400e533c420056
 CH_ALERTE=0x1455d36c2644109a
 CH_STORAGE=0x1485ddced2021066
@@ -28,7 +39,11 @@ REFERENT_WATCHES=[]
 intents=discord.Intents.default()
 client=discord.Client(intents=intents)
 tree=app_commands.CommandTree(client)
-SERVERS={'blue':{'url':'https://blue.nationsglory.fr/standalone/dynmap_world.json','emoji':'🔵'},'coral':{'url':'https://coral.nationsglory.fr/standalone/dynmap_world.json','emoji':'🔴'},'orange':{'url':'https://orange.nationsglory.fr/standalone/dynmap_world.json','emoji':'🟠'},'red':{'url':'https://red.nationsglory.fr/standalone/dynmap_world.json','emoji':'🔴'},'yellow':{'url':'https://yellow.nationsglory.fr/standalone/dynmap_world.json','emoji':'🟡'},'mocha':{'url':'https://mocha.nationsglory.fr/standalone/dynmap_world.json','emoji':'🟤'},'white':{'url':'https://white.nationsglory.fr/standalone/dynmap_world.json','emoji':'⚪'},'jade':{'url':'https://jade.nationsglory.fr/standalone/dynmap_world.json','emoji':'🟢'},'black':{'url':'https://black.nationsglory.fr/standalone/dynmap_world.json','emoji':'⚫'},'cyan':{'url':'https://cyan.nationsglory.fr/standalone/dynmap_world.json','emoji':'🔵'},'lime':{'url':'https://lime.nationsglory.fr/standalone/dynmap_world.json','emoji':'🟢'}}
+DYNMAP_URL=os.getenv('DYNMAP_URL','https://{server}.nationsglory.fr')  # racine dynmap, {server} remplacé (bench/ pointe vers un stub local)
+NG_API_URL=os.getenv('NG_API_URL','https://publicapi.nationsglory.fr')
+def dynmap_url(server,path):return f"{DYNMAP_URL.format(server=server)}/{path}"
+SERVERS={'blue':{'emoji':'🔵'},'coral':{'emoji':'🔴'},'orange':{'emoji':'🟠'},'red':{'emoji':'🔴'},'yellow':{'emoji':'🟡'},'mocha':{'emoji':'🟤'},'white':{'emoji':'⚪'},'jade':{'emoji':'🟢'},'black':{'emoji':'⚫'},'cyan':{'emoji':'🔵'},'lime':{'emoji':'🟢'}}
+for _s,_v in SERVERS.items():_v['url']=dynmap_url(_s,'standalone/dynmap_world.json')
 CACHE_TTL=900
 ctry_cache={}
 _dynmap_markers_cache={}
@@ -36,6 +51,203 @@ _dim_markers_cache={}
 DYNMAP_MARKERS_TTL=120
 CORS={'Access-Control-Allow-Origin':'*','Access-Control-Allow-Methods':'GET, POST, OPTIONS','Access-Control-Allow-Headers':'Content-Type, Authorization'}
 
+# ════════════════════════════════════════════════════════
+# 📈 MÉTRIQUES (format texte Prometheus, GET /metrics)
+# ════════════════════════════════════════════════════════
+METRICS_TOKEN=os.getenv('METRICS_TOKEN','')  # /metrics exige Authorization: Bearer <METRICS_TOKEN> ; vide → /metrics désactivé (404)
+LATENCY_BUCKETS=(.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10)
+_metrics={}  # {nom: métrique} dans l'ordre d'enregistrement
+
+def _lbl(names,values):
+	if not names:return''
+	return'{'+','.join(f'{n}="{str(v).replace(chr(92),chr(92)*2).replace(chr(34),chr(92)+chr(34))}"'for n,v in zip(names,values))+'}'
+
+class Counter:
+	"""Compteur par combinaison de labels : inc() n'est qu'une addition dans un dict."""
+	kind='counter'
+	def __init__(self,name,help,labels=()):self.name,self.help,self.labels,self.values=name,help,tuple(labels),{};_metrics[name]=self
+	def inc(self,*lv,n=1):self.values[lv]=self.values.get(lv,0)+n
+	def samples(self):return[(self.name,_lbl(self.labels,lv),v)for lv,v in self.values.items()]
+
+class Histogram:
+	"""Histogramme à seaux fixes ; les seaux sont cumulés seulement au rendu."""
+	kind='histogram'
+	def __init__(self,name,help,labels=(),buckets=LATENCY_BUCKETS):
+		self.name,self.help,self.labels,self.buckets,self.values=name,help,tuple(labels),tuple(buckets),{};_metrics[name]=self
+	def observe(self,v,*lv):
+		s=self.values.get(lv)
+		if s is None:s=self.values[lv]=[[0]*(len(self.buckets)+1),0.0,0]
+		i=0
+		for b in self.buckets:
+			if v<=b:break
+			i+=1
+		s[0][i]+=1;s[1]+=v;s[2]+=1
+	def samples(self):
+		out=[]
+		for lv,(counts,total,n)in self.values.items():
+			acc=0
+			for b,c in zip(self.buckets+('+Inf',),counts):
+				acc+=c;out.append((self.name+'_bucket',_lbl(self.labels+('le',),lv+(b,)),acc))
+			out+=[(self.name+'_sum',_lbl(self.labels,lv),total),(self.name+'_count',_lbl(self.labels,lv),n)]
+		return out
+
+class Collected:
+	"""Valeurs lues au moment du scrape (compteurs déjà tenus ailleurs, profondeurs de files...) : fn() → {labels: valeur}."""
+	def __init__(self,name,help,kind,fn,labels=()):self.name,self.help,self.kind,self.fn,self.labels=name,help,kind,fn,tuple(labels);_metrics[name]=self
+	def samples(self):
+		v=self.fn()
+		if not isinstance(v,dict):v={():v}
+		return[(self.name,_lbl(self.labels,lv if isinstance(lv,tuple)else(lv,)),x)for lv,x in v.items()]
+
+def timed(hist,labels=None):
+	"""Décorateur : durée de chaque appel (sync ou async) dans `hist` ; labels(*args,**kw) → tuple de valeurs de labels."""
+	def deco(fn):
+		if asyncio.iscoroutinefunction(fn):
+			async def wrapper(*a,**kw):
+				t0=time.perf_counter()
+				try:return await fn(*a,**kw)
+				finally:hist.observe(time.perf_counter()-t0,*(labels(*a,**kw)if labels else()))
+		else:
+			def wrapper(*a,**kw):
+				t0=time.perf_counter()
+				try:return fn(*a,**kw)
+				finally:hist.observe(time.perf_counter()-t0,*(labels(*a,**kw)if labels else()))
+		wrapper.__name__=fn.__name__;wrapper.__doc__=fn.__doc__
+		return wrapper
+	return deco
+
+def render_metrics():
+	lines=[]
+	for m in list(_metrics.values()):
+		try:samples=m.samples()
+		except Exception as e:print(f"❌ métrique {m.name}: {e}",flush=True);continue
+		lines+=[f"# HELP {m.name} {m.help}",f"# TYPE {m.name} {m.kind}"]
+		lines+=[f"{n}{l} {v}"for n,l,v in samples]
+	return'\n'.join(lines)+'\n'
+
+M_UPSTREAM=Histogram('mossad_upstream_request_seconds','Latence des requêtes HTTP sortantes par hôte',('host',))
+M_UPSTREAM_STATUS=Counter('mossad_upstream_responses_total','Réponses HTTP sortantes par hôte et statut (error = exception)',('host','status'))
+M_CACHE=Counter('mossad_cache_requests_total','Lectures de cache : hit (frais), stale (périmé servi, rafraîchi en fond), miss',('cache','result'))
+def _cache_ratios():
+	tot={};ok={}
+	for(c,res),v in M_CACHE.values.items():
+		tot[c]=tot.get(c,0)+v
+		if res!='miss':ok[c]=ok.get(c,0)+v
+	return{(c,):round(ok.get(c,0)/t,4)for c,t in tot.items()}
+Collected('mossad_cache_hit_ratio','Part des lectures servies sans attendre l\'amont (hit+stale)','gauge',_cache_ratios,('cache',))
+M_LOOP_LAG=Histogram('mossad_event_loop_lag_seconds','Retard de réveil de la boucle asyncio',buckets=(.001,.005,.01,.025,.05,.1,.25,.5,1,2.5))
+_loop_lag={'last':0.0,'max':0.0}
+LOOP_LAG_INTERVAL=0.5
+Collected('mossad_event_loop_lag_last_seconds','Dernier retard de réveil mesuré','gauge',lambda:_loop_lag['last'])
+
+async def loop_lag_loop():
+	loop=asyncio.get_running_loop()
+	while True:
+		t0=loop.time();await asyncio.sleep(LOOP_LAG_INTERVAL)
+		lag=max(0.0,loop.time()-t0-LOOP_LAG_INTERVAL);_loop_lag['last']=lag;_loop_lag['max']=max(_loop_lag['max'],lag);M_LOOP_LAG.observe(lag)
+
+async def api_metrics(r):
+	if not METRICS_TOKEN:return web.Response(status=404)  # salons Discord, hôtes amont, collections : jamais public par défaut
+	if not hmac.compare_digest(r.headers.get('Authorization',''),f"Bearer {METRICS_TOKEN}"):return web.Response(status=401)
+	return web.Response(text=render_metrics(),content_type='text/plain',charset='utf-8',headers={'Cache-Control':'no-store'})
+
+# ════════════════════════════════════════════════════════
+# 🌐 CLIENT HTTP PARTAGÉ (dynmap + publicapi)
+# ════════════════════════════════════════════════════════
+HTTP_LIMIT=int(os.getenv('HTTP_LIMIT','64'))
+HTTP_LIMIT_PER_HOST=int(os.getenv('HTTP_LIMIT_PER_HOST','6'))
+HTTP_DNS_TTL=300
+HTTP_KEEPALIVE=60
+HTTP_TIMEOUTS={
+	'dynmap':aiohttp.ClientTimeout(total=5,sock_connect=3),
+	'dynmap_markers':aiohttp.ClientTimeout(total=15,sock_connect=5),
+	'publicapi':aiohttp.ClientTimeout(total=10,sock_connect=5),
+	'self':aiohttp.ClientTimeout(total=10),
+}
+_http_session=None
+_http_stats={'requests':0,'conn_created':0,'conn_reused':0}
+
+async def _on_conn_create(session,ctx,params):_http_stats['conn_created']+=1
+async def _on_conn_reuse(session,ctx,params):_http_stats['conn_reused']+=1
+async def _on_req_start(session,ctx,params):_http_stats['requests']+=1;ctx.t0=time.perf_counter()
+async def _on_req_end(session,ctx,params):  # en-têtes reçus : la lecture du corps n'est pas comptée
+	host=params.url.host;M_UPSTREAM.observe(time.perf_counter()-ctx.t0,host);M_UPSTREAM_STATUS.inc(host,params.response.status)
+async def _on_req_exc(session,ctx,params):
+	host=params.url.host;M_UPSTREAM.observe(time.perf_counter()-ctx.t0,host);M_UPSTREAM_STATUS.inc(host,'error')
+
+def http_session():
+	"""Session aiohttp unique (keep-alive, cache DNS, limites par hôte). Créée dans main(), recréée si fermée."""
+	global _http_session
+	if _http_session is None or _http_session.closed:
+		tc=aiohttp.TraceConfig()
+		tc.on_connection_create_end.append(_on_conn_create)
+		tc.on_connection_reuseconn.append(_on_conn_reuse)
+		tc.on_request_start.append(_on_req_start)
+		tc.on_request_end.append(_on_req_end)
+		tc.on_request_exception.append(_on_req_exc)
+		conn=aiohttp.TCPConnector(limit=HTTP_LIMIT,limit_per_host=HTTP_LIMIT_PER_HOST,ttl_dns_cache=HTTP_DNS_TTL,keepalive_timeout=HTTP_KEEPALIVE,enable_cleanup_closed=True)
+		_http_session=aiohttp.ClientSession(connector=conn,timeout=HTTP_TIMEOUTS['dynmap'],trace_configs=[tc])
+	return _http_session
+
+def http_get(url,profile='dynmap',**kw):
+	"""GET via la session partagée avec le profil de timeout demandé (à utiliser avec `async with`)."""
+	return http_session().get(url,timeout=HTTP_TIMEOUTS[profile],**kw)
+
+async def http_close():
+	global _http_session
+	if _http_session and not _http_session.closed:
+		await _http_session.close()
+		print('🔌 Client HTTP fermé',flush=True)
+	_http_session=None
+
+def http_stats():
+	conn=_http_session.connector if _http_session and not _http_session.closed else None
+	idle=sum(len(v)for v in getattr(conn,'_conns',{}).values())if conn else 0
+	active=len(getattr(conn,'_acquired',()))if conn else 0
+	made=_http_stats['conn_created'];reused=_http_stats['conn_reused']
+	return{**_http_stats,'open':idle+active,'active':active,'idle':idle,'reuse_ratio':round(reused/(made+reused),3)if made+reused else 0.0}
+
+# ════════════════════════════════════════════════════════
+# 🔁 SINGLE-FLIGHT + STALE-WHILE-REVALIDATE
+# ════════════════════════════════════════════════════════
+SWR_GRACE=int(os.getenv('SWR_GRACE','600'))  # fenêtre pendant laquelle une valeur périmée est servie pendant le rafraîchissement
+_inflight={}  # {clé: Task} — fetchs amont en cours
+
+def _flight(key,factory):
+	"""Démarre factory() si aucun fetch n'est en vol pour `key`, sinon renvoie la tâche existante."""
+	t=_inflight.get(key)
+	if t is None or t.done():
+		t=_inflight[key]=asyncio.ensure_future(factory())
+		def _done(task):
+			if _inflight.get(key)is task:del _inflight[key]
+			if not task.cancelled():task.exception()  # évite "exception never retrieved" pour les refresh en fond
+		t.add_done_callback(_done)
+	return t
+
+async def single_flight(key,factory):
+	"""Les appels concurrents sur la même clé attendent le même fetch (l'annulation d'un appelant ne l'annule pas)."""
+	return await asyncio.shield(_flight(key,factory))
+
+async def swr_get(cache,key,ttl,fetch,grace=None,name=None):
+	"""cache[key]=(valeur,ts). Frais → direct ; périmé dans la grâce → servi et rafraîchi en fond ; sinon attente du fetch unique.
+	   name : libellé du cache dans mossad_cache_requests_total."""
+	grace=SWR_GRACE if grace is None else grace
+	ent=cache.get(key);now=time.time()
+	if ent and now-ent[1]<ttl:
+		if name:M_CACHE.inc(name,'hit')
+		return ent[0]
+	async def _load():
+		val=await fetch();cache[key]=(val,time.time());return val
+	fk=(id(cache),key)
+	if ent and now-ent[1]<ttl+grace:
+		if name:M_CACHE.inc(name,'stale')
+		_flight(fk,_load);return ent[0]
+	if name:M_CACHE.inc(name,'miss')
+	try:return await single_flight(fk,_load)
+	except Exception:
+		if ent:return ent[0]
+		raise
+
                 
 
                                       
@@ -94,74 +306,556 @@ def require_auth(handler):
 		if not t or not _jwt_verify(t):return cors({'error':'Non autorisé'},401)
 		return await handler(r,*a,**kw)
 	return wrapper
-def cors(data,status=200):return web.Response(text=json.dumps(data,ensure_ascii=False),status=status,content_type='application/json',headers=CORS)
+# ════════════════════════════════════════════════════════
+# 🐢 BOUCLE BLOQUÉE : CHIEN DE GARDE + PROFILEUR À LA DEMANDE
+# ════════════════════════════════════════════════════════
+SLOW_CALLBACK_MS=int(os.getenv('SLOW_CALLBACK_MS','250'))  # au-delà, le callback en cours est journalisé avec sa pile
+WATCHDOG_INTERVAL=0.05
+STALL_STACK_DEPTH=15
+PROFILE_MAX_SECONDS=60
+_wd={'loop':None,'ident':None,'event':None,'stack':None,'task':None,'stalls':0,'max_ms':0,'last':None}
+_prof={'running':False,'runs':0}
+_frame_labels={}  # code → "fonction (fichier:ligne)"
+_HANDLE_RUN_CODE=asyncio.events.Handle._run.__code__
+M_STALL=Histogram('mossad_event_loop_stall_seconds',f'Blocages de la boucle asyncio de plus de {SLOW_CALLBACK_MS} ms',buckets=(.25,.5,1,2.5,5,10,30))
+
+def _frame_label(co):
+	l=_frame_labels.get(co)
+	if l is None:l=_frame_labels[co]=f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})"
+	return l
+
+def _loop_stack():
+	"""Pile du thread de la boucle (coroutines comprises : elles s'exécutent sur cette pile) + tâche en cours."""
+	f=sys._current_frames().get(_wd['ident']);lines=[]
+	while f is not None and len(lines)<STALL_STACK_DEPTH:lines.append(f"{os.path.basename(f.f_code.co_filename)}:{f.f_lineno} {f.f_code.co_name}");f=f.f_back
+	try:t=asyncio.current_task(_wd['loop']);task=f"{t.get_name()} {t.get_coro().__qualname__}"if t else None
+	except Exception:task=None
+	return lines[::-1],task
+
+def _wd_pong(t0):
+	d=time.perf_counter()-t0
+	if d*1000>=SLOW_CALLBACK_MS:
+		stack=_wd['stack']or[];ms=round(d*1000);_wd['stalls']+=1;_wd['max_ms']=max(_wd['max_ms'],ms);M_STALL.observe(d)
+		_wd['last']={'at':time.time(),'ms':ms,'task':_wd['task'],'stack':stack}
+		print(f"🐢 Boucle bloquée {ms} ms (tâche {_wd['task']})"+''.join(f"\n    {l}"for l in stack),flush=True)
+	_wd['stack']=_wd['task']=None;_wd['event'].set()
+
+def _wd_run():
+	"""Thread : poste un ping sur la boucle et l'attend ; passé SLOW_CALLBACK_MS, photographie la pile de ce qui bloque."""
+	loop,ev=_wd['loop'],_wd['event']
+	while not loop.is_closed():
+		ev.clear();t0=time.perf_counter()
+		try:loop.call_soon_threadsafe(_wd_pong,t0)
+		except RuntimeError:return  # boucle fermée
+		if not ev.wait(SLOW_CALLBACK_MS/1000):
+			_wd['stack'],_wd['task']=_loop_stack()
+			while not ev.wait(1.0):
+				if loop.is_closed():return
+		time.sleep(WATCHDOG_INTERVAL)
+
+def start_loop_watchdog():
+	"""À appeler depuis la boucle à surveiller."""
+	if _wd['loop']:return
+	_wd.update(loop=asyncio.get_running_loop(),ident=threading.get_ident(),event=threading.Event())
+	threading.Thread(target=_wd_run,name='loop-watchdog',daemon=True).start()
+
+def loop_stats():return{'slow_callback_ms':SLOW_CALLBACK_MS,'stalls':_wd['stalls'],'max_stall_ms':_wd['max_ms'],'last_stall':_wd['last'],
+	'lag_last_ms':round(_loop_lag['last']*1000,2),'lag_max_ms':round(_loop_lag['max']*1000,2),'profiling':_prof['running']}
+
+def _sample_stacks(seconds,interval,all_threads):
+	"""Échantillonne les piles (thread de la boucle, ou tous) → {pile repliée 'racine;...;feuille': échantillons}."""
+	folded={};me=threading.get_ident();n=0;end=time.perf_counter()+seconds
+	while time.perf_counter()<end:
+		names={t.ident:t.name for t in threading.enumerate()}if all_threads else None
+		for tid,f in sys._current_frames().items():
+			if tid==me or(not all_threads and tid!=_wd['ident']):continue
+			if f.f_code.co_filename.endswith('selectors.py'):key='(idle)'  # boucle en attente d'E/S
+			else:
+				stack=[]
+				while f is not None:
+					if f.f_code is _HANDLE_RUN_CODE:break  # au-dessus : run_forever/_run_once, identiques pour tous les callbacks
+					stack.append(_frame_label(f.f_code));f=f.f_back
+				key=';'.join(reversed(stack))
+			key=f"{names.get(tid,tid)if all_threads else'loop'};{key}";folded[key]=folded.get(key,0)+1
+		n+=1;time.sleep(interval)
+	return folded,n
+
+@require_auth
+async def api_debug_profile(r):
+	"""Profil échantillonné au format replié (flamegraph.pl, speedscope) : ?seconds=10&interval_ms=5&threads=all&focus=scan_server,api_"""
+	q=r.rel_url.query
+	try:seconds=min(max(float(q.get('seconds',10)),0.1),PROFILE_MAX_SECONDS);interval=max(float(q.get('interval_ms',5)),1)/1000
+	except ValueError:return cors({'error':'Paramètres invalides'},400)
+	if not _wd['ident']:return cors({'error':'Chien de garde non démarré'},503)
+	if _prof['running']:return cors({'error':'Profilage déjà en cours'},409)
+	_prof['running']=True;_prof['runs']+=1
+	try:folded,n=await asyncio.get_running_loop().run_in_executor(None,_sample_stacks,seconds,interval,q.get('threads')=='all')
+	finally:_prof['running']=False
+	focus=[f for f in q.get('focus','').split(',')if f]
+	if focus:folded={k:v for k,v in folded.items()if any(fr.startswith(p)for fr in k.split(';')for p in focus)}
+	body=''.join(f"{k} {v}\n"for k,v in sorted(folded.items(),key=lambda kv:-kv[1]))
+	return web.Response(text=body,content_type='text/plain',charset='utf-8',headers={**CORS,'Cache-Control':'no-store','X-Profile-Samples':str(n)})
+
+# ════════════════════════════════════════════════════════
+# 📦 ENCODAGE DES RÉPONSES (orjson, gzip/brotli, colonnes)
+# ════════════════════════════════════════════════════════
+COMPRESS_MIN_BYTES=1024  # en dessous, l'en-tête coûte plus que le gain
+BROTLI_QUALITY=4  # rapide, déjà nettement plus compact que gzip sur du JSON
+_enc_stats={'responses':0,'bytes_raw':0,'bytes_sent':0,'br':0,'gzip':0}
+
+def dumps(data):
+	if orjson:return orjson.dumps(data,option=orjson.OPT_NON_STR_KEYS)
+	return json.dumps(data,ensure_ascii=False).encode()
+
+def cors(data,status=200):return web.Response(body=dumps(data),status=status,content_type='application/json',charset='utf-8',headers=CORS)
+
+@web.middleware
+async def compress_middleware(r,handler):
+	"""Négocie br (si le module brotli est installé) puis gzip/deflate via aiohttp pour les réponses JSON."""
+	resp=await handler(r)
+	if not isinstance(resp,web.Response)or resp.content_type!='application/json':return resp
+	body=resp.body;n=len(body)if isinstance(body,(bytes,bytearray))else 0
+	_enc_stats['responses']+=1;_enc_stats['bytes_raw']+=n
+	if n<COMPRESS_MIN_BYTES or 'Content-Encoding'in resp.headers:_enc_stats['bytes_sent']+=n;return resp
+	ae=r.headers.get('Accept-Encoding','').lower()
+	resp.headers['Vary']='Accept-Encoding'
+	etag=resp.headers.get('ETag')
+	if brotli and'br'in ae:
+		resp.body=brotli.compress(bytes(body),quality=BROTLI_QUALITY);resp.headers['Content-Encoding']='br'
+		_enc_stats['br']+=1;_enc_stats['bytes_sent']+=len(resp.body)
+		if etag:resp.headers['ETag']=etag[:-1]+'-br"'  # ETag fort : une valeur par représentation
+	elif'gzip'in ae or'deflate'in ae:
+		resp.enable_compression();_enc_stats['gzip']+=1;_enc_stats['bytes_sent']+=n  # taille compressée inconnue ici
+		if etag:resp.headers['ETag']=etag[:-1]+'-gz"'
+	else:_enc_stats['bytes_sent']+=n
+	return resp
+
+def want_columns(r):return r.rel_url.query.get('fmt')=='col'
+
+def columnar(rows):
+	"""[{k:v}] -> {'n','cols':{k:[v]}} ; clé absente d'une ligne -> null."""
+	keys=list(dict.fromkeys(k for row in rows for k in row))
+	return {'n':len(rows),'cols':{k:[row.get(k)for row in rows]for k in keys}}
+
+def delta_encode(vals):
+	"""Coordonnées arrondies au bloc, première valeur absolue puis écarts successifs."""
+	out,prev=[],0
+	for v in vals:v=int(round(v));out.append(v-prev);prev=v
+	return out
+
+def enc_stats():
+	d=dict(_enc_stats);d['json']='orjson'if orjson else'json';d['brotli']=bool(brotli)
+	return {**d,'etag':dict(_etag_stats),'memo':len(_resp_memo)}
+
+RESP_MEMO_MAX=256
+_resp_memo=OrderedDict()  # {clé: (version, corps, etag)}
+_etag_stats={'memo_hits':0,'built':0,'not_modified':0}
+
+def _etag_matches(r,etag):
+	inm=r.headers.get('If-None-Match')
+	if not inm:return False
+	base=etag.strip('"')
+	for t in inm.split(','):
+		t=t.strip().removeprefix('W/').strip('"')
+		if t=='*'or t.split('-')[0]==base:return True  # suffixe -br/-gz ajouté par compress_middleware
+	return False
+
+async def cached_json(r,key,version,build,max_age,private=True):
+	"""Réponse JSON conditionnelle (ETag fort + Cache-Control, 304 sur If-None-Match).
+	   Corps et ETag mémorisés par (clé, version des données en cache) : tant que la version ne bouge pas,
+	   ni reconstruction ni sérialisation. version=None → reconstruit à chaque appel."""
+	m=_resp_memo.get(key)
+	if version is not None and m and m[0]==version:
+		body,etag=m[1],m[2];_resp_memo.move_to_end(key);_etag_stats['memo_hits']+=1
+	else:
+		data=build()
+		if asyncio.iscoroutine(data):data=await data
+		body=dumps(data);etag='"'+hashlib.blake2b(body,digest_size=12).hexdigest()+'"';_etag_stats['built']+=1
+		if version is not None:
+			_resp_memo[key]=(version,body,etag);_resp_memo.move_to_end(key)
+			while len(_resp_memo)>RESP_MEMO_MAX:_resp_memo.popitem(last=False)
+	headers={**CORS,'ETag':etag,'Cache-Control':f"{'private'if private else'public'}, max-age={max(0,int(max_age))}"}
+	if _etag_matches(r,etag):_etag_stats['not_modified']+=1;return web.Response(status=304,headers=headers)
+	return web.Response(body=body,content_type='application/json',charset='utf-8',headers=headers)
 async def handle_options(r):return web.Response(status=204,headers=CORS)
 mongo_ok=False
 db=sessions_col=config_col=None
+BACKFILL_CUTOFFS=('hm_backfill_cutoff','activity_rollups_cutoff')
+def _seed_cutoffs(d,ts):
+	"""Coupures des backfills et de la migration sessions2 (synchrone : init_mongo, rejeu d'un enregistrement 'cutoff').
+	   $min : une coupure ne peut que reculer (un démarrage plus ancien a déjà compté en direct à partir de la sienne).
+	   Migration sans état : sessions2 déjà peuplée avant toute écriture de ce processus → ancienne migration passée."""
+	cfg=d['config']
+	for key in BACKFILL_CUTOFFS:cfg.update_one({'key':key},{'$min':{'value':ts}},upsert=True)
+	if not cfg.find_one({'key':'sessions2_migration'}):
+		st={'status':'done'}if d['sessions2'].find_one({},{'_id':1})else{'status':'running','cutoff':ts}
+		cfg.update_one({'key':'sessions2_migration'},{'$setOnInsert':{'value':st}},upsert=True)
+	cfg.update_one({'key':'sessions2_migration','value.status':{'$ne':'done'}},{'$min':{'value.cutoff':ts}})
+
 def init_mongo():
 	global mongo_ok,db,sessions_col,config_col
 	if not MONGO_URL:return
 	try:
 		from pymongo import MongoClient,ASCENDING
-		c=MongoClient(MONGO_URL,serverSelectionTimeoutMS=8000,tls=True,tlsAllowInvalidCertificates=True)
+		c=MongoClient(MONGO_URL,serverSelectionTimeoutMS=8000,**({'tls':True,'tlsAllowInvalidCertificates':True}if MONGO_TLS else{}))
 		c.admin.command('ping')
 		db=c['mossadglory']
 		sessions_col=db['sessions']
 		config_col=db['config']
 		sessions_col.create_index([('player',ASCENDING),('ts',ASCENDING)])
 		db['presence'].create_index([('total',-1)])
+		try:db['presence'].create_index([('player',ASCENDING)],unique=True)
+		except OperationFailure as e:print(f"⚠️ presence : doublons de joueur, index player non unique ({e})",flush=True);db['presence'].create_index([('player',ASCENDING)])
 		db['sessions2'].create_index([('player',ASCENDING),('start',ASCENDING)])
 		db['swords'].create_index([('name',ASCENDING)],unique=True)
                                
 		db['recruitments'].create_index([('server',ASCENDING),('country',ASCENDING),('ts',ASCENDING)])
 		db['notes'].create_index([('player',ASCENDING)],unique=True)
+		for col,_,ttl in ACTIVITY_ROLLUPS:
+			db[col].create_index([('ts',ASCENDING)],unique=True,**({'expireAfterSeconds':ttl}if ttl else{}))
+		_seed_cutoffs(db,_BOOT_TS)  # avant mongo_ok : aucune écriture en direct ne précède les coupures
 		mongo_ok=True
 		print('✅ MongoDB OK',flush=True)
 	except Exception as e:print(f"❌ MongoDB: {e}",flush=True)
 
+# ════════════════════════════════════════════════════════
+# 🗄️ PERSISTANCE ASYNC (pymongo exécuté hors de l'event loop)
+# ════════════════════════════════════════════════════════
+DB_WORKERS=int(os.getenv('DB_WORKERS','8'))
+DB_QUEUE_MAX=int(os.getenv('DB_QUEUE_MAX','64'))  # opérations en cours max par collection, les suivantes attendent
+_db_executor=ThreadPoolExecutor(max_workers=DB_WORKERS,thread_name_prefix='mongo')
+_db_stats={}  # {collection: {'depth','ops','errors','wait_total','wait_max','op_total'}}
+_db_slots={}  # {collection: Semaphore}
+
+class AsyncCollection:
+	"""Façade awaitable d'une collection : chaque opération pymongo part dans le pool de threads Mongo.
+	   adb.sessions.insert_one(doc), adb.config.find_one(q)... ou run(fn) pour les curseurs."""
+	def __init__(self,name):
+		self.name=name
+		_db_stats.setdefault(name,{'depth':0,'ops':0,'errors':0,'wait_total':0.0,'wait_max':0.0,'op_total':0.0})
+		_db_slots.setdefault(name,asyncio.Semaphore(DB_QUEUE_MAX))
+	def __getattr__(self,method):
+		if method.startswith('_'):raise AttributeError(method)
+		return lambda *a,**kw:self.run(lambda c:getattr(c,method)(*a,**kw))
+	def _timed(self,fn):
+		started=time.perf_counter();return started,fn(db[self.name])
+	async def run(self,fn):
+		"""Exécute fn(collection) dans le pool ; à utiliser pour matérialiser un curseur (lambda c:list(c.find(...)))."""
+		st=_db_stats[self.name];st['depth']+=1;t0=time.perf_counter()
+		try:
+			async with _db_slots[self.name]:
+				started,res=await asyncio.get_running_loop().run_in_executor(_db_executor,self._timed,fn)
+		except Exception:st['errors']+=1;raise
+		finally:st['depth']-=1
+		wait=started-t0;op=time.perf_counter()-started;st['ops']+=1;st['wait_total']+=wait;st['wait_max']=max(st['wait_max'],wait);st['op_total']+=op
+		M_MONGO_OP.observe(op,self.name);M_MONGO_WAIT.observe(wait,self.name)
+		return res
+	async def find_list(self,*a,sort=None,limit=0,**kw):
+		def _q(c):
+			cur=c.find(*a,**kw)
+			if sort:cur=cur.sort(sort)
+			if limit:cur=cur.limit(limit)
+			return list(cur)
+		return await self.run(_q)
+	async def aggregate_list(self,pipeline,**kw):return await self.run(lambda c:list(c.aggregate(pipeline,**kw)))
+
+class _AsyncDB:
+	def __init__(self):self._cols={}
+	def __getattr__(self,name):
+		if name.startswith('_'):raise AttributeError(name)
+		if name not in self._cols:self._cols[name]=AsyncCollection(name)
+		return self._cols[name]
+adb=_AsyncDB()
+for _c in('sessions','sessions2','presence','activity','recruitments','config','swords'):getattr(adb,_c)
+
+M_MONGO_OP=Histogram('mossad_mongo_op_seconds','Durée des opérations MongoDB par collection (hors attente)',('collection',))
+M_MONGO_WAIT=Histogram('mossad_mongo_wait_seconds','Attente d\'un slot/thread avant l\'opération MongoDB',('collection',))
+Collected('mossad_mongo_errors_total','Opérations MongoDB en erreur','counter',lambda:{n:st['errors']for n,st in _db_stats.items()},('collection',))
+Collected('mossad_mongo_inflight','Opérations MongoDB en cours ou en attente','gauge',lambda:{n:st['depth']for n,st in _db_stats.items()},('collection',))
+
+def db_stats():
+	return{n:{'depth':st['depth'],'ops':st['ops'],'errors':st['errors'],'wait_avg_ms':round(st['wait_total']/st['ops']*1000,2)if st['ops']else 0,'wait_max_ms':round(st['wait_max']*1000,2),'op_avg_ms':round(st['op_total']/st['ops']*1000,2)if st['ops']else 0}for n,st in _db_stats.items()}
+
+# ════════════════════════════════════════════════════════
+# 📦 WRITE-BEHIND (pings, sessions, compteurs de présence)
+# ════════════════════════════════════════════════════════
+WB_FLUSH_SIZE=int(os.getenv('WB_FLUSH_SIZE','200'))
+WB_FLUSH_INTERVAL=float(os.getenv('WB_FLUSH_INTERVAL','5'))
+_wb={'sessions':[],'sessions2':[],'presence':{},'presence_retry':[]}  # presence: {player: {'total','servers':{srv:n},'last_seen','last_server'}}
+# presence_retry: [(id, presence)] deltas déjà tentés — renvoyés tels quels sous garde last_seen, jamais refusionnés (un essai en échec a pu s'appliquer en partie) ; id repris s'ils passent au journal
+_wb_lock=asyncio.Lock()
+_wb_wakeup=asyncio.Event()
+_wb_stats={'flushes':0,'written':0,'failures':0,'fail_streak':0}
+
+def _wb_pending():return len(_wb['sessions'])+len(_wb['sessions2'])+len(_wb['presence'])+sum(len(p)for _,p in _wb['presence_retry'])
+
+def _wb_merge_presence(dst,src):
+	for p,v in src.items():
+		cur=dst.get(p)
+		if not cur:dst[p]=v;continue
+		cur['total']+=v['total']
+		for srv,n in v['servers'].items():cur['servers'][srv]=cur['servers'].get(srv,0)+n
+		for k,n in v.get('hm',{}).items():cur.setdefault('hm',{})[k]=cur.get('hm',{}).get(k,0)+n
+		for k,x in v.get('hs',{}).items():cur.setdefault('hs',{})[k]=cur.get('hs',{}).get(k,0)+x
+		if v['last_seen']>=cur['last_seen']:cur['last_seen']=v['last_seen'];cur['last_server']=v['last_server']
+
+def _wb_add(kind,doc):
+	doc.setdefault('_id',ObjectId())  # _id posé côté client : un retry d'insert_many ne crée pas de doublon
+	_wb[kind].append(doc)
+	if _wb_pending()>=WB_FLUSH_SIZE and not _wb_stats['fail_streak']:_wb_wakeup.set()  # en échec : on laisse le backoff jouer
+
+def _presence_ops(pres,op_id=None,retry=False):
+	"""Un upsert $inc par joueur : compteurs serveur + histogramme jour×heure (hm.{j}.{h}) et somme des heures d'arrivée (hs.{j}).
+	   Un document créé ici n'a aucun ping antérieur : il est marqué complet (hm_v) d'office.
+	   retry / op_id (delta déjà tenté, ou rejoué depuis le journal ; bulk_write ordonné) : document créé à part, puis $inc
+	   seulement si last_seen n'est pas déjà celui du delta (essai précédent appliqué) et, au rejeu, si op_id n'est pas
+	   dans _jr (les JOURNAL_APPLIED_KEEP derniers deltas rejoués : des écritures live ont pu bouger last_seen entre-temps)."""
+	ops=[]
+	for p,v in pres.items():
+		ls=v['last_seen'].replace(microsecond=v['last_seen'].microsecond//1000*1000)  # précision BSON : la garde compare à la valeur stockée
+		upd={'$inc':{'total':v['total'],**{f'servers.{srv}':n for srv,n in v['servers'].items()},**{f'hm.{k}':n for k,n in v.get('hm',{}).items()},**{f'hs.{k}':x for k,x in v.get('hs',{}).items()}},'$set':{'last_seen':ls,'last_server':v['last_server']}}
+		if not(retry or op_id):ops.append(UpdateOne({'player':p},{**upd,'$setOnInsert':{'hm_v':1}},upsert=True));continue
+		q={'player':p,'last_seen':{'$ne':ls}}
+		if op_id:q['_jr']={'$ne':op_id};upd['$push']={'_jr':{'$each':[op_id],'$slice':-JOURNAL_APPLIED_KEEP}}
+		ops+=[UpdateOne({'player':p},{'$setOnInsert':{'hm_v':1}},upsert=True),UpdateOne(q,upd)]
+	return ops
+
+async def _insert_idempotent(col,docs):
+	"""insert_many non ordonné ; les doublons (_id déjà écrit lors d'un essai précédent) sont ignorés."""
+	try:await col.insert_many(docs,ordered=False)
+	except BulkWriteError as e:
+		if any(w.get('code')!=11000 for w in e.details.get('writeErrors',[])):raise
+
+async def wb_flush():
+	"""Vide le buffer en insert_many/bulk_write. En cas d'échec, les lots sont remis en tête du buffer
+	   puis basculés dans le journal disque si MongoDB reste indisponible."""
+	async with _wb_lock:
+		if not _wb_pending():return True
+		if not mongo_ok:
+			_wb_spill();await journal_flush();return False
+		fresh=bool(_wb['presence'])
+		pings,sess,pres=_wb['sessions'],_wb['sessions2'],_wb['presence_retry']+([(str(ObjectId()),_wb['presence'])]if fresh else[])
+		_wb['sessions'],_wb['sessions2'],_wb['presence'],_wb['presence_retry']=[],[],{},[]
+		ok=True
+		for kind,docs in(('sessions',pings),('sessions2',sess)):
+			if not docs:continue
+			try:await _insert_idempotent(getattr(adb,kind),docs);_wb_stats['written']+=len(docs)
+			except Exception as e:ok=False;_wb[kind][:0]=docs;print(f"❌ write-behind {kind}: {e}",flush=True)
+		for i,(op_id,delta)in enumerate(pres):
+			retry=i<len(pres)-1 or not fresh  # seul le delta neuf part sans garde
+			try:await adb.presence.bulk_write(_presence_ops(delta,retry=retry),ordered=retry);_wb_stats['written']+=len(delta)
+			except Exception as e:ok=False;_wb['presence_retry']=pres[i:];print(f"❌ write-behind presence: {e}",flush=True);break
+		_wb_stats['flushes']+=1
+		if ok:_wb_stats['fail_streak']=0
+		else:
+			_wb_stats['failures']+=1;_wb_stats['fail_streak']+=1
+			if _wb_stats['fail_streak']>=JOURNAL_SPILL_AFTER or _wb_pending()>WB_MAX_PENDING:_wb_spill();await journal_flush()
+		return ok
+
+async def write_behind_loop():
+	backoff=WB_FLUSH_INTERVAL
+	while True:
+		try:await asyncio.wait_for(_wb_wakeup.wait(),timeout=backoff)
+		except asyncio.TimeoutError:pass
+		_wb_wakeup.clear()
+		ok=await wb_flush()
+		backoff=WB_FLUSH_INTERVAL if ok else min(backoff*2,60)
+
+def wb_stats():return{**_wb_stats,'pending':{'sessions':len(_wb['sessions']),'sessions2':len(_wb['sessions2']),'presence':len(_wb['presence']),'presence_retry':len(_wb['presence_retry'])}}
+
+# ════════════════════════════════════════════════════════
+# 💾 JOURNAL DISQUE (écritures pendant une panne MongoDB)
+# ════════════════════════════════════════════════════════
+JOURNAL_PATH=os.getenv('JOURNAL_PATH','mossad_journal.ndjson')
+JOURNAL_FSYNC_INTERVAL=1.0  # les lignes sont regroupées puis fsync au plus une fois par seconde
+JOURNAL_RETRY_INTERVAL=30  # reconnexion / rejeu
+JOURNAL_SPILL_AFTER=3  # échecs de flush consécutifs avant bascule du buffer sur disque
+JOURNAL_REPLAY_BATCH=500
+JOURNAL_APPLIED_KEEP=32  # ids de deltas gardés par document cible : couvre un rejeu interrompu puis repris
+WB_MAX_PENDING=5000
+_jr_pending=[]  # lignes encodées en attente d'écriture+fsync
+_jr_lock=asyncio.Lock()
+_jr_stats={'appended':0,'spills':0,'replayed':0,'replays':0}
+
+def journal_append(kind,doc,key=None):
+	rec={'k':kind,'d':doc}
+	if key:rec['id']=key
+	_jr_pending.append(json_util.dumps(rec,ensure_ascii=False)+'\n');_jr_stats['appended']+=1
+
+def _jr_write(lines):
+	with open(JOURNAL_PATH,'a',encoding='utf-8')as f:
+		f.writelines(lines);f.flush();os.fsync(f.fileno())
+
+async def journal_flush():
+	async with _jr_lock:
+		if not _jr_pending:return
+		lines=_jr_pending[:];del _jr_pending[:]
+		try:await asyncio.get_running_loop().run_in_executor(None,_jr_write,lines)
+		except Exception as e:_jr_pending[:0]=lines;print(f"❌ journal: {e}",flush=True)
+
+def _wb_spill():
+	n=_wb_pending()
+	for d in _wb['sessions']:journal_append('sessions',d)
+	for d in _wb['sessions2']:journal_append('sessions2',d)
+	for op_id,delta in _wb['presence_retry']:journal_append('presence',delta,key=op_id)  # même id : le rejeu ignore la part déjà appliquée
+	if _wb['presence']:journal_append('presence',_wb['presence'],key=str(ObjectId()))
+	_wb['sessions'],_wb['sessions2'],_wb['presence'],_wb['presence_retry']=[],[],{},[]
+	_jr_stats['spills']+=1;print(f"💾 MongoDB indisponible : {n} événements basculés dans le journal",flush=True)
+
+async def persist_or_journal(kind,doc):
+	"""insert_one si MongoDB répond, sinon journal disque (rejoué plus tard grâce au _id client)."""
+	doc.setdefault('_id',ObjectId())
+	if mongo_ok:
+		try:await getattr(adb,kind).insert_one(doc);return
+		except Exception as e:print(f"❌ {kind}: {e}, bascule journal",flush=True)
+	journal_append(kind,doc)
+
+def _jr_read_batch(f,n):
+	out=[]
+	for line in f:
+		out.append(line)
+		if len(out)>=n:break
+	return out
+
+async def journal_replay():
+	"""Rejoue le journal par lots. Inserts idempotents (_id client) ; deltas de présence et agrégats d'activité gardés par id
+	   sur le document cible (rejeu interrompu → rien n'est compté deux fois), puis marqués dans journal_applied une fois appliqués."""
+	await journal_flush()
+	loop=asyncio.get_running_loop();path=JOURNAL_PATH+'.replay'
+	async with _jr_lock:
+		if not os.path.exists(path)and os.path.exists(JOURNAL_PATH):os.replace(JOURNAL_PATH,path)
+	if not os.path.exists(path):return
+	print('🔁 Rejeu du journal MongoDB...',flush=True);n=0
+	with open(path,encoding='utf-8')as f:
+		while True:
+			lines=await loop.run_in_executor(None,_jr_read_batch,f,JOURNAL_REPLAY_BATCH)
+			if not lines:break
+			batch={}
+			for line in lines:
+				try:rec=json_util.loads(line)
+				except ValueError:continue  # ligne tronquée (arrêt brutal pendant l'écriture)
+				if rec['k']in('presence','activity'):
+					# marqueur écrit APRÈS application : un échec en cours de route laisse l'événement rejouable
+					op_id=rec['id']if rec['k']=='presence'else rec['d']['_id']
+					if await adb.journal_applied.find_one({'_id':op_id}):continue  # déjà appliqué en entier
+					if rec['k']=='presence':await adb.presence.bulk_write(_presence_ops(rec['d'],op_id),ordered=True)
+					else:
+						try:await adb.activity.insert_one(rec['d'])
+						except DuplicateKeyError:pass  # inséré lors d'un rejeu interrompu : les agrégats manquent peut-être encore
+						await apply_activity_rollups(rec['d'],guard=True);_activity_touch()
+					try:await adb.journal_applied.insert_one({'_id':op_id,'ts':datetime.utcnow()})
+					except DuplicateKeyError:pass
+				elif rec['k']=='cutoff':await loop.run_in_executor(_db_executor,_seed_cutoffs,db,rec['d']['ts'])
+				else:batch.setdefault(rec['k'],[]).append(rec['d'])
+				n+=1
+			for kind,docs in batch.items():await _insert_idempotent(getattr(adb,kind),docs)
+	os.remove(path);_jr_stats['replayed']+=n;_jr_stats['replays']+=1
+	print(f"✅ Journal rejoué : {n} événements",flush=True)
+
+async def journal_loop():
+	last=time.monotonic()
+	while True:
+		await asyncio.sleep(JOURNAL_FSYNC_INTERVAL)
+		await journal_flush()
+		if not MONGO_URL or time.monotonic()-last<JOURNAL_RETRY_INTERVAL:continue
+		last=time.monotonic()
+		if not mongo_ok:
+			await asyncio.get_running_loop().run_in_executor(_db_executor,init_mongo)
+			if not mongo_ok:continue
+		if os.path.exists(JOURNAL_PATH)or os.path.exists(JOURNAL_PATH+'.replay'):
+			try:await journal_replay()
+			except Exception as e:print(f"❌ Rejeu journal: {e}",flush=True)
+
+async def wait_mongo():
+	"""Attend que MongoDB soit joignable (journal_loop retente init_mongo) ; False sans MONGO_URL.
+	   Pour les tâches de fond lancées au démarrage, qui ne doivent pas abandonner si MongoDB est absent à ce moment-là."""
+	if not MONGO_URL:return False
+	while not mongo_ok:await asyncio.sleep(JOURNAL_RETRY_INTERVAL)
+	return True
+
+async def journal_drained():
+	"""Attend que le journal disque soit rejoué : les backfills lisent la coupure et les pings qu'il contient."""
+	while _jr_pending or os.path.exists(JOURNAL_PATH)or os.path.exists(JOURNAL_PATH+'.replay'):await asyncio.sleep(JOURNAL_RETRY_INTERVAL)
+
+def journal_stats():
+	size=sum(os.path.getsize(p)for p in(JOURNAL_PATH,JOURNAL_PATH+'.replay')if os.path.exists(p))
+	return{**_jr_stats,'pending':len(_jr_pending),'bytes':size}
+
 def record_connection(player,server):
-	if not mongo_ok:return
-	try:
-		now=datetime.utcnow()+timedelta(hours=1)
-		sessions_col.insert_one({'player':player,'server':server,'ts':now,'day':now.weekday(),'hour':now.hour,'minute':now.minute})
-		db['presence'].update_one(
-		 {'player':player},
-		 {
-		  '$inc':{'total':1,f'servers.{server}':1},
-		  '$set':{'last_seen':now,'last_server':server}
-		 },
-		 upsert=True
-		)
-	except:pass
+	if not MONGO_URL:return
+	now=datetime.utcnow()+timedelta(hours=1)
+	_wb_add('sessions',{'player':player,'server':server,'ts':now,'day':now.weekday(),'hour':now.hour,'minute':now.minute})
+	d=now.weekday()
+	_wb_merge_presence(_wb['presence'],{player:{'total':1,'servers':{server:1},'hm':{f'{d}.{now.hour}':1},'hs':{str(d):now.hour+now.minute/60},'last_seen':now,'last_server':server}})
 
-def get_sessions(player,limit=500):
+async def get_sessions(player,limit=500):
 	if not mongo_ok:return[]
-	try:from pymongo import ASCENDING;return list(sessions_col.find({'player':player},{'_id':0}).sort('ts',ASCENDING).limit(limit))
+	try:return await adb.sessions.find_list({'player':player},{'_id':0},sort=[('ts',1)],limit=limit)
 	except:return[]
-def get_pronostic(player):
-	ss=get_sessions(player,200)
-	if len(ss)<3:return None
-	DAYS=['Lundi','Mardi','Mercredi','Jeudi','Vendredi','Samedi','Dimanche'];dc,hbd=[0]*7,[[]for _ in range(7)]
-	for s in ss:dc[s['day']]+=1;hbd[s['day']].append(s['hour']+s.get('minute',0)/60)
-	total=len(ss);res=[]
+_BOOT_TS=datetime.utcnow()+timedelta(hours=1)  # début du comptage en direct des histogrammes
+
+async def get_histogram(player):
+	"""(hm 7×24 connexions par jour/heure, hs somme des heures d'arrivée par jour) sur tout l'historique.
+	   Un seul find_one sur presence ; repli sur les pings bruts tant que le backfill n'a pas traité le joueur."""
+	if not mongo_ok:return None
+	try:doc=await adb.presence.find_one({'player':player},{'_id':0,'hm':1,'hs':1,'hm_v':1})
+	except Exception:return None
+	if doc and doc.get('hm_v'):
+		hm,hs=doc.get('hm',{}),doc.get('hs',{})
+		return[[hm.get(str(d),{}).get(str(h),0)for h in range(24)]for d in range(7)],[hs.get(str(d),0.0)for d in range(7)]
+	ss=await get_sessions(player,500)
+	hm=[[0]*24 for _ in range(7)];hs=[0.0]*7
+	for s in ss:hm[s['day']][s['hour']]+=1;hs[s['day']]+=s['hour']+s.get('minute',0)/60
+	return hm,hs
+async def get_pronostic(player):
+	res=await get_histogram(player)
+	if not res:return None
+	hm,hs=res;dc=[sum(row)for row in hm];total=sum(dc)
+	if total<3:return None
+	DAYS=['Lundi','Mardi','Mercredi','Jeudi','Vendredi','Samedi','Dimanche'];res=[]
 	for d in range(7):
 		if not dc[d]:continue
-		avg=sum(hbd[d])/len(hbd[d]);res.append((d,int(avg),int(avg%1*60),round(dc[d]/total*100)))
+		avg=hs[d]/dc[d];res.append((d,int(avg),int(avg%1*60),round(dc[d]/total*100)))
 	return sorted(res,key=lambda x:-x[3])[:5],DAYS,total
-def get_plages(player):
-	ss=get_sessions(player,500)
-	if not ss:return None
-	DAYS=['Lun','Mar','Mer','Jeu','Ven','Sam','Dim'];hm=[[0]*24 for _ in range(7)]
-	for s in ss:hm[s['day']][s['hour']]+=1
-	return hm,DAYS
-def cfg_set(key,val):
+async def get_plages(player):
+	res=await get_histogram(player)
+	if not res or not any(map(sum,res[0])):return None
+	DAYS=['Lun','Mar','Mer','Jeu','Ven','Sam','Dim']
+	return res[0],DAYS
+
+async def backfill_histograms():
+	"""Construit une fois hm/hs depuis toute la collection sessions (pings antérieurs au déploiement des histogrammes).
+	   Les pings postérieurs à la coupure sont comptés en direct par record_connection."""
+	if not await wait_mongo()or await cfg_get('hm_backfill_done'):return
+	await journal_drained()
+	cutoff=await cfg_get('hm_backfill_cutoff')
+	if not cutoff:cutoff=_BOOT_TS;await cfg_set('hm_backfill_cutoff',cutoff)
+	print('📊 Backfill des histogrammes de présence...',flush=True)
+	try:
+		rows=await adb.sessions.aggregate_list([
+			{'$match':{'ts':{'$lt':cutoff}}},
+			{'$group':{'_id':{'p':'$player','d':'$day','h':'$hour'},'n':{'$sum':1},'hs':{'$sum':{'$add':['$hour',{'$divide':[{'$ifNull':['$minute',0]},60]}]}}}},
+		],allowDiskUse=True)
+		per={}
+		for r in rows:
+			k=r['_id'];inc=per.setdefault(k['p'],{})
+			inc[f"hm.{k['d']}.{k['h']}"]=r['n'];inc[f"hs.{k['d']}"]=inc.get(f"hs.{k['d']}",0)+r['hs']
+		ops=[UpdateOne({'player':p,'hm_v':{'$exists':False}},{'$inc':inc,'$set':{'hm_v':1}})for p,inc in per.items()]
+		for i in range(0,len(ops),500):await adb.presence.bulk_write(ops[i:i+500],ordered=False)
+		# joueurs sans ping avant la coupure : histogramme déjà complet
+		await adb.presence.update_many({'hm_v':{'$exists':False}},{'$set':{'hm_v':1}})
+		await cfg_set('hm_backfill_done',True)
+		print(f"✅ Histogrammes : {len(per)} joueurs",flush=True)
+	except Exception as e:print(f"❌ Backfill histogrammes: {e}",flush=True)
+async def cfg_set(key,val):
 	if not mongo_ok:return
-	try:config_col.update_one({'key':key},{'$set':{'value':val}},upsert=True)
+	try:await adb.config.update_one({'key':key},{'$set':{'value':val}},upsert=True)
 	except:pass
-def cfg_get(key):
+async def cfg_get(key):
 	if not mongo_ok:return None
-	try:doc=config_col.find_one({'key':key});return doc['value']if doc else None
+	try:doc=await adb.config.find_one({'key':key});return doc['value']if doc else None
 	except:return None
+
 async def _load_wl(global_name,prefix,channel_id):
 	global WL,WL_MOCHA,wl_msg_id,wl_mocha_msg_id;ch=client.get_channel(channel_id)
 	if not ch:return
@@ -175,40 +869,44 @@ async def _load_wl(global_name,prefix,channel_id):
 			except:pass
 	await _save_wl(global_name,prefix,channel_id)
 async def _save_wl(global_name,prefix,channel_id):
-	global wl_msg_id,wl_mocha_msg_id;ch=client.get_channel(channel_id)
+	global wl_msg_id,wl_mocha_msg_id;watch_changed();await save_state(force=True);ch=client.get_channel(channel_id)
 	if not ch:return
 	players=WL if global_name=='WL'else WL_MOCHA;msg_id=wl_msg_id if global_name=='WL'else wl_mocha_msg_id;content=f"{prefix}:"+json.dumps({'players':players})
 	if msg_id:
-		try:msg=await ch.fetch_message(msg_id);await msg.edit(content=content);return
+		try:await ch.get_partial_message(msg_id).edit(content=content);return
 		except discord.NotFound:pass
 	msg=await ch.send(content)
 	if global_name=='WL':wl_msg_id=msg.id
 	else:wl_mocha_msg_id=msg.id
 async def load_cw():
-	global COUNTRY_WATCHES;v=cfg_get('country_watches')
+	global COUNTRY_WATCHES;v=await cfg_get('country_watches')
 	if v:COUNTRY_WATCHES=v
-async def save_cw():cfg_set('country_watches',COUNTRY_WATCHES)
+async def save_cw(snapshot=True):
+	if snapshot:await save_state(force=True)  # modif utilisateur : l'état local ne doit jamais être plus vieux que le stockage
+	await cfg_set('country_watches',COUNTRY_WATCHES)
 
                            
 async def load_referents():
 	global REFERENT_WATCHES
-	v=cfg_get('referent_watches')
+	v=await cfg_get('referent_watches')
 	if v:REFERENT_WATCHES=v;print(f"✅ Référents chargés: {len(REFERENT_WATCHES)}",flush=True)
-async def save_referents():cfg_set('referent_watches',REFERENT_WATCHES)
+async def save_referents():await save_state(force=True);await cfg_set('referent_watches',REFERENT_WATCHES)
 
 async def load_swords():
 	global SWORDS
 	if not mongo_ok:return
-	SWORDS=list(db['swords'].find({},{'_id':0}))
+	SWORDS=await adb.swords.find_list({},{'_id':0});watch_changed()
 	print(f"⚔️  Swords chargés: {len(SWORDS)}",flush=True)
 
 async def save_sword(sword):
+	watch_changed();await save_state(force=True)
 	if not mongo_ok:return
-	db['swords'].update_one({'name':sword['name']},{'$set':sword},upsert=True)
+	await adb.swords.update_one({'name':sword['name']},{'$set':sword},upsert=True)
 
 async def delete_sword(name):
+	watch_changed();await save_state(force=True)
 	if not mongo_ok:return
-	db['swords'].delete_one({'name':name})
+	await adb.swords.delete_one({'name':name})
 
 async def set_sword_out(name,is_out):
 	global SWORDS,_sword_action_alerted
@@ -220,61 +918,270 @@ async def set_sword_out(name,is_out):
 	if not is_out:_sword_action_alerted=False
 _sword_notif_sent={}  # dédup notifs CO {(name,server): timestamp}
 
-async def load_watchlist():await _load_wl('WL','WATCHLIST',CH_STORAGE)
+async def load_watchlist():await _load_wl('WL','WATCHLIST',CH_STORAGE);watch_changed()
 async def save_watchlist():await _save_wl('WL','WATCHLIST',CH_STORAGE)
-async def load_watchlist_mocha():await _load_wl('MOCHA','WATCHLIST_MOCHA',CH_M_RAPPORT)
+async def load_watchlist_mocha():await _load_wl('MOCHA','WATCHLIST_MOCHA',CH_M_RAPPORT);watch_changed()
 async def save_watchlist_mocha():await _save_wl('MOCHA','WATCHLIST_MOCHA',CH_M_RAPPORT)
-async def get_online(server):
+_online_http={}  # {server: {'etag','modified','hash','players'}} — état du dernier poll dynmap_world.json
+_online_stats={s:{'parsed':0,'skipped':0,'not_modified':0,'errors':0}for s in SERVERS}
+_JSON_DEC=json.JSONDecoder()
+_PLAYERS_KEY_RE=re.compile(rb'"players"\s*:\s*\[')
+_PLAYER_NAME_RE=re.compile(rb'"name"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+def _extract_player_names(body):
+	"""Décode uniquement le tableau `players` de dynmap_world.json (pas le document entier)."""
+	m=_PLAYERS_KEY_RE.search(body)
+	if not m:return[]
+	arr,_=_JSON_DEC.raw_decode(body[m.end()-1:].decode('utf-8','replace'))
+	return[p['name']for p in arr if isinstance(p,dict)and 'name'in p]
+
+def _players_hash(body):
+	"""Empreinte des seuls noms du tableau `players` : timestamp, servertime et positions changent à chaque poll.
+	   Objets joueurs plats : le tableau finit au premier `}]` (nombre de guillemets impair → coupé dans une chaîne → corps entier)."""
+	m=_PLAYERS_KEY_RE.search(body);src=body
+	if m:
+		if body[m.end():m.end()+64].lstrip().startswith(b']'):src=b''
+		else:
+			end=body.find(b'}]',m.end());seg=body[m.end():end]
+			if end>=0 and not(seg.count(b'"')-seg.count(b'\\"'))%2:src=b'\0'.join(_PLAYER_NAME_RE.findall(seg))
+	return hashlib.blake2b(src,digest_size=16).digest()
+
+async def _fetch_online(server):
+	"""Poll conditionnel : If-None-Match/If-Modified-Since + hash des noms en ligne. Retourne None si erreur."""
+	st=_online_http.get(server);stats=_online_stats.setdefault(server,{'parsed':0,'skipped':0,'not_modified':0,'errors':0})
+	headers={}
+	if st:
+		if st['etag']:headers['If-None-Match']=st['etag']
+		if st['modified']:headers['If-Modified-Since']=st['modified']
 	try:
-		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))as s:
-			async with s.get(SERVERS[server]['url'])as r:
-				if r.status==200:return[p['name']for p in(await r.json()).get('players',[])]
-	except:pass
-	return[]
-async def get_all_online():results=await asyncio.gather(*[get_online(s)for s in SERVERS],return_exceptions=True);return{s:r if isinstance(r,list)else[]for(s,r)in zip(SERVERS,results)}
+		async with http_get(SERVERS[server]['url'],'dynmap',headers=headers)as r:
+			if r.status==304 and st:stats['not_modified']+=1;return st['players']
+			if r.status!=200:stats['errors']+=1;return None
+			body=await r.read()
+			h=_players_hash(body)
+			if st and st['hash']==h:
+				stats['skipped']+=1;players=st['players']
+			else:
+				players=_extract_player_names(body);stats['parsed']+=1
+			_online_http[server]={'etag':r.headers.get('ETag'),'modified':r.headers.get('Last-Modified'),'hash':h,'players':players}
+			return players
+	except:stats['errors']+=1
+	return None
 
-NG_PLAYERCOUNT_URL='https://publicapi.nationsglory.fr/playercount'
+# ════════════════════════════════════════════════════════
+# 📸 SNAPSHOT DES JOUEURS EN LIGNE (publié par le scanner)
+# ════════════════════════════════════════════════════════
+ONLINE_MAX_AGE=float(os.getenv('ONLINE_MAX_AGE','45'))  # au-delà, un lecteur repolle lui-même le serveur concerné
+ONLINE_RETRY=10  # pas de repoll lecteur d'un serveur en erreur plus d'une fois par ONLINE_RETRY s
+
+class OnlineSnapshot:
+	"""Vue figée des joueurs en ligne : jamais modifiée, remplacée à chaque publication.
+	   version ne change que si une liste change ; fetched donne l'âge de chaque serveur."""
+	__slots__=('version','players','sets','where','fetched')
+	def __init__(self,version,players,sets,where,fetched):
+		self.version,self.players,self.sets,self.where,self.fetched=version,players,sets,where,fetched
+	def age(self,server):return time.time()-self.fetched.get(server,0)
+	def online(self,server):return list(self.players.get(server,()))
+	def all(self):return{s:list(self.players.get(s,()))for s in SERVERS}
+	def servers_of(self,player):return self.where.get(player,())
+	def locate(self,names):
+		"""{serveur: [noms en ligne]} dans l'ordre de names."""
+		found={}
+		for n in names:
+			for s in self.where.get(n,()):found.setdefault(s,[]).append(n)
+		return found
+
+_online_snap=OnlineSnapshot(0,{},{},{},{})
+_online_fail={}
+_snap_stats={'publishes':0,'changes':0,'live_refreshes':0}
+
+def publish_online(server,players):
+	"""Publie la liste d'un serveur ; l'index joueur→serveurs est mis à jour par différence."""
+	global _online_snap
+	old=_online_snap;new_set=frozenset(players);old_set=old.sets.get(server)
+	fetched={**old.fetched,server:time.time()};_snap_stats['publishes']+=1;_online_fail.pop(server,None)
+	if old_set==new_set:_online_snap=OnlineSnapshot(old.version,old.players,old.sets,old.where,fetched);return _online_snap
+	old_set=old_set or frozenset();where=dict(old.where)
+	for p in old_set-new_set:
+		rest=tuple(x for x in where.get(p,())if x!=server)
+		if rest:where[p]=rest
+		else:where.pop(p,None)
+	for p in new_set-old_set:where[p]=where.get(p,())+(server,)
+	_snap_stats['changes']+=1
+	_online_snap=OnlineSnapshot(old.version+1,{**old.players,server:tuple(players)},{**old.sets,server:new_set},where,fetched)
+	return _online_snap
+
+async def _refresh_online(server):
+	players=await _fetch_online(server)
+	if players is None:_online_fail[server]=time.time()
+	else:publish_online(server,players)
+
+async def online_snapshot(max_age=ONLINE_MAX_AGE,servers=None):
+	"""Snapshot courant. Les serveurs plus vieux que max_age (scanner pas encore passé, en backoff...)
+	   sont repollés avant de répondre, une seule requête par serveur quel que soit le nombre de lecteurs."""
+	snap=_online_snap;now=time.time()
+	stale=[s for s in(servers or SERVERS)if snap.age(s)>max_age and now-_online_fail.get(s,0)>=ONLINE_RETRY]
+	if stale:
+		_snap_stats['live_refreshes']+=len(stale)
+		await asyncio.gather(*[single_flight(('online',s),lambda s=s:_refresh_online(s))for s in stale],return_exceptions=True)
+		snap=_online_snap
+	return snap
+
+def snapshot_stats():
+	snap=_online_snap
+	return{**_snap_stats,'version':snap.version,'players':len(snap.where),'age':{s:round(snap.age(s),1)for s in snap.fetched}}
+
+def _req_max_age(r):
+	try:return max(0.0,float(r.rel_url.query.get('max_age',ONLINE_MAX_AGE)))
+	except ValueError:return ONLINE_MAX_AGE
+
+async def get_online(server,max_age=ONLINE_MAX_AGE):return(await online_snapshot(max_age,[server])).online(server)
+
+NG_PLAYERCOUNT_URL=f"{NG_API_URL}/playercount"
 NG_PLAYERCOUNT_TOKEN='Bearer NGAPI_q05@rd^9Gg!@A9(4YYQEHVj9)6fNTGF2c02f64647e5f99a75001c7cb30c1e8e5'
 async def get_playercount():
 	try:
-		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))as s:
-			async with s.get(NG_PLAYERCOUNT_URL,headers={'Authorization':NG_PLAYERCOUNT_TOKEN,'accept':'application/json'})as r:
-				if r.status==200:
-					data=await r.json()
-					return{k:{'players':v.get('players',0),'online':v.get('online',True)}for k,v in data.items()if isinstance(v,dict)and 'players'in v}
+		async with http_get(NG_PLAYERCOUNT_URL,'publicapi',headers={'Authorization':NG_PLAYERCOUNT_TOKEN,'accept':'application/json'})as r:
+			if r.status==200:
+				data=await r.json()
+				return{k:{'players':v.get('players',0),'online':v.get('online',True)}for k,v in data.items()if isinstance(v,dict)and 'players'in v}
 	except:pass
 	return{}
 
 async def api_playercount(r):return cors(await get_playercount())
 
 ACTIVITY_INTERVAL=60  # toutes les 1 minute
+# Agrégats min/max/somme par serveur, mis à jour à chaque point : (collection, taille du seau en s, rétention TTL en s)
+ACTIVITY_ROLLUPS=(('activity_5m',300,30*86400),('activity_1h',3600,400*86400),('activity_1d',86400,None))
+ACTIVITY_RAW_RETENTION=int(os.getenv('ACTIVITY_RAW_RETENTION_DAYS','3'))*86400  # points bruts (1/min)
+ACTIVITY_MAX_HOURS=24*400
+_EPOCH=datetime(1970,1,1)
+_activity_last={'ts':None,'at':0.0,'v':0}  # dernier point enregistré en direct ; v : version des réponses /api/activity
+
+def _activity_touch(ts=None):
+	"""Invalide les réponses /api/activity mémorisées (point en direct, rejeu du journal, backfill des agrégats).
+	   ts : point enregistré en direct, recale aussi le max-age sur le prochain point attendu."""
+	_activity_last['v']+=1
+	if ts is not None:_activity_last.update(ts=ts,at=time.time())
+
+def _bucket(ts,sec):return _EPOCH+timedelta(seconds=int((ts-_EPOCH).total_seconds())//sec*sec)
+
+def _rollup_update(data):
+	return {'$min':{f'min.{s}':v for s,v in data.items()},'$max':{f'max.{s}':v for s,v in data.items()},
+		'$inc':{**{f'sum.{s}':v for s,v in data.items()},**{f'n.{s}':1 for s in data}}}
+
+async def apply_activity_rollups(doc,guard=False):
+	"""guard (rejeu) : chaque seau garde l'_id des derniers points appliqués ; un point déjà compté est ignoré
+	   (le filtre ne correspond plus, l'upsert bute sur l'index unique ts)."""
+	if not doc.get('data'):return
+	upd=_rollup_update(doc['data'])
+	if guard:upd['$push']={'_jr':{'$each':[doc['_id']],'$slice':-JOURNAL_APPLIED_KEEP}}
+	for col,sec,_ in ACTIVITY_ROLLUPS:
+		q={'ts':_bucket(doc['ts'],sec)}
+		if guard:q['_jr']={'$ne':doc['_id']}
+		try:await getattr(adb,col).update_one(q,upd,upsert=True)
+		except DuplicateKeyError:
+			if not guard:raise
+
+async def record_activity(doc):
+	"""Point brut + agrégats ; journal disque si MongoDB est indisponible (agrégats appliqués au rejeu)."""
+	doc.setdefault('_id',ObjectId())
+	if mongo_ok:
+		try:await adb.activity.insert_one(doc)
+		except Exception as e:print(f"❌ activity: {e}, bascule journal",flush=True)
+		else:
+			try:await apply_activity_rollups(doc)
+			except Exception as e:print(f"❌ activity rollups: {e}",flush=True)
+			_activity_touch(doc['ts'])
+			return
+	journal_append('activity',doc)
+
+async def ensure_activity_ttl():
+	"""Rétention des points bruts par index TTL (remplace le delete_many à chaque minute)."""
+	try:
+		idx=await adb.activity.index_information()
+		cur=idx.get('ts_1',{})
+		if cur.get('expireAfterSeconds')==ACTIVITY_RAW_RETENTION:return
+		if cur:await adb.activity.drop_index('ts_1')
+		await adb.activity.create_index('ts',expireAfterSeconds=ACTIVITY_RAW_RETENTION)
+	except Exception as e:print(f"❌ TTL activity: {e}",flush=True)
+
+async def backfill_activity_rollups():
+	"""Construit une fois les agrégats depuis les points bruts antérieurs au démarrage, puis active le TTL.
+	   Le TTL n'est posé qu'après, pour ne pas purger des points pas encore agrégés."""
+	if not await wait_mongo():return
+	if not await cfg_get('activity_rollups_done'):
+		await journal_drained()
+		cutoff=await cfg_get('activity_rollups_cutoff')
+		if not cutoff:cutoff=_BOOT_TS;await cfg_set('activity_rollups_cutoff',cutoff)
+		print('📊 Backfill des agrégats d\'activité...',flush=True)
+		try:
+			for col,sec,_ in ACTIVITY_ROLLUPS:
+				rows=await adb.activity.aggregate_list([
+					{'$match':{'ts':{'$lt':cutoff}}},
+					{'$project':{'b':{'$subtract':['$ts',{'$mod':[{'$toLong':'$ts'},sec*1000]}]},'kv':{'$objectToArray':'$data'}}},
+					{'$unwind':'$kv'},
+					{'$group':{'_id':{'b':'$b','s':'$kv.k'},'min':{'$min':'$kv.v'},'max':{'$max':'$kv.v'},'sum':{'$sum':'$kv.v'},'n':{'$sum':1}}},
+				],allowDiskUse=True)
+				per={}
+				for r in rows:
+					u=per.setdefault(r['_id']['b'],{'$min':{},'$max':{},'$inc':{}});s=r['_id']['s']
+					u['$min'][f'min.{s}']=r['min'];u['$max'][f'max.{s}']=r['max'];u['$inc'][f'sum.{s}']=r['sum'];u['$inc'][f'n.{s}']=r['n']
+				ops=[UpdateOne({'ts':b},u,upsert=True)for b,u in per.items()]
+				for i in range(0,len(ops),500):await getattr(adb,col).bulk_write(ops[i:i+500],ordered=False)
+				print(f"✅ {col} : {len(ops)} seaux",flush=True)
+			await cfg_set('activity_rollups_done',True);_activity_touch()
+		except Exception as e:print(f"❌ Backfill agrégats: {e}",flush=True);return
+	await ensure_activity_ttl()
+
 async def activity_recorder_loop():
 	await asyncio.sleep(15)
 	while True:
 		try:
-			if mongo_ok:
+			if MONGO_URL:
 				pc=await get_playercount()
 				if pc:
 					now=datetime.utcnow()+timedelta(hours=1)
-					doc={'ts':now,'data':{s:pc[s]['players']for s in SERVERS if s in pc}}
-					db['activity'].insert_one(doc)
-					# Nettoyage automatique : garder seulement 30 jours
-					cutoff=now-timedelta(days=30)
-					db['activity'].delete_many({'ts':{'$lt':cutoff}})
+					await record_activity({'ts':now,'data':{s:pc[s]['players']for s in SERVERS if s in pc}})
 		except Exception as e:print(f'❌ activity_recorder: {e}',flush=True)
 		await asyncio.sleep(ACTIVITY_INTERVAL)
 
+def _activity_source(hours):
+	"""Résolution choisie selon la fenêtre : ~100 à ~900 points quel que soit le zoom."""
+	if hours<=6:return 'activity',None,'1m'
+	if hours<=72:return 'activity_5m',300,'5m'
+	if hours<=24*31:return 'activity_1h',3600,'1h'
+	return 'activity_1d',86400,'1d'
+
 async def api_activity(r):
 	if not mongo_ok:return cors({'error':'MongoDB non connecté'},503)
 	try:
-		hours=int(r.rel_url.query.get('hours',24))
-		now=datetime.utcnow()+timedelta(hours=1)
-		since=now-timedelta(hours=hours)
-		docs=list(db['activity'].find({'ts':{'$gte':since}},{'_id':0}).sort('ts',1))
-		for d in docs:
-			d['ts']=d['ts'].strftime('%Y-%m-%dT%H:%M:%S')
-		return cors({'points':docs,'hours':hours,'servers':list(SERVERS.keys())})
+		hours=max(1,min(int(r.rel_url.query.get('hours',24)),ACTIVITY_MAX_HOURS))
+		col_fmt=want_columns(r)
+		# la réponse change à l'enregistrement d'un point, et au glissement de la fenêtre (since=now-hours) même sans nouveau point
+		return await cached_json(r,('activity',hours,col_fmt),(_activity_last['v'],int(time.time()//ACTIVITY_INTERVAL)),lambda:_activity_payload(hours,col_fmt),
+			ACTIVITY_INTERVAL-(time.time()-_activity_last['at']),private=False)
 	except Exception as e:return cors({'error':str(e)},500)
+
+async def _activity_payload(hours,col_fmt):
+	now=datetime.utcnow()+timedelta(hours=1)
+	col,sec,res=_activity_source(hours)
+	since=now-timedelta(hours=hours)
+	if sec:since=_bucket(since,sec)
+	docs=await getattr(adb,col).find_list({'ts':{'$gte':since}},{'_id':0},sort=[('ts',1)])
+	servers=list(SERVERS.keys())
+	points=[]
+	for d in docs:
+		if sec:n=d.get('n',{});data={s:round(d['sum'][s]/n[s],1)for s in n if n[s]}
+		else:data=d.get('data',{})
+		points.append({'ts':d['ts'].strftime('%Y-%m-%dT%H:%M:%S'),'data':data})
+	# colonnes : une liste par série, min/max par seau pour les résolutions agrégées
+	cols={'ts':[p['ts']for p in points],'avg':{s:[p['data'].get(s)for p in points]for s in servers}}
+	if sec:
+		for k in('min','max'):cols[k]={s:[d.get(k,{}).get(s)for d in docs]for s in servers}
+	out={'columns':cols,'resolution':res,'hours':hours,'servers':servers}
+	if not col_fmt:out['points']=points
+	return out
                                                                                 
 _STATIC_COUNTRIES_FALLBACK=sorted(["ArchipelCrozet","Algerie","Angola","IlesAndaman","Autriche","Azerbaidjan","Bahrein","Bangladesh","Belgique","Benin","Bielorussie","Bolivie","Bosnie","BurkinaFaso","Cambodge","CentreAfrique","Chili","Colombie","Congo","RDCongo","CoreeDuSud","CoteDivoire","Egypte","EmiratsArabesUnis","Equateur","Erythree","Ethiopie","Iakoutie","Iamalie","IleBolchevique","IlesBaleares","IleCoats","IleDeLaReunion","IlesFeroe","IlesFidji","IlesGalapagos","IleMaurice","IleVictoria","Gabon","Georgie","Ghana","Groenland","Guatemala","Guyane","Guyana","Hainan","Inde","Indonesie","Irak","Iran","Italie","IlesVancouver","Japon","Java","Kazakhstan","Khabarovsk","Kenya","Kosovo","Krasnoy","Laos","Lettonie","Libye","Lituanie","Macedoine","Malaisie","Malte","Kamtchatka","Mali","Maroc","Mauritanie","Magadan","Mozambique","Namibie","Niger","Nigeria","Norvege","NouvelleGuinee","NouvelleZemble","Ouganda","Ouzbekistan","Palaos","Pakistan","Portugal","Qatar","SaharaOccidental","Serbie","Somalie","Srilanka","StHelena","IlesSandwich","IleBouvet","Suriname","Svalbard","Swaziland","Syrie","Tadjikistan","Tanzanie","Tchoukota","TerreSiple","TerreSpaatz","TerreMill","TerreGrant","TerreVega","TerreThor","TerreLow","TerrePowell","TerreBurke","TerreSigny","TerreBooth","TerreSmith","TerreRoss","TerreLiard","TerreMasson","Thailande","Tibet","Timor","Touva","Tunisie","Turkmenistan","Turquie","TriniteEtTobago","Uruguay","WallisEtFutuna","Yemen","Zambie","Zimbabwe","Montana","Michigan","Nunavut","Sonora","Queensland","Minnesota","Washington","Oregon","Idaho","Utah","NouveauMexique","Colorado","Wyoming","Quinghai","Xinjiang","Yunnam","Sichuan","Guizhou","Guangxi","Guangdong","Chypre","Roumanie","EmpireJordanien","Madagan","Tasmanie","EmpireBissaoguineen","Liberia","EmpireIrkoutsk","IleWrangel","Canada","TerreAdelie","Suede","Djibouti","Paraguay","Nepal","Bhoutan","Sakhaline","RoyaumeUni","IlesSalomon","EtatsUnis","Liban","Bahamas","EmpireOmanais","RepubliqueTcheque","Espagne","Danemark","Jamaique","NouvelleZelande","Bouriatie","Taiwan","Tomsk","Cameroun","Amour","Kirghizistan","Venezuela","IlesKerguelen","Soudan","Sardaigne","Luxembourg","Bresil","Nevada","Moldavie","Malawi","NouvelleCaledonie","AfriqueDuSud","CoreeDuNord","Estonie","Wisconsin","Birmanie","TerreDeFeu","Salvador","Koweit","Baja","Socotra","Botswana","TerreSnow","Allemagne","Pologne","Slovenie","PaysBas","Philippines","Texas","Suisse","Altai","Floride","Quebec","Slovaquie","Madagascar","Montenegro","Mongolie","Nicaragua","Sumatra","France","Bulgarie","Alaska","Argentine","Grece","Australie","Belize","Armenie","Afghanistan","Californie","Russie","Islande","Perou","Arizona","Tchad","Albanie","IlesCanaries","Togo","Chine","Mexique","Ontario","IleGraham","Dakota","Vietnam","Papouasie","Croatie"])
 
@@ -283,10 +1190,15 @@ _ctry_last_fetch={}
 CTRY_FETCH_COOLDOWN=21600                                                                      
 
 async def get_country_list(server):
+	now=time.time();ent=ctry_cache.get(server)
+	if ent and now-ent[1]<CTRY_FETCH_COOLDOWN:M_CACHE.inc('countries','hit');return ent[0]
+	if ent and now-ent[1]<CTRY_FETCH_COOLDOWN+SWR_GRACE:
+		M_CACHE.inc('countries','stale');_flight(('countries',server),lambda:_fetch_country_list(server));return ent[0]
+	M_CACHE.inc('countries','miss')
+	return await single_flight(('countries',server),lambda:_fetch_country_list(server))
+
+async def _fetch_country_list(server):
 	now=time.time()
-                                                   
-	if server in ctry_cache and now-ctry_cache[server][1]<CTRY_FETCH_COOLDOWN:
-		return ctry_cache[server][0]
                                                                                                                      
 	last_fetch=_ctry_last_fetch.get(server,0)
 	if now-last_fetch<CTRY_FETCH_COOLDOWN:
@@ -301,25 +1213,24 @@ async def get_country_list(server):
 	delay=30
 	for attempt in range(4):
 		try:
-			async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))as s:
-				async with s.get(f"https://publicapi.nationsglory.fr/country/list/{server}",headers=headers)as r:
-					if r.status==429:
-						retry_after=int(r.headers.get('Retry-After',delay))
-						print(f"[countries] {server} 429 rate-limit, attente {retry_after}s (tentative {attempt+1}/4)",flush=True)
-						await asyncio.sleep(retry_after)
-						delay=min(delay*2,300)
-						continue
-					if r.status in(200,500):
-						data=await r.json()
-						raw=data.get('claimed',[])+data.get('availables',[])if isinstance(data,dict)else data
-						claimed=sorted([c['name']for c in raw if isinstance(c,dict)and c.get('name','').strip()])
-						if claimed:
-							print(f"[countries] {server} OK => {len(claimed)} pays",flush=True)
-							ctry_cache[server]=claimed,now
-							return claimed
-					else:
-						print(f"[countries] {server} HTTP {r.status}",flush=True)
-						break
+			async with http_get(f"{NG_API_URL}/country/list/{server}",'publicapi',headers=headers)as r:
+				if r.status==429:
+					retry_after=int(r.headers.get('Retry-After',delay))
+					print(f"[countries] {server} 429 rate-limit, attente {retry_after}s (tentative {attempt+1}/4)",flush=True)
+					await asyncio.sleep(retry_after)
+					delay=min(delay*2,300)
+					continue
+				if r.status in(200,500):
+					data=await r.json()
+					raw=data.get('claimed',[])+data.get('availables',[])if isinstance(data,dict)else data
+					claimed=sorted([c['name']for c in raw if isinstance(c,dict)and c.get('name','').strip()])
+					if claimed:
+						print(f"[countries] {server} OK => {len(claimed)} pays",flush=True)
+						ctry_cache[server]=claimed,now
+						return claimed
+				else:
+					print(f"[countries] {server} HTTP {r.status}",flush=True)
+					break
 		except Exception as e:
 			print(f"[countries] {server} erreur tentative {attempt+1}: {e}",flush=True)
 			await asyncio.sleep(delay)
@@ -331,34 +1242,35 @@ async def get_country_list(server):
 	print(f"[countries] {server} fallback statique ({len(_STATIC_COUNTRIES_FALLBACK)} pays)",flush=True)
 	return _STATIC_COUNTRIES_FALLBACK
 async def _fetch_dynmap_markers(server):
-	now=time.time()
-	if server in _dynmap_markers_cache and now-_dynmap_markers_cache[server][1]<DYNMAP_MARKERS_TTL:
-		return _dynmap_markers_cache[server][0]
+	"""Téléchargement brut de marker_world.json (non caché, voir dynmap_index)."""
 	try:
-		url=f"https://{server}.nationsglory.fr/tiles/_markers_/marker_world.json"
-		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))as s:
-			async with s.get(url)as r:
-				if r.status==200:
-					data=await r.json(content_type=None)
-					markers=data.get('sets',{}).get('factions.markerset',{}).get('markers',{})
-					_dynmap_markers_cache[server]=(markers,now)
-					print(f"[dynmap] {server} markers OK ({len(markers)} pays)",flush=True)
-					return markers
+		url=dynmap_url(server,'tiles/_markers_/marker_world.json')
+		async with http_get(url,'dynmap_markers')as r:
+			if r.status==200:
+				data=await r.json(content_type=None)
+				return data.get('sets',{}).get('factions.markerset',{}).get('markers',{})
 	except Exception as e:
 		print(f"[dynmap] {server} erreur: {e}",flush=True)
-	return{}
+	return None
 
-def _parse_marker_desc(desc):
-	import html as _html,re as _re
-	desc=_html.unescape(desc)
-	m=_re.search(r'Membres<\/span><br\/>\s*(.*?)<br',desc,_re.S)
-	members=[x.strip()for x in m.group(1).split(',')if x.strip()]if m else[]
-	c=_re.search(r'Claims<\/b>\s*(\d+)',desc)
-	p=_re.search(r'Power<\/b>\s*(\d+)\s*\/\s*(\d+)',desc)
-	mmr=_re.search(r'MMR<\/b>\s*(\d+)',desc)
-	l=_re.search(r"src='https:\/\/skins\.nationsglory\.fr\/face\/([^/]+)\/",desc)
+# ════════════════════════════════════════════════════════
+# 🧩 PARSING DES MARKERS DYNMAP (regex précompilées + memo par hash de desc)
+# ════════════════════════════════════════════════════════
+MARKER_MEMO_MAX=16384  # ~ tous les pays de tous les serveurs
+_RE_CLAIMS=re.compile(r'Claims<\/b>\s*(\d+)')
+_RE_POWER=re.compile(r'Power<\/b>\s*(\d+)\s*\/\s*(\d+)')
+_RE_MMR=re.compile(r'MMR<\/b>\s*(\d+)')
+_RE_LEADER=re.compile(r"src='https:\/\/skins\.nationsglory\.fr\/face\/([^/]+)\/")
+_EMPTY_MARKER={'members':(),'claims':0,'power':0,'maxpower':0,'mmr':0,'leader':''}
+_marker_memo=OrderedDict()  # blake2b(desc) → champs parsés (members en tuple, partagé)
+_marker_stats={'parsed':0,'hits':0,'batches':0,'last_batch_ms':0.0}
+
+def _parse_marker_desc_raw(desc):
+	if '&'in desc:desc=html.unescape(desc)  # la plupart des desc n'ont aucune entité
+	i=desc.find('Membres</span><br/>');j=desc.find('<br',i+19)if i>=0 else-1  # équivaut à Membres</span><br/>\s*(.*?)<br, sans regex
+	c=_RE_CLAIMS.search(desc);p=_RE_POWER.search(desc);mmr=_RE_MMR.search(desc);l=_RE_LEADER.search(desc)
 	return{
-		'members':members,
+		'members':tuple(filter(None,map(str.strip,desc[i+19:j].split(','))))if j>=0 else(),
 		'claims':int(c.group(1))if c else 0,
 		'power':int(p.group(1))if p else 0,
 		'maxpower':int(p.group(2))if p else 0,
@@ -366,22 +1278,91 @@ def _parse_marker_desc(desc):
 		'leader':l.group(1)if l else '',
 	}
 
-async def get_country_from_dynmap(server,country):
-	markers=await _fetch_dynmap_markers(server)
+def _parse_marker_cached(desc):
+	"""Résultat partagé (ne pas muter) ; une desc déjà vue n'est jamais re-parsée."""
+	if not desc:return _EMPTY_MARKER
+	h=hashlib.blake2b(desc.encode(),digest_size=16).digest()
+	parsed=_marker_memo.get(h)
+	if parsed is not None:_marker_memo.move_to_end(h);_marker_stats['hits']+=1;return parsed
+	parsed=_marker_memo[h]=_parse_marker_desc_raw(desc);_marker_stats['parsed']+=1
+	if len(_marker_memo)>MARKER_MEMO_MAX:_marker_memo.popitem(last=False)
+	return parsed
+
+def _parse_markerset(markers):
+	"""Parse tout un factions.markerset en une passe → {clé: fiche pays}. Les desc inchangées depuis le fetch précédent sortent du memo."""
+	t0=time.perf_counter();out={}
+	for k,v in markers.items():
+		desc=v.get('desc','');parsed=_parse_marker_cached(desc)
+		out[k]={'key':k,'name':v.get('label',k).replace(' [home]','').strip(),'home':k.startswith('default_')and k.endswith('__home'),
+			'has_desc':bool(desc),'x':v.get('x',0),'z':v.get('z',0),**parsed,'members':list(parsed['members'])}
+	_marker_stats['batches']+=1;_marker_stats['last_batch_ms']=round((time.perf_counter()-t0)*1000,2)
+	return out
+
+def marker_stats():return{**_marker_stats,'memo':len(_marker_memo)}
+
+# ════════════════════════════════════════════════════════
+# 🗺️ CACHE DYNMAP INDEXÉ (pays parsés + index joueur/label)
+# ════════════════════════════════════════════════════════
+DYNMAP_IDLE_EVICT=1800  # index non consulté depuis 30 min → libéré
+DYNMAP_REFRESH_EVERY=15
+
+def _build_dynmap_index(markers,now):
+	"""Parse tous les markers une seule fois. Seul le résultat parsé est gardé (pas les desc HTML)."""
+	countries=_parse_markerset(markers);by_player={};by_label={}
+	for k,c in countries.items():
+		by_label.setdefault(c['name'].lower(),k)
+		if c['home']and c['has_desc']:
+			for m in c['members']:by_player.setdefault(m.lower(),k)
+	return{'ts':now,'used':now,'countries':countries,'by_player':by_player,'by_label':by_label}
+
+_EMPTY_DYNMAP_INDEX=_build_dynmap_index({},0)
+
+async def _refresh_dynmap(server):
+	markers=await _fetch_dynmap_markers(server);now=time.time()
+	old=_dynmap_markers_cache.get(server)
+	if markers is None:
+		if old:old['ts']=now-DYNMAP_MARKERS_TTL+DYNMAP_REFRESH_EVERY  # nouvel essai au prochain passage
+		return old
+	idx=_build_dynmap_index(markers,now)
+	if old:idx['used']=old['used']
+	_dynmap_markers_cache[server]=idx
+	print(f"[dynmap] {server} markers OK ({len(markers)} pays)",flush=True)
+	return idx
+
+def _dynmap_refresh_bg(server):return _flight(('dynmap',server),lambda:_refresh_dynmap(server))
+
+async def dynmap_index(server):
+	"""Index parsé des pays d'un serveur. Périmé (dans la grâce SWR) → servi tel quel et rafraîchi en tâche de fond."""
+	now=time.time();idx=_dynmap_markers_cache.get(server)
+	if idx:
+		idx['used']=now;age=now-idx['ts']
+		if age<DYNMAP_MARKERS_TTL:M_CACHE.inc('dynmap_markers','hit');return idx
+		if age<DYNMAP_MARKERS_TTL+SWR_GRACE:M_CACHE.inc('dynmap_markers','stale');_dynmap_refresh_bg(server);return idx
+	M_CACHE.inc('dynmap_markers','miss')
+	return await single_flight(('dynmap',server),lambda:_refresh_dynmap(server))or idx or _EMPTY_DYNMAP_INDEX
+
+async def dynmap_cache_loop():
+	"""Rafraîchit les index consultés avant expiration et libère ceux qui ne servent plus."""
+	while True:
+		await asyncio.sleep(DYNMAP_REFRESH_EVERY)
+		now=time.time()
+		for server,idx in list(_dynmap_markers_cache.items()):
+			if now-idx['used']>DYNMAP_IDLE_EVICT:del _dynmap_markers_cache[server];continue
+			if now-idx['ts']>=DYNMAP_MARKERS_TTL-DYNMAP_REFRESH_EVERY:_dynmap_refresh_bg(server)
+
+def _find_country(idx,country):
+	countries=idx['countries']
 	key=f"default_{country}__home"
-	if key in markers:
-		desc=markers[key].get('desc','')
-		parsed=_parse_marker_desc(desc)
-		name=markers[key].get('label',country).replace(' [home]','').strip()
-		return parsed['members'],name,parsed
+	if key in countries:return countries[key]
 	cl=country.lower()
-	for k,v in markers.items():
-		if cl in k.lower():
-			desc=v.get('desc','')
-			parsed=_parse_marker_desc(desc)
-			name=v.get('label',country).replace(' [home]','').strip()
-			return parsed['members'],name,parsed
-	return None,None,{}
+	key=idx['by_label'].get(cl)
+	if key:return countries[key]
+	return next((v for k,v in countries.items()if cl in k.lower()),None)
+
+async def get_country_from_dynmap(server,country):
+	rec=_find_country(await dynmap_index(server),country)
+	if not rec:return None,None,{}
+	return rec['members'],rec['name'],rec
 
 async def get_country_members(server,country):
 	members,name,_=await get_country_from_dynmap(server,country)
@@ -391,12 +1372,12 @@ async def get_country_members(server,country):
                                       
                                                 
 
-def record_recruitment(server,country,country_name,player,old_count,new_count):
+async def record_recruitment(server,country,country_name,player,old_count,new_count):
 
-	if not mongo_ok:return
+	if not MONGO_URL:return
 	try:
 		now=datetime.utcnow()+timedelta(hours=1)
-		db['recruitments'].insert_one({
+		await persist_or_journal('recruitments',{
 		 'server':server,
 		 'country':country.lower(),
 		 'country_name':country_name,
@@ -407,12 +1388,12 @@ def record_recruitment(server,country,country_name,player,old_count,new_count):
 		})
 	except Exception as e:print(f"❌ record_recruitment: {e}",flush=True)
 
-def record_departure(server,country,country_name,player,old_count,new_count):
+async def record_departure(server,country,country_name,player,old_count,new_count):
 
-	if not mongo_ok:return
+	if not MONGO_URL:return
 	try:
 		now=datetime.utcnow()+timedelta(hours=1)
-		db['recruitments'].insert_one({
+		await persist_or_journal('recruitments',{
 		 'server':server,
 		 'country':country.lower(),
 		 'country_name':country_name,
@@ -424,38 +1405,76 @@ def record_departure(server,country,country_name,player,old_count,new_count):
 		})
 	except Exception as e:print(f"❌ record_departure: {e}",flush=True)
 
+# ════════════════════════════════════════════════════════
+# 👤 CLIENT API NG /user (cache LRU+TTL, pool borné, rate limit)
+# ════════════════════════════════════════════════════════
+NG_USER_TTL=int(os.getenv('NG_USER_TTL','900'))
+NG_USER_CACHE_MAX=int(os.getenv('NG_USER_CACHE_MAX','2000'))
+NG_USER_CONCURRENCY=int(os.getenv('NG_USER_CONCURRENCY','4'))
+NG_USER_RPS=float(os.getenv('NG_USER_RPS','3'))
+NG_USER_BURST=6
+_ng_user_cache=OrderedDict()  # {pseudo en minuscules: (data|None, ts)} — ordre LRU
+_ng_user_sem=asyncio.Semaphore(NG_USER_CONCURRENCY)
+_ng_bucket={'tokens':float(NG_USER_BURST),'ts':time.monotonic(),'blocked_until':0.0}
+_ng_user_stats={'hits':0,'misses':0,'requests':0,'rate_limited':0}
+
+async def _ng_acquire():
+	"""Token bucket partagé ; bloque tout le monde jusqu'à la fin d'un Retry-After reçu."""
+	b=_ng_bucket
+	while True:
+		now=time.monotonic()
+		if now<b['blocked_until']:await asyncio.sleep(b['blocked_until']-now);continue
+		b['tokens']=min(NG_USER_BURST,b['tokens']+(now-b['ts'])*NG_USER_RPS);b['ts']=now
+		if b['tokens']>=1:b['tokens']-=1;return
+		await asyncio.sleep((1-b['tokens'])/NG_USER_RPS)
+
+async def _fetch_user(player):
+	async with _ng_user_sem:
+		for attempt in range(3):
+			await _ng_acquire();_ng_user_stats['requests']+=1
+			async with http_get(f"{NG_API_URL}/user/{player}",'publicapi',headers={'Authorization':f"Bearer {NG_KEY}",'accept':'application/json'})as resp:
+				if resp.status==429:
+					try:retry=float(resp.headers.get('Retry-After',5))
+					except ValueError:retry=5.0
+					_ng_bucket['blocked_until']=max(_ng_bucket['blocked_until'],time.monotonic()+retry);_ng_user_stats['rate_limited']+=1
+					print(f"[ng_user] 429 sur {player}, pause {retry}s (tentative {attempt+1}/3)",flush=True)
+					continue
+				if resp.status==404:return None  # joueur inconnu : réponse définitive, mise en cache
+				if resp.status!=200:raise RuntimeError(f"API NG: HTTP {resp.status}")  # 5xx passager : pas de cache (swr_get sert l'ancienne valeur s'il y en a une)
+				return await resp.json()
+	raise RuntimeError('API NG: rate limit persistant')
+
+async def ng_user(player):
+	"""Profil /user/{player} de l'API NG (None si joueur inconnu, exception sur toute autre erreur).
+	   Caché NG_USER_TTL s par pseudo sans casse, lookups concurrents fusionnés."""
+	key=player.lower();ent=_ng_user_cache.get(key)
+	if ent and time.time()-ent[1]<NG_USER_TTL:_ng_user_stats['hits']+=1
+	else:_ng_user_stats['misses']+=1
+	data=await swr_get(_ng_user_cache,key,NG_USER_TTL,lambda:_fetch_user(player),name='ng_user')
+	if key in _ng_user_cache:_ng_user_cache.move_to_end(key)
+	while len(_ng_user_cache)>NG_USER_CACHE_MAX:_ng_user_cache.popitem(last=False)
+	return data
+
 async def verify_members_by_api(server, members):
 
 	if not members:return[]
-	headers={'Authorization':f"Bearer {NG_KEY}",'accept':'application/json'}
 	verified=[]
-	async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))as s:
-		tasks=[s.get(f"https://publicapi.nationsglory.fr/user/{p}",headers=headers)for p in members]
-		for(p,task)in zip(members,tasks):
-			try:
-				async with task as resp:
-					if resp.status==200:
-						data=await resp.json();rank=data.get('servers',{}).get(server,{}).get('country_rank','')
-						if rank:verified.append(p)
-					else:verified.append(p)                                                     
-			except:verified.append(p)
+	for p,data in zip(members,await asyncio.gather(*[ng_user(p)for p in members],return_exceptions=True)):
+		if isinstance(data,dict):
+			rank=data.get('servers',{}).get(server,{}).get('country_rank','')
+			if rank:verified.append(p)
+		else:verified.append(p)                                                     
 	return verified
 
 async def verify_members_with_ranks(server, members):
 
 	if not members:return[],{}
-	headers={'Authorization':f"Bearer {NG_KEY}",'accept':'application/json'}
 	verified=[];ranks={}
-	async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))as s:
-		tasks=[s.get(f"https://publicapi.nationsglory.fr/user/{p}",headers=headers)for p in members]
-		for(p,task)in zip(members,tasks):
-			try:
-				async with task as resp:
-					if resp.status==200:
-						data=await resp.json();rank=data.get('servers',{}).get(server,{}).get('country_rank','')
-						if rank:verified.append(p);ranks[p]=rank
-					else:verified.append(p)                                          
-			except:verified.append(p)
+	for p,data in zip(members,await asyncio.gather(*[ng_user(p)for p in members],return_exceptions=True)):
+		if isinstance(data,dict):
+			rank=data.get('servers',{}).get(server,{}).get('country_rank','')
+			if rank:verified.append(p);ranks[p]=rank
+		else:verified.append(p)                                          
 	return verified,ranks
 
 async def check_referent(watch):
@@ -476,13 +1495,13 @@ async def check_referent(watch):
 		new_recruits=curr_set-prev_set
 		for p in new_recruits:
 			print(f"🆕 Recrutement détecté : {p} → {name} ({server.upper()})",flush=True)
-			record_recruitment(server,country,name,p,old_count,new_count)
+			await record_recruitment(server,country,name,p,old_count,new_count)
                      
 		departures=prev_set-curr_set
 		for p in departures:
 			if prev_set:                                       
 				print(f"🚪 Départ détecté : {p} ← {name} ({server.upper()})",flush=True)
-				record_departure(server,country,name,p,old_count,new_count)
+				await record_departure(server,country,name,p,old_count,new_count)
                         
 		watch['members_snapshot']=members
 		watch['last_check']=(datetime.utcnow()+timedelta(hours=1)).strftime('%d/%m/%Y %H:%M:%S')
@@ -585,7 +1604,7 @@ async def api_referent_stats(r):
 		 }},
 		 {'$sort':{'total':-1}}
 		]
-		docs=list(db['recruitments'].aggregate(pipeline))
+		docs=await adb.recruitments.aggregate_list(pipeline)
 		result=[]
 		for d in docs:
 			last=d['last_recruit']
@@ -615,7 +1634,7 @@ async def api_referent_history(r):
 		if not server or not country:return cors({'error':'server et country requis'},400)
 		query={'server':server.lower(),'country':country.lower()}
 		if not include_departures:query['departure']={'$exists':False}
-		docs=list(db['recruitments'].find(query,{'_id':0}).sort('ts',DESCENDING).limit(limit))
+		docs=await adb.recruitments.find_list(query,{'_id':0},sort=[('ts',DESCENDING)],limit=limit)
 		for d in docs:
 			if 'ts' in d and hasattr(d['ts'],'strftime'):
 				d['ts']=d['ts'].strftime('%d/%m/%Y %H:%M:%S')
@@ -630,9 +1649,9 @@ async def api_referent_history(r):
 		 }},
 		 {'$sort':{'_id':1}}
 		]
-		curve=list(db['recruitments'].aggregate(pipeline))
+		curve=await adb.recruitments.aggregate_list(pipeline)
 		for c in curve:c['players']=list(set(c['players']))
-		return cors({'events':docs,'curve':curve,'total':len(docs)})
+		return cors({'events':columnar(docs)if want_columns(r)else docs,'curve':curve,'total':len(docs)})
 	except Exception as e:return cors({'error':str(e)},500)
 
 
@@ -640,52 +1659,52 @@ async def api_referent_history(r):
 
 
 async def api_events(r):
-	"""SSE endpoint — pousse les events co/déco en temps réel"""
+	"""SSE endpoint — pousse les events co/déco en temps réel.
+	   Filtres optionnels : ?type=connect,disconnect&server=lime&player=X ; reprise via Last-Event-ID (ou ?last_id=)."""
 	# EventSource ne supporte pas les headers, token en query param
 	t=r.rel_url.query.get('token') or _get_token(r)
 	if not t or not _jwt_verify(t):return web.Response(status=401,headers=CORS)
-	q=asyncio.Queue()
-	_sse_clients.append(q)
+	q=r.rel_url.query
+	def _set(k):return frozenset(x for x in q[k].split(',')if x)if q.get(k)else None
+	sub=Subscriber(_set('type'),_set('server'),_set('player'))
+	bus_subscribe(sub,r.headers.get('Last-Event-ID')or q.get('last_id'))
 	resp=web.StreamResponse(headers={**CORS,'Content-Type':'text/event-stream','Cache-Control':'no-cache','X-Accel-Buffering':'no'})
-	await resp.prepare(r)
 	try:
+		await resp.prepare(r)
 		await resp.write(b'data: {"type":"ping"}\n\n')
-		while True:
-			try:
-				evt=await asyncio.wait_for(q.get(),timeout=25)
-				payload=json.dumps(evt,ensure_ascii=False)
-				await resp.write(f'data: {payload}\n\n'.encode())
-			except asyncio.TimeoutError:
-				await resp.write(b'data: {"type":"ping"}\n\n')  # keepalive
+		while not sub.closed:
+			if not sub.buf:
+				try:await asyncio.wait_for(sub.wake.wait(),timeout=SSE_KEEPALIVE)
+				except asyncio.TimeoutError:await resp.write(b'data: {"type":"ping"}\n\n');continue  # keepalive
+			sub.wake.clear()
+			if sub.closed or not sub.buf:continue
+			batch=list(sub.buf);sub.buf.clear()
+			await resp.write(b''.join(f for _,f in batch))
+			_bus_stats['delivered']+=len(batch)
 	except Exception:pass
-	finally:
-		_sse_clients.remove(q) if q in _sse_clients else None
+	finally:_bus_subs.discard(sub)
 	return resp
 
 async def api_health(r):
-    return cors({'status':'ok','mongo':mongo_ok,'ng_key_len':len(NG_KEY or ''),'ng_key_start':(NG_KEY or '')[:10]})
+    return cors({'status':'ok','mongo':mongo_ok,'ng_key_len':len(NG_KEY or ''),'ng_key_start':(NG_KEY or '')[:10],'http':http_stats(),'scanner':_online_stats,'online':snapshot_stats(),'diff':diff_stats(),'scheduler':scheduler_stats(),'ng_user':{**_ng_user_stats,'cached':len(_ng_user_cache)},'db':db_stats(),'write_behind':wb_stats(),'journal':journal_stats(),'encoding':enc_stats(),'sse':bus_stats(),'discord':dispatch_stats(),'status_msgs':pin_stats(),'state':state_stats(),'migration':_mig_stats,'markers':marker_stats(),'loop':loop_stats()})
 @require_auth
 async def api_online(r):
 	s=r.match_info['server'].lower()
 	if s not in SERVERS:return cors({'error':'Serveur invalide'},400)
-	pl=await get_online(s);return cors({'server':s,'players':pl,'count':len(pl)})
+	snap=await online_snapshot(_req_max_age(r),[s]);pl=snap.online(s)
+	return cors({'server':s,'players':pl,'count':len(pl),'version':snap.version,'age':round(snap.age(s),1)})
 @require_auth
-async def api_online_all(r):return cors(await get_all_online())
+async def api_online_all(r):
+	snap=await online_snapshot(_req_max_age(r))
+	return await cached_json(r,'online_all',snap.version,snap.all,SCAN_MIN_INTERVAL)
 @require_auth
 async def api_checkall(r):
-	p=r.match_info['player'];all_=await get_all_online()
-	found=[s for(s,pl)in all_.items()if p in pl]
-	countries_by_server={}
-	for srv in list(SERVERS.keys()):
-		markers=await _fetch_dynmap_markers(srv)
-		for k,v in markers.items():
-			if not k.startswith('default_')or not k.endswith('__home'):continue
-			desc=v.get('desc','')
-			if not desc:continue
-			parsed=_parse_marker_desc(desc)
-			if any(m.lower()==p.lower()for m in parsed['members']):
-				countries_by_server[srv]=v.get('label',k).replace(' [home]','').strip()
-				break
+	p=r.match_info['player'];snap=await online_snapshot(_req_max_age(r))
+	found=list(snap.servers_of(p))
+	countries_by_server={};pl=p.lower()
+	for srv,idx in zip(SERVERS,await asyncio.gather(*[dynmap_index(s)for s in SERVERS])):
+		key=idx['by_player'].get(pl)
+		if key:countries_by_server[srv]=idx['countries'][key]['name']
 	country_name='';country_server=''
 	if countries_by_server:
 		country_server=next(iter(countries_by_server))
@@ -696,54 +1715,61 @@ async def api_countries(r):
 	s=r.match_info['server'].lower()
 	if s not in SERVERS:return cors({'error':'Serveur invalide'},400)
 	raw=await get_country_list(s)
-                                                        
-	names=[x['name']if isinstance(x,dict)else x for x in raw if(isinstance(x,dict)and x.get('name','').strip())or(isinstance(x,str)and x.strip())]
-	return cors({'server':s,'countries':names,'claimed':names})
+	ent=ctry_cache.get(s)
+	def build():
+		names=[x['name']if isinstance(x,dict)else x for x in raw if(isinstance(x,dict)and x.get('name','').strip())or(isinstance(x,str)and x.strip())]
+		return {'server':s,'countries':names,'claimed':names}
+	# liste de secours statique : courte durée, la vraie liste peut arriver au prochain essai
+	if not ent or raw is not ent[0]:return await cached_json(r,('countries',s),None,build,60)
+	return await cached_json(r,('countries',s),ent[1],build,CTRY_FETCH_COOLDOWN-(time.time()-ent[1]))
+DIM_MARKERS_TTL=300
+async def _fetch_dim_areas(s,dim):
+	url=dynmap_url(s,f"tiles/_markers_/marker_{dim}.json")
+	async with http_get(url,'dynmap_markers')as resp:
+		if resp.status!=200:raise RuntimeError(f'HTTP {resp.status}')
+		data=await resp.json(content_type=None)
+		return data.get('sets',{}).get('factions.markerset',{}).get('areas',{})
+
 @require_auth
 async def api_dim_markers(r):
 	s=r.match_info['server'].lower()
 	dim=r.match_info['dim'].upper()
 	if s not in SERVERS:return cors({'error':'Serveur invalide'},400)
 	if dim not in ('DIM-28','DIM-29','DIM-31'):return cors({'error':'Dimension invalide'},400)
-	cache_key=f"{s}_{dim}"
-	now=time.time()
-	if cache_key in _dim_markers_cache and now-_dim_markers_cache[cache_key][1]<300:
-		return cors(_dim_markers_cache[cache_key][0])
-	try:
-		url=f"https://{s}.nationsglory.fr/tiles/_markers_/marker_{dim}.json"
-		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))as sess:
-			async with sess.get(url)as resp:
-				if resp.status==200:
-					data=await resp.json(content_type=None)
-					areas=data.get('sets',{}).get('factions.markerset',{}).get('areas',{})
-					_dim_markers_cache[cache_key]=(areas,now)
-					return cors(areas)
-				return cors({'error':f'HTTP {resp.status}'},502)
+	key=f"{s}_{dim}"
+	try:areas=await swr_get(_dim_markers_cache,key,DIM_MARKERS_TTL,lambda:_fetch_dim_areas(s,dim),name='dim_markers')
 	except Exception as e:return cors({'error':str(e)},502)
+	ts=_dim_markers_cache[key][1]if key in _dim_markers_cache else None
+	col=want_columns(r)
+	return await cached_json(r,('dim',key,col),ts,lambda:_dim_columns(areas)if col else areas,DIM_MARKERS_TTL-(time.time()-(ts or 0)))
+
+def _dim_columns(areas):
+	vals=[v for v in areas.values()if v.get('label')]
+	return {'fmt':'col','label':[v['label']for v in vals],'x':[delta_encode(v.get('x')or[])for v in vals],'z':[delta_encode(v.get('z')or[])for v in vals]}
 
 @require_auth
 
 async def api_souspower(r):
 	s=r.match_info['server'].lower()
 	if s not in SERVERS:return cors({'error':'Serveur invalide'},400)
-	markers=await _fetch_dynmap_markers(s)
-	if not markers:return cors({'error':'Dynmap inaccessible'},503)
+	idx=await dynmap_index(s)
+	if not idx['countries']:return cors({'error':'Dynmap inaccessible'},503)
+	col=want_columns(r)
+	return await cached_json(r,('souspower',s,col),idx['ts'],lambda:_souspower_payload(s,idx,col),DYNMAP_MARKERS_TTL-(time.time()-idx['ts']))
+
+def _souspower_payload(s,idx,col):
 	result=[]
-	for k,v in markers.items():
-		if not k.startswith('default_')or not k.endswith('__home'):continue
-		desc=v.get('desc','')
-		if not desc:continue
-		parsed=_parse_marker_desc(desc)
-		pow,maxpow,claims=parsed['power'],parsed['maxpower'],parsed['claims']
+	for c in idx['countries'].values():
+		if not c['home']or not c['has_desc']:continue
+		pow,maxpow,claims=c['power'],c['maxpower'],c['claims']
 		if claims==0 and pow==0:continue  # ignorer pays vides/systeme
 		if claims>900000:continue  # ignorer WarZone/SafeZone
-		name=v.get('label',k).replace(' [home]','').strip()
 		marge=pow-claims
-		result.append({'name':name,'power':pow,'maxpower':maxpow,'claims':claims,'marge':marge,
-			'mmr':parsed['mmr'],'leader':parsed['leader'],'members':len(parsed['members']),
-			'x':v.get('x',0),'z':v.get('z',0)})
+		result.append({'name':c['name'],'power':pow,'maxpower':maxpow,'claims':claims,'marge':marge,
+			'mmr':c['mmr'],'leader':c['leader'],'members':len(c['members']),
+			'x':c['x'],'z':c['z']})
 	result.sort(key=lambda x:x['marge'])
-	return cors({'server':s,'countries':result,'total':len(result)})
+	return {'server':s,'countries':columnar(result)if col else result,'total':len(result)}
 
 async def api_check(r):
 	s,c=r.match_info['server'].lower(),r.match_info['country']
@@ -752,10 +1778,7 @@ async def api_check(r):
 	match=next((x for x in country_list if x.lower()==c.lower()),c)
 	members,name,extra=await get_country_from_dynmap(s,match)
 	if not members:return cors({'error':'Pays introuvable'},404)
-	all_=await get_all_online();found,total={},0
-	for(sv,pl)in all_.items():
-		f=[m for m in members if m in pl]
-		if f:found[sv]=f;total+=len(f)
+	found=(await online_snapshot(_req_max_age(r))).locate(members);total=sum(map(len,found.values()))
 	return cors({'country':name,'members_total':len(members),'online_total':total,'servers':found,
 		'claims':extra.get('claims',0),'power':extra.get('power',0),'maxpower':extra.get('maxpower',0),
 		'mmr':extra.get('mmr',0),'leader':extra.get('leader','')})
@@ -782,12 +1805,12 @@ async def api_wl_mocha_add(r):return await _wl_mutate(r,WL_MOCHA,save_watchlist_
 async def api_wl_mocha_remove(r):return await _wl_mutate(r,WL_MOCHA,save_watchlist_mocha)
 @require_auth
 async def api_pronostic(r):
-	res=get_pronostic(r.match_info['player'])
+	res=await get_pronostic(r.match_info['player'])
 	if not res:return cors({'error':'Pas assez de données (min 3)'},404)
 	top,DAYS,total=res;return cors({'player':r.match_info['player'],'total':total,'pronostic':[{'day':DAYS[d],'avg_h':h,'avg_m':m,'pct':pct}for(d,h,m,pct)in top]})
 @require_auth
 async def api_plages(r):
-	res=get_plages(r.match_info['player'])
+	res=await get_plages(r.match_info['player'])
 	if not res:return cors({'error':'Aucune donnée'},404)
 	hm,DAYS=res;return cors({'player':r.match_info['player'],'days':DAYS,'heatmap':hm})
 @require_auth
@@ -809,11 +1832,9 @@ async def api_cw_remove(r):
 async def api_grade(r):
 	player=r.match_info['player'];server=r.match_info['server'].lower()
 	try:
-		headers={'Authorization':f"Bearer {NG_KEY}",'accept':'application/json'}
-		async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=8))as s:
-			async with s.get(f"https://publicapi.nationsglory.fr/user/{player}",headers=headers)as resp:
-				if resp.status!=200:return cors({'player':player,'server':server,'rank':None})
-				data=await resp.json();rank=data.get('servers',{}).get(server,{}).get('country_rank',None);return cors({'player':player,'server':server,'rank':rank})
+		data=await ng_user(player)
+		if data is None:return cors({'player':player,'server':server,'rank':None})
+		rank=data.get('servers',{}).get(server,{}).get('country_rank',None);return cors({'player':player,'server':server,'rank':rank})
 	except Exception as e:return cors({'player':player,'server':server,'rank':None,'error':str(e)})
 
 @require_auth
@@ -823,27 +1844,21 @@ async def api_grades_all(r):
 	player=r.match_info['player']
 	try:
 		# 1) Grades API NG (un seul appel)
-		headers={'Authorization':f"Bearer {NG_KEY}",'accept':'application/json'}
 		ng_grades={}
 		try:
-			async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=8))as sess:
-				async with sess.get(f"https://publicapi.nationsglory.fr/user/{player}",headers=headers)as resp:
-					if resp.status==200:
-						data=await resp.json()
-						ng_grades={srv:info.get('country_rank',None) for srv,info in data.get('servers',{}).items() if isinstance(info,dict)}
-						print(f"[grades] {player} API NG: {ng_grades}",flush=True)
+			data=await ng_user(player)
+			if data is not None:
+				ng_grades={srv:info.get('country_rank',None) for srv,info in data.get('servers',{}).items() if isinstance(info,dict)}
+				print(f"[grades] {player} API NG: {ng_grades}",flush=True)
 		except Exception as e:print(f"[grades] {player} API NG error: {e}",flush=True)
 		# 2) Vérifie le leader dans la dynmap (override API NG si leader)
 		async def check_server(server):
 			try:
-				markers=await _fetch_dynmap_markers(server)
-				pl=player.lower()
-				for k,v in markers.items():
-					if not k.startswith('default_') or not k.endswith('__home'):continue
-					parsed=_parse_marker_desc(v.get('desc',''))
-					if not any(m.lower()==pl for m in parsed['members']):continue
-					if parsed['leader'] and parsed['leader'].lower()==pl:return server,'leader'
-					return server,ng_grades.get(server,None)
+				idx=await dynmap_index(server)
+				pl=player.lower();key=idx['by_player'].get(pl)
+				if key:
+					leader=idx['countries'][key]['leader']
+					if leader and leader.lower()==pl:return server,'leader'
 			except Exception as e:print(f"[grades] check {server}: {e}",flush=True)
 			return server,ng_grades.get(server,None)
 		results=await asyncio.gather(*[check_server(srv) for srv in SERVERS])
@@ -860,7 +1875,7 @@ async def api_debug_country_desc(r):
 	server=r.match_info['server'].lower()
 	country=r.match_info['country']
 	if server not in SERVERS:return cors({'error':'Serveur invalide'},400)
-	markers=await _fetch_dynmap_markers(server)
+	markers=await _fetch_dynmap_markers(server)or{}
 	key=f"default_{country}__home"
 	if key not in markers:
 		cl=country.lower()
@@ -871,6 +1886,19 @@ async def api_debug_country_desc(r):
 	return cors({'key':key,'label':v.get('label',''),'desc_raw':v.get('desc','')[:3000]})
 
 
+def _secs_of_day(field):return{'$add':[{'$multiply':[{'$hour':field},3600]},{'$multiply':[{'$minute':field},60]},{'$second':field}]}
+def _history_pipeline(player,first):
+	"""Regroupement par jour côté MongoDB : sessions du jour (secondes depuis minuit) + durée totale, un document par jour actif."""
+	return[
+		{'$match':{'player':player,'start':{'$gte':first}}},
+		{'$sort':{'start':1}},
+		{'$group':{
+			'_id':{'$dateToString':{'format':'%Y-%m-%d','date':'$start'}},
+			'total_dur':{'$sum':{'$ifNull':['$dur',0]}},
+			'sessions':{'$push':{'server':'$server','start':_secs_of_day('$start'),'end':_secs_of_day('$end'),'dur':{'$ifNull':['$dur',0]},'migrated':{'$ifNull':['$migrated',False]}}},
+		}},
+	]
+
 @require_auth
 async def api_history(r):
 	"""Historique depuis sessions2 (start/end réels). Données migrées depuis l'ancienne collection au démarrage."""
@@ -881,43 +1909,29 @@ async def api_history(r):
 		days=min(days,365)
 		now=datetime.utcnow()+timedelta(hours=1)
 		since=now-timedelta(days=days)
-		from pymongo import ASCENDING
 		DAYS_FR=['Lundi','Mardi','Mercredi','Jeudi','Vendredi','Samedi','Dimanche']
-		docs=list(db['sessions2'].find(
-			{'player':player,'start':{'$gte':since}},
-			{'_id':0,'server':1,'start':1,'end':1,'dur':1,'migrated':1}
-		).sort('start',ASCENDING))
-		by_day={}
-		for d in docs:
-			st=d['start']
-			day_key=st.strftime('%Y-%m-%d')
-			if day_key not in by_day:
-				by_day[day_key]={'label':DAYS_FR[st.weekday()]+' '+st.strftime('%d/%m'),'sessions':[]}
-			by_day[day_key]['sessions'].append({
-				'server':d['server'],
-				'start':st.hour*3600+st.minute*60+st.second,
-				'end':d['end'].hour*3600+d['end'].minute*60+d['end'].second,
-				'dur':d.get('dur',0),
-				'migrated':d.get('migrated',False)
-			})
+		first=(since+timedelta(days=1)).replace(hour=0,minute=0,second=0,microsecond=0)  # 1er jour affiché
+		groups=await adb.sessions2.aggregate_list(_history_pipeline(player,first))
+		by_day={g['_id']:g for g in groups}
 		result=[]
 		total_dur=0
+		today=now.strftime('%Y-%m-%d')
 		for i in range(days):
 			day_dt=since+timedelta(days=i+1)
 			day_key=day_dt.strftime('%Y-%m-%d')
-			if day_key>now.strftime('%Y-%m-%d'):break
-			sessions=by_day.get(day_key,{}).get('sessions',[])
-			day_dur=sum(s['dur'] for s in sessions)
+			if day_key>today:break
+			g=by_day.get(day_key)
+			day_dur=g['total_dur']if g else 0
 			total_dur+=day_dur
-			result.append({'date':day_key,'label':by_day.get(day_key,{}).get('label',DAYS_FR[(since+timedelta(days=i+1)).weekday()]+' '+(since+timedelta(days=i+1)).strftime('%d/%m')),'sessions':sessions,'total_dur':day_dur})
+			result.append({'date':day_key,'label':DAYS_FR[day_dt.weekday()]+' '+day_dt.strftime('%d/%m'),'sessions':g['sessions']if g else[],'total_dur':day_dur})
 		avg_sec=round(total_dur/days) if days>0 else 0
-		return cors({'player':player,'days':days,'history':result,'avg_sec':avg_sec,'days_with_data':sum(1 for d in result if d['sessions'])})
+		return cors({'player':player,'days':days,'history':result,'avg_sec':avg_sec,'days_with_data':len(groups)})
 	except Exception as e:return cors({'error':str(e)},500)
 
 @require_auth
 async def api_known_players(r):
 	if not mongo_ok:return cors({'players':[]})
-	try:pl=sessions_col.distinct('player');pl.sort(key=str.lower);return cors({'players':pl})
+	try:pl=await adb.sessions.distinct('player');pl.sort(key=str.lower);return cors({'players':pl})
 	except:return cors({'players':[]})
 async def api_auth_check(r):
 	try:
@@ -946,10 +1960,7 @@ async def cmd_check(i:discord.Interaction,server:str,country:str):
 	if server not in SERVERS:return await i.followup.send('❌ Serveur invalide')
 	members,name=await get_country_members(server,country)
 	if not members:return await i.followup.send('❌ Pays introuvable')
-	all_=await get_all_online();found,total={},0
-	for(s,pl)in all_.items():
-		f=[m for m in members if m in pl]
-		if f:found[s]=f;total+=len(f)
+	found=(await online_snapshot()).locate(members);total=sum(map(len,found.values()))
 	e=discord.Embed(title=f"📊 Espionnage {name}",color=discord.Color.red())
 	if found:
 		for(s,pl)in sorted(found.items(),key=lambda x:(x[0]!=server,x[0])):lbl=f"{SERVERS[s]['emoji']} {s.upper()} ({len(pl)})"+(' ← cible'if s==server else'');e.add_field(name=lbl,value=', '.join(pl),inline=False)
@@ -957,7 +1968,7 @@ async def cmd_check(i:discord.Interaction,server:str,country:str):
 	else:e.description=f"✅ Aucun membre de {name} connecté";e.color=discord.Color.green()
 	await i.followup.send(embed=e)
 @tree.command(name='checkall',description='Localiser un joueur')
-async def cmd_checkall(i:discord.Interaction,joueur:str):await i.response.defer();all_=await get_all_online();found=[s for(s,pl)in all_.items()if joueur in pl];e=discord.Embed(title=f"🔍 {joueur}",color=discord.Color.green()if found else discord.Color.red());e.description='\n'.join(f"{SERVERS[s]['emoji']} **{s.upper()}**"for s in found)if found else f"**{joueur}** hors ligne";await i.followup.send(embed=e)
+async def cmd_checkall(i:discord.Interaction,joueur:str):await i.response.defer();found=(await online_snapshot()).servers_of(joueur);e=discord.Embed(title=f"🔍 {joueur}",color=discord.Color.green()if found else discord.Color.red());e.description='\n'.join(f"{SERVERS[s]['emoji']} **{s.upper()}**"for s in found)if found else f"**{joueur}** hors ligne";await i.followup.send(embed=e)
 @tree.command(name='online',description='Joueurs en ligne sur un serveur')
 @app_commands.autocomplete(server=srv_ac)
 async def cmd_online(i:discord.Interaction,server:str):
@@ -973,7 +1984,7 @@ async def cmd_online(i:discord.Interaction,server:str):
 async def cmd_pronostic(i:discord.Interaction,joueur:str):
 	await i.response.defer()
 	if not mongo_ok:return await i.followup.send('❌ MongoDB non connecté',ephemeral=True)
-	res=get_pronostic(joueur)
+	res=await get_pronostic(joueur)
 	if not res:return await i.followup.send(f"⚠️ Pas assez de données pour **{joueur}**",ephemeral=True)
 	top,DAYS,total=res;e=discord.Embed(title=f"🔮 Pronostic — {joueur}",description=f"Basé sur **{total}** connexions",color=discord.Color.purple())
 	for(d,avg_h,avg_m,pct)in top:e.add_field(name=f"{DAYS[d]} — {pct}%",value=f"`{'█'*(pct//10)}{'░'*(10-pct//10)}` **{avg_h}h{str(avg_m).zfill(2)}**",inline=False)
@@ -982,7 +1993,7 @@ async def cmd_pronostic(i:discord.Interaction,joueur:str):
 async def cmd_plages(i:discord.Interaction,joueur:str):
 	await i.response.defer()
 	if not mongo_ok:return await i.followup.send('❌ MongoDB non connecté',ephemeral=True)
-	res=get_plages(joueur)
+	res=await get_plages(joueur)
 	if not res:return await i.followup.send(f"⚠️ Aucune donnée pour **{joueur}**",ephemeral=True)
 	hm,DAYS=res;e=discord.Embed(title=f"🕐 Plages — {joueur}",color=discord.Color.orange())
 	for d in range(7):
@@ -1010,61 +2021,134 @@ def _wl_cmd(name,lst,save_fn,label=''):
 		e=discord.Embed(title=f"👁️ Watchlist{tag}",color=discord.Color.blurple());e.description='\n'.join(f"• {p}"for p in lst);e.set_footer(text=f"{len(lst)} joueurs");await i.response.send_message(embed=e,ephemeral=True)
 _wl_cmd('',WL,save_watchlist)
 _wl_cmd('mocha',WL_MOCHA,save_watchlist_mocha,'MOCHA')
-last_states={s:{}for s in SERVERS}
+last_states={s:frozenset()for s in SERVERS}  # joueurs vus au dernier scan réussi
 _session_starts={}  # {(player,server): datetime}
 _sword_online={}  # {name: server} — swords actuellement connectés
 _sword_action_alerted=False  # True si @everyone déjà envoyé pour la co actuelle
 _sword_outs={}  # {name: {'until': datetime, 'duration_h': int}} — outs déclarés manuellement
-_sse_clients=[]
 
 def _record_session(player,server,start,end):
-	if not mongo_ok:return
+	if not MONGO_URL:return
+	dur=int((end-start).total_seconds())
+	if dur<15:return
+	_wb_add('sessions2',{'player':player,'server':server,'start':start,'end':end,'dur':dur})
+
+MIGRATION_WORKERS=int(os.getenv('MIGRATION_WORKERS','3'))  # joueurs traités en parallèle (threads Mongo partagés avec l'app)
+MIGRATION_BATCH=1000  # sessions par insert_many
+MIGRATION_GAP=timedelta(minutes=20)
+_mig_stats={'status':'idle','players_total':0,'players_done':0,'errors':0,'pings':0,'sessions':0,'elapsed':0,'pings_per_s':0}
+
+def _migrate_player(player,cutoff):
+	"""Thread Mongo : pings du joueur en flux (curseur trié) → sessions2 par lots non ordonnés, puis checkpoint.
+	   Sans checkpoint, les sessions migrées d'une tentative interrompue sont d'abord effacées."""
+	col=db['sessions2'];col.delete_many({'player':player,'migrated':True})
+	cur=None;bulk=[];pings=sessions=0
+	def close(c):
+		end=c['last']+timedelta(minutes=3);dur=int((end-c['start']).total_seconds())
+		if dur>=15:bulk.append({'player':player,'server':c['server'],'start':c['start'],'end':end,'dur':dur,'migrated':True})
+	for ping in sessions_col.find({'player':player,'ts':{'$lt':cutoff}},{'_id':0,'server':1,'ts':1}).sort('ts',1).batch_size(5000):
+		pings+=1;ts=ping['ts'];srv=ping['server']
+		if not cur or srv!=cur['server']or ts-cur['last']>MIGRATION_GAP:
+			if cur:close(cur)
+			cur={'server':srv,'start':ts,'last':ts}
+		else:cur['last']=ts
+		if len(bulk)>=MIGRATION_BATCH:col.insert_many(bulk,ordered=False);sessions+=len(bulk);bulk=[]
+	if cur:close(cur)
+	if bulk:col.insert_many(bulk,ordered=False);sessions+=len(bulk)
+	db['migration_progress'].insert_one({'_id':player,'pings':pings,'sessions':sessions,'ts':datetime.utcnow()})
+	return pings,sessions
+
+async def migrate_sessions_to_sessions2():
+	"""Convertit l'ancienne collection sessions (pings) vers sessions2 (start/end), en tâche de fond.
+	   Reprenable : un checkpoint par joueur (migration_progress), état global dans cfg 'sessions2_migration'.
+	   Seuls les pings antérieurs au premier lancement sont migrés (les suivants ont déjà leurs sessions2 en direct)."""
+	if not await wait_mongo():return
 	try:
-		dur=int((end-start).total_seconds())
-		if dur<15:return
-		db['sessions2'].insert_one({'player':player,'server':server,'start':start,'end':end,'dur':dur})
-	except:pass
+		await journal_drained()  # la coupure peut encore reculer au rejeu
+		st=await cfg_get('sessions2_migration')  # posé par init_mongo avant toute écriture live
+		if not st or st['status']=='done':return
+		done={d['_id']for d in await adb.migration_progress.find_list({},{'_id':1})}
+		players=[d['_id']for d in await adb.sessions.aggregate_list([{'$group':{'_id':'$player'}}],allowDiskUse=True)if d['_id']not in done]
+		_mig_stats.update(status='running',players_total=len(players)+len(done),players_done=len(done),errors=0,pings=0,sessions=0)
+		print(f"🔄 Migration sessions → sessions2 : {len(players)} joueurs restants ({len(done)} déjà faits)",flush=True)
+		q=deque(players);loop=asyncio.get_running_loop();t0=time.monotonic()
+		async def worker():
+			while q:
+				p=q.popleft()
+				try:pings,sess=await loop.run_in_executor(_db_executor,_migrate_player,p,st['cutoff'])
+				except Exception as e:_mig_stats['errors']+=1;print(f"❌ Migration {p}: {e}",flush=True);continue  # repris au prochain démarrage
+				_mig_stats['players_done']+=1;_mig_stats['pings']+=pings;_mig_stats['sessions']+=sess
+		async def reporter():
+			while True:
+				await asyncio.sleep(15);m=_mig_stats
+				print(f"🔄 Migration : {m['players_done']}/{m['players_total']} joueurs, {m['sessions']} sessions, {m['pings_per_s']} pings/s",flush=True)
+		async def clock():
+			while True:
+				el=time.monotonic()-t0;_mig_stats['elapsed']=round(el);_mig_stats['pings_per_s']=round(_mig_stats['pings']/el)if el else 0
+				await asyncio.sleep(1)
+		aux=[asyncio.create_task(reporter()),asyncio.create_task(clock())]
+		try:await asyncio.gather(*[worker()for _ in range(MIGRATION_WORKERS)])
+		finally:
+			for t in aux:t.cancel()
+		if _mig_stats['errors']:_mig_stats['status']='partial';print(f"⚠️ Migration incomplète : {_mig_stats['errors']} joueurs en erreur, reprise au prochain démarrage",flush=True);return
+		await cfg_set('sessions2_migration',{**st,'status':'done'});_mig_stats['status']='done'
+		print(f"✅ Migration terminée : {_mig_stats['sessions']} sessions insérées ({_mig_stats['pings']} pings en {_mig_stats['elapsed']}s)",flush=True)
+	except Exception as e:_mig_stats['status']='error';print(f'❌ Migration: {e}',flush=True)
 
-def migrate_sessions_to_sessions2():
-	"""Convertit l'ancienne collection sessions (pings) vers sessions2 (start/end).
-	   Appelé une seule fois au démarrage si sessions2 est vide."""
-	if not mongo_ok:return
-	try:
-		if db['sessions2'].count_documents({})>0:
-			print('⏭️  sessions2 déjà peuplée, migration ignorée',flush=True);return
-		print('🔄 Migration sessions → sessions2...',flush=True)
-		from pymongo import ASCENDING
-		GAP=timedelta(minutes=20)
-		players=sessions_col.distinct('player')
-		total=0
-		for player in players:
-			pings=list(sessions_col.find({'player':player},{'_id':0,'server':1,'ts':1}).sort('ts',ASCENDING))
-			if not pings:continue
-			cur=None
-			bulk=[]
-			for ping in pings:
-				ts=ping['ts'];srv=ping['server']
-				if not cur or srv!=cur['server'] or ts-cur['last']>GAP:
-					if cur:
-						end=cur['last']+timedelta(minutes=3)
-						dur=int((end-cur['start']).total_seconds())
-						if dur>=15:bulk.append({'player':player,'server':cur['server'],'start':cur['start'],'end':end,'dur':dur,'migrated':True})
-					cur={'server':srv,'start':ts,'last':ts}
-				else:cur['last']=ts
-			if cur:
-				end=cur['last']+timedelta(minutes=3)
-				dur=int((end-cur['start']).total_seconds())
-				if dur>=15:bulk.append({'player':player,'server':cur['server'],'start':cur['start'],'end':end,'dur':dur,'migrated':True})
-			if bulk:db['sessions2'].insert_many(bulk);total+=len(bulk)
-		print(f'✅ Migration terminée : {total} sessions insérées',flush=True)
-	except Exception as e:print(f'❌ Migration: {e}',flush=True)  # liste des queues SSE connectées
-rapport_msg_id=None
 _rate_limited=False
 
-def _sse_broadcast(event):
-	for q in list(_sse_clients):
-		try:q.put_nowait(event)
-		except:pass
+# ════════════════════════════════════════════════════════
+# 📣 BUS D'ÉVÉNEMENTS (SSE)
+# ════════════════════════════════════════════════════════
+SSE_BUFFER=int(os.getenv('SSE_BUFFER','256'))  # événements en attente max par abonné
+SSE_HISTORY=int(os.getenv('SSE_HISTORY','1000'))  # rejouables via Last-Event-ID
+SSE_POLICY=os.getenv('SSE_POLICY','drop')  # 'drop' : les plus anciens sautent ; 'disconnect' : l'abonné lent est coupé
+SSE_KEEPALIVE=25
+_BUS_EPOCH=format(int(time.time()),'x')  # préfixe des ids : un id d'un process précédent ne rejoue rien
+_bus_seq=0
+_bus_history=deque(maxlen=SSE_HISTORY)  # (seq, (type,server,player), trame)
+_bus_subs=set()
+_bus_stats={'published':0,'delivered':0,'dropped':0,'disconnected':0,'replayed':0}
+
+class Subscriber:
+	"""Abonné SSE : tampon borné de trames déjà sérialisées + filtres par sujet (None = tout)."""
+	__slots__=('buf','wake','types','servers','players','closed','dropped')
+	def __init__(self,types=None,servers=None,players=None):
+		self.buf=deque();self.wake=asyncio.Event();self.closed=False;self.dropped=0
+		self.types,self.servers,self.players=types,servers,players
+	def matches(self,meta):
+		t,s,p=meta
+		return(self.types is None or t in self.types)and(self.servers is None or s in self.servers)and(self.players is None or p in self.players)
+	def push(self,meta,frame):
+		if self.closed or not self.matches(meta):return
+		if len(self.buf)>=SSE_BUFFER:
+			if SSE_POLICY=='disconnect':self.closed=True;self.wake.set();_bus_stats['disconnected']+=1;return
+			self.buf.popleft();self.dropped+=1;_bus_stats['dropped']+=1
+		self.buf.append((time.monotonic(),frame));self.wake.set()
+
+def publish_event(event):
+	"""Sérialise une seule fois, puis distribue la même trame à tous les abonnés concernés."""
+	global _bus_seq
+	_bus_seq+=1;meta=(event.get('type'),event.get('server'),event.get('player'))
+	frame=f"id: {_BUS_EPOCH}-{_bus_seq}\n".encode()+b'data: '+dumps(event)+b'\n\n'
+	_bus_history.append((_bus_seq,meta,frame));_bus_stats['published']+=1
+	for sub in list(_bus_subs):sub.push(meta,frame)
+
+def bus_subscribe(sub,last_event_id=None):
+	"""Rejoue l'historique postérieur à last_event_id puis inscrit l'abonné (sans await entre les deux : rien n'est perdu)."""
+	epoch,_,seq=(last_event_id or'').partition('-')
+	if epoch==_BUS_EPOCH and seq.isdigit():
+		for s_,meta,frame in _bus_history:
+			if s_>int(seq):sub.push(meta,frame);_bus_stats['replayed']+=1
+	_bus_subs.add(sub)
+
+Collected('mossad_sse_subscribers','Abonnés SSE connectés','gauge',lambda:len(_bus_subs))
+Collected('mossad_sse_events_total','Événements SSE publiés, livrés, perdus (tampon plein)','counter',lambda:{k:_bus_stats[k]for k in('published','delivered','dropped')},('result',))
+
+def bus_stats():
+	now=time.monotonic();lags=[now-s.buf[0][0]for s in _bus_subs if s.buf]  # âge du plus vieil événement non envoyé
+	return{**_bus_stats,'subscribers':len(_bus_subs),'policy':SSE_POLICY,'buffered':sum(len(s.buf)for s in _bus_subs),
+		'lag_max_s':round(max(lags,default=0),3),'lagging':len(lags)}
 
 async def safe_send(channel,**kwargs):
 	global _rate_limited
@@ -1085,21 +2169,142 @@ async def safe_edit(msg,**kwargs):
 				retry=e.retry_after if hasattr(e,'retry_after')else 30
 				_rate_limited=True;print(f"⚠️ Rate limit (edit), attente {retry}s",flush=True);await asyncio.sleep(retry);_rate_limited=False
 			else:raise
+# ════════════════════════════════════════════════════════
+# 📨 DISPATCHER DISCORD (files par salon, regroupement, buckets)
+# ════════════════════════════════════════════════════════
+DISCORD_COALESCE=float(os.getenv('DISCORD_COALESCE','1.5'))  # fenêtre de regroupement des alertes (s)
+DISCORD_QUEUE_MAX=500  # au-delà, les plus vieilles alertes d'un salon sont abandonnées
+DISCORD_ROUTE_BURST=5;DISCORD_ROUTE_PER=5.0  # POST /channels/{id}/messages : 5 messages / 5 s par salon
+EMBED_LINES=30;MESSAGE_EMBEDS=10
+EMBED_DESC_MAX=4096;MESSAGE_CHARS_MAX=6000  # limites Discord : description d'un embed, total titres+descriptions d'un message
+_dq={}  # {channel_id: {'items':deque,'task','bucket'}}
+_dispatch_stats={'queued':0,'messages':0,'coalesced':0,'dropped':0,'rate_limited':0,'errors':0,'bucket_waits':0}
+
+def notify(channel_id,*,line=None,title=None,color=None,content=None,embed=None):
+	"""Met un message en file pour un salon, sans aucune I/O : l'appelant (scanner...) n'attend jamais Discord.
+	   line+title+color : regroupé avec les lignes de même (title,color) arrivées dans la fenêtre.
+	   content/embed : envoyé tel quel, dans l'ordre."""
+	if not channel_id:return
+	q=_dq.get(channel_id)
+	if q is None:
+		q=_dq[channel_id]={'items':deque(maxlen=DISCORD_QUEUE_MAX),'task':None,
+			'bucket':{'tokens':float(DISCORD_ROUTE_BURST),'ts':time.monotonic(),'blocked_until':0.0}}
+	if len(q['items'])==DISCORD_QUEUE_MAX:_dispatch_stats['dropped']+=1
+	q['items'].append((title,color,line,discord.utils.utcnow())if line is not None else(None,None,(content,embed),None))
+	_dispatch_stats['queued']+=1
+	if not _busy(q['task']):q['task']=asyncio.create_task(_dispatch_worker(channel_id))
+
+def _coalesce(items):
+	"""Suite d'items -> messages {'content','embeds'} : lignes regroupées par (title,color), messages bruts à leur place.
+	   Embeds coupés à EMBED_LINES lignes / EMBED_DESC_MAX caractères, messages à MESSAGE_EMBEDS embeds / MESSAGE_CHARS_MAX caractères ;
+	   horodatage = mise en file de la dernière ligne de l'embed."""
+	out,groups=[],{}
+	def flush():
+		embeds=[]
+		for(title,color),lines in groups.items():
+			t=title if len(lines)==1 else f"{title} ×{len(lines)}"
+			chunk,size=[],0
+			for line,ts in lines+[(None,None)]:
+				if line is not None:line=line[:EMBED_DESC_MAX]
+				if chunk and(line is None or len(chunk)>=EMBED_LINES or size+1+len(line)>EMBED_DESC_MAX):
+					embeds.append(discord.Embed(title=t,description='\n'.join(chunk),color=color,timestamp=chunk_ts));chunk,size=[],0
+				if line is not None:size+=len(line)+(1 if chunk else 0);chunk.append(line);chunk_ts=ts
+			if len(lines)>1:_dispatch_stats['coalesced']+=len(lines)-1
+		msg,size=[],0
+		for e in embeds:
+			n=len(e.title or'')+len(e.description or'')
+			if msg and(len(msg)>=MESSAGE_EMBEDS or size+n>MESSAGE_CHARS_MAX):out.append({'embeds':msg});msg,size=[],0
+			msg.append(e);size+=n
+		if msg:out.append({'embeds':msg})
+		groups.clear()
+	for title,color,x,ts in items:
+		if title is None:
+			flush();content,embed=x;out.append({'content':content,**({'embeds':[embed]}if embed else{})})
+		else:groups.setdefault((title,color),[]).append((x,ts))
+	flush()
+	return out
+
+async def _route_acquire(b):
+	"""Bucket local du salon, tenu à jour avant l'envoi (et recalé sur le retry_after d'un 429)."""
+	rate=DISCORD_ROUTE_BURST/DISCORD_ROUTE_PER
+	while True:
+		now=time.monotonic()
+		if now<b['blocked_until']:await asyncio.sleep(b['blocked_until']-now);continue
+		b['tokens']=min(DISCORD_ROUTE_BURST,b['tokens']+(now-b['ts'])*rate);b['ts']=now
+		if b['tokens']>=1:b['tokens']-=1;return
+		_dispatch_stats['bucket_waits']+=1;await asyncio.sleep((1-b['tokens'])/rate)
+
+async def _dispatch_worker(channel_id):
+	q=_dq[channel_id]
+	while q['items']:
+		await asyncio.sleep(DISCORD_COALESCE)  # laisse arriver le reste de la rafale
+		items=list(q['items']);q['items'].clear()
+		ch=client.get_channel(channel_id)
+		if not ch:_dispatch_stats['dropped']+=len(items);continue
+		for msg in _coalesce(items):
+			for _ in range(3):
+				await _route_acquire(q['bucket'])
+				try:await ch.send(**msg);_dispatch_stats['messages']+=1;break
+				except discord.errors.HTTPException as e:
+					if e.status!=429:_dispatch_stats['errors']+=1;print(f"❌ Discord {channel_id}: {e}",flush=True);break
+					retry=getattr(e,'retry_after',None)or 5
+					_dispatch_stats['rate_limited']+=1;q['bucket']['blocked_until']=time.monotonic()+retry;q['bucket']['tokens']=0
+					print(f"⚠️ Rate limit salon {channel_id}, attente {retry}s",flush=True)
+				except Exception as e:_dispatch_stats['errors']+=1;print(f"❌ Discord {channel_id}: {e}",flush=True);break
+			else:_dispatch_stats['dropped']+=1;print(f"❌ Discord {channel_id}: message abandonné après 3 rate limits",flush=True)
+
+Collected('mossad_discord_queue_depth','Lignes en attente d\'envoi par salon Discord','gauge',lambda:{str(c):len(q['items'])for c,q in _dq.items()},('channel',))
+Collected('mossad_discord_rate_limited_total','Réponses 429 reçues de Discord','counter',lambda:_dispatch_stats['rate_limited'])
+Collected('mossad_discord_messages_total','Messages Discord envoyés, abandonnés (salon introuvable, file pleine, 3 rate limits) ou en erreur','counter',lambda:{k:_dispatch_stats[k]for k in('messages','dropped','errors')},('result',))
+
+def dispatch_stats():return{**_dispatch_stats,'depth':{str(c):len(q['items'])for c,q in _dq.items()}}
+
 def _status_text(wl,players):
 	on=[p for p in wl if p in players];off=[p for p in wl if p not in players];txt=''
 	if on:txt+=f"🟢 **En ligne ({len(on)}) :**\n"+''.join(f"• {p}\n"for p in on)
 	if off:txt+=('\n'if txt else'')+f"⚪ **Hors ligne ({len(off)}) :**\n"+''.join(f"• {p}\n"for p in off)
 	return txt or'Aucun joueur surveillé en ligne'
 def _rapport_embed(title,count,time_str,status_text,color):e=discord.Embed(title=title,color=color,timestamp=discord.utils.utcnow());e.add_field(name='👥 Connectés',value=f"**{count}**",inline=True);e.add_field(name='⏱️ Relevé', value=f"**{time_str}**", inline=True);e.add_field(name='👁️ Surveillance',value=status_text,inline=False);e.set_footer(text=f"Scanner • MongoDB {'✅'if mongo_ok else'❌'}");return e
-async def _update_rapport(channel,msg_id_ref,embed,save_fn):
-	if not channel:return msg_id_ref
-	if msg_id_ref:
-		try:msg=await channel.fetch_message(msg_id_ref);await safe_edit(msg,embed=embed);return msg_id_ref
-		except discord.NotFound:pass
-	msg=await safe_send(channel,embed=embed);await asyncio.get_running_loop().run_in_executor(None,save_fn,msg.id);return msg.id
+# ════════════════════════════════════════════════════════
+# 📌 MESSAGES DE STATUT (embeds mis à jour en place)
+# ════════════════════════════════════════════════════════
+STATUS_FORCE_REFRESH=int(os.getenv('STATUS_FORCE_REFRESH','300'))  # réédition forcée même sans changement (heure du relevé)
+_pins={}  # {nom: {'channel','msg_id','sig','at'}} ; channel/msg_id persistés dans cfg 'status_msgs'
+_pin_stats={'edits':0,'skipped':0,'sends':0,'recovered':0}
+
+async def load_pins():
+	v=await cfg_get('status_msgs')or{}
+	old=await cfg_get('rapport_msg_id')  # ancienne clé du rapport LIME
+	if old and'rapport_lime'not in v:v['rapport_lime']={'channel':CH_RAPPORT,'msg_id':old}
+	for name,p in v.items():_pins[name]={'channel':p['channel'],'msg_id':p['msg_id'],'sig':None,'at':0}
+
+async def _save_pins():await cfg_set('status_msgs',{n:{'channel':p['channel'],'msg_id':p['msg_id']}for n,p in _pins.items()if p['msg_id']})
+
+async def pin_update(name,channel_id,embed,sig,find=None):
+	"""Met à jour le message de statut `name` : un seul PATCH (message partiel, pas de fetch), aucun appel si sig
+	   est inchangée depuis moins de STATUS_FORCE_REFRESH s. Historique (titre contenant find) seulement sur NotFound."""
+	p=_pins.get(name)
+	if not p or p['channel']!=channel_id:p=_pins[name]={'channel':channel_id,'msg_id':None,'sig':None,'at':0}
+	now=time.time()
+	if p['msg_id']and p['sig']==sig and now-p['at']<STATUS_FORCE_REFRESH:_pin_stats['skipped']+=1;return
+	ch=client.get_channel(channel_id)
+	if not ch:return
+	if p['msg_id']:
+		try:await safe_edit(ch.get_partial_message(p['msg_id']),embed=embed);p['sig'],p['at']=sig,now;_pin_stats['edits']+=1;return
+		except discord.NotFound:p['msg_id']=None
+	msg=None
+	if find:
+		async for old in ch.history(limit=10):
+			if old.author==client.user and old.embeds and find in(old.embeds[0].title or''):msg=old;break
+	if msg:await safe_edit(msg,embed=embed);_pin_stats['recovered']+=1
+	else:msg=await safe_send(ch,embed=embed);_pin_stats['sends']+=1
+	p.update(msg_id=msg.id,sig=sig,at=now);await _save_pins()
+
+def pin_stats():return{**_pin_stats,'messages':{n:p['msg_id']for n,p in _pins.items()}}
 async def _check_sword_action(ts):
 	global _sword_action_alerted
-	co_lime=[n for n,srv in _sword_online.items() if srv=='lime' and any(s['name']==n and not s.get('is_out')for s in SWORDS)]
+	active=watch_index().swords_active
+	co_lime=[n for n,srv in _sword_online.items()if srv=='lime'and n in active]
 	print(f"⚔️ _check_sword_action: co_lime={co_lime} alerted={_sword_action_alerted} CH_SWORD_ACTION={CH_SWORD_ACTION} _sword_online={_sword_online}",flush=True)
 	if len(co_lime)<2:return
 	ch=client.get_channel(CH_SWORD_ACTION)if CH_SWORD_ACTION else None
@@ -1109,47 +2314,100 @@ async def _check_sword_action(ts):
 	_sword_action_alerted=True
 	desc='\n'.join(f"⚔️ **{n}**"for n in co_lime)
 	e=discord.Embed(title=f'🚨 ACTION POSSIBLE — {len(co_lime)} SWORDS SUR LIME',description=f"{desc}\n\n✅ Co simultanément, aucun out",color=discord.Color.red(),timestamp=ts)
-	await safe_send(ch,content='@everyone',embed=e)
+	notify(CH_SWORD_ACTION,content='@everyone',embed=e)
 
-async def scan_server(server,alerte_ch):
-	players=await get_online(server);pset=set(players);prev=last_states[server];mocha_ch=client.get_channel(CH_M_ALERTE);ts=discord.utils.utcnow()
-	now=datetime.utcnow()+timedelta(hours=1)
-	for p in pset:
-		if not prev.get(p):
-			_session_starts[(p,server)]=now
-			record_connection(p,server)
-			if p in WL and alerte_ch:e=discord.Embed(title='🟢 CONNEXION',description=f"**{p}** → **{server.upper()}**",color=discord.Color.green(),timestamp=ts);await safe_send(alerte_ch,embed=e)
-			if p in WL:_sse_broadcast({'type':'connect','player':p,'server':server})
-			if p in WL_MOCHA and server=='mocha'and mocha_ch:e=discord.Embed(title='🟢 CONNEXION — MOCHA',description=f"**{p}** → **MOCHA**",color=discord.Color.orange(),timestamp=ts);await safe_send(mocha_ch,embed=e)
-			# ── Sword tracker ──
-			sword_names=[s['name']for s in SWORDS]
-			if p in sword_names:
-				_sword_online[p]=server
-				# Dédup : ne notifie que si co pas déjà notifiée dans les 60s
-				import time as _t;_now_t=_t.time()
-				if _now_t-_sword_notif_sent.get((p,server),0)>60:
-					_sword_notif_sent[(p,server)]=_now_t
-					sw_ch=client.get_channel(CH_SWORD)if CH_SWORD else None
-					if sw_ch:await safe_send(sw_ch,embed=discord.Embed(title='⚔️ SWORD CO',description=f"**{p}** → **{server.upper()}**",color=discord.Color.green(),timestamp=ts))
-					await _check_sword_action(ts)
-	for(p,was)in prev.items():
-		if was and p not in pset:
-			start_dt=_session_starts.pop((p,server),None)
-			if start_dt:_record_session(p,server,start_dt,now)
-			if p in WL and alerte_ch:e=discord.Embed(title='🔴 DÉCONNEXION',description=f"**{p}** ← **{server.upper()}**",color=discord.Color.red(),timestamp=ts);await safe_send(alerte_ch,embed=e)
-			if p in WL:_sse_broadcast({'type':'disconnect','player':p,'server':server})
-			if p in WL_MOCHA and server=='mocha'and mocha_ch:e=discord.Embed(title='🔴 DÉCONNEXION — MOCHA',description=f"**{p}** ← **MOCHA**",color=discord.Color.red(),timestamp=ts);await safe_send(mocha_ch,embed=e)
-			# ── Sword déco ──
-			sword_names=[s['name']for s in SWORDS]
-			if p in sword_names and p in _sword_online:
-				del _sword_online[p]
-				# Notif déco → CH_SWORD (logs)
-				sw_ch=client.get_channel(CH_SWORD)if CH_SWORD else None
-				if sw_ch:await safe_send(sw_ch,embed=discord.Embed(title='🔴 SWORD DÉCO',description=f"**{p}** ← **{server.upper()}**",color=discord.Color.red(),timestamp=ts))
-				global _sword_action_alerted
-				co_active=[n for n in _sword_online if any(s['name']==n and not s.get('is_out')for s in SWORDS)]
-				if len(co_active)<2:_sword_action_alerted=False
-	last_states[server]={p:True for p in pset};return players
+# ════════════════════════════════════════════════════════
+# 🔁 MOTEUR DE DIFF DU SCANNER
+# ════════════════════════════════════════════════════════
+class WatchIndex:
+	"""Ensembles figés des joueurs surveillés, reconstruits seulement quand une liste change (watch_changed)."""
+	__slots__=('wl','wl_mocha','swords','swords_active')
+	def __init__(self):
+		self.wl=frozenset(WL);self.wl_mocha=frozenset(WL_MOCHA)
+		self.swords=frozenset(s['name']for s in SWORDS);self.swords_active=frozenset(s['name']for s in SWORDS if not s.get('is_out'))
+
+_watch=None
+_diff_handlers=[]
+_diff_stats={'ticks':0,'unchanged':0,'joins':0,'leaves':0,'rebuilds':0}
+
+def watch_changed():
+	global _watch;_watch=None
+
+def watch_index():
+	global _watch
+	if _watch is None:_watch=WatchIndex();_diff_stats['rebuilds']+=1
+	return _watch
+
+def on_diff(fn):
+	"""Enregistre un handler async(d) ; d = {'server','joins','leaves','watch','ts','now'}.
+	   Les handlers ne font pas d'I/O Discord directe : ils passent par notify()."""
+	_diff_handlers.append(fn);return fn
+
+M_SCAN=Histogram('mossad_scan_seconds','Durée d\'un scan (fetch dynmap + diff + handlers) par serveur',('server',))
+Collected('mossad_scan_players','Joueurs en ligne au dernier scan','gauge',lambda:{s:len(v)for s,v in last_states.items()},('server',))
+
+@timed(M_SCAN,lambda server:(server,))
+async def scan_server(server):
+	players=await _fetch_online(server)
+	if players is None:return None  # erreur dynmap : on ne touche pas à l'état (pas de fausses décos)
+	snap=publish_online(server,players);_diff_stats['ticks']+=1
+	pset=snap.sets[server];prev=last_states[server]
+	if pset==prev:_diff_stats['unchanged']+=1;return players
+	joins=pset-prev;leaves=prev-pset;last_states[server]=pset
+	_diff_stats['joins']+=len(joins);_diff_stats['leaves']+=len(leaves)
+	d={'server':server,'joins':joins,'leaves':leaves,'watch':watch_index(),'ts':discord.utils.utcnow(),'now':datetime.utcnow()+timedelta(hours=1)}
+	for h in _diff_handlers:
+		try:await h(d)
+		except Exception as e:print(f"❌ diff {h.__name__} {server}: {e}",flush=True)
+	return players
+
+@on_diff
+async def _diff_sessions(d):
+	server,now=d['server'],d['now']
+	for p in d['joins']:_session_starts[(p,server)]=now;record_connection(p,server)
+	for p in d['leaves']:
+		start_dt=_session_starts.pop((p,server),None)
+		if start_dt:_record_session(p,server,start_dt,now)
+
+@on_diff
+async def _diff_alerts(d):
+	server,w=d['server'],d['watch'];S=server.upper()
+	for p in d['joins']&w.wl:notify(CH_ALERTE,title='🟢 CONNEXION',color=discord.Color.green(),line=f"**{p}** → **{S}**")
+	for p in d['leaves']&w.wl:notify(CH_ALERTE,title='🔴 DÉCONNEXION',color=discord.Color.red(),line=f"**{p}** ← **{S}**")
+	if server=='mocha'and w.wl_mocha:
+		for p in d['joins']&w.wl_mocha:notify(CH_M_ALERTE,title='🟢 CONNEXION — MOCHA',color=discord.Color.orange(),line=f"**{p}** → **MOCHA**")
+		for p in d['leaves']&w.wl_mocha:notify(CH_M_ALERTE,title='🔴 DÉCONNEXION — MOCHA',color=discord.Color.red(),line=f"**{p}** ← **MOCHA**")
+
+@on_diff
+async def _diff_sse(d):
+	w=d['watch']
+	for p in d['joins']&w.wl:publish_event({'type':'connect','player':p,'server':d['server']})
+	for p in d['leaves']&w.wl:publish_event({'type':'disconnect','player':p,'server':d['server']})
+
+@on_diff
+async def _diff_swords(d):
+	global _sword_action_alerted
+	server,ts,w=d['server'],d['ts'],d['watch']
+	joined=d['joins']&w.swords;left=[p for p in d['leaves']&w.swords if p in _sword_online]
+	if not joined and not left:return
+	notified=False
+	for p in joined:
+		_sword_online[p]=server
+		# Dédup : ne notifie que si co pas déjà notifiée dans les 60s
+		_now_t=time.time()
+		if _now_t-_sword_notif_sent.get((p,server),0)>60:
+			_sword_notif_sent[(p,server)]=_now_t;notified=True
+			notify(CH_SWORD,title='⚔️ SWORD CO',color=discord.Color.green(),line=f"**{p}** → **{server.upper()}**")
+	if notified:await _check_sword_action(ts)
+	for p in left:
+		del _sword_online[p]
+		notify(CH_SWORD,title='🔴 SWORD DÉCO',color=discord.Color.red(),line=f"**{p}** ← **{server.upper()}**")
+	if left and sum(1 for n in _sword_online if n in w.swords_active)<2:_sword_action_alerted=False
+
+Collected('mossad_scan_ticks_total','Scans réussis (unchanged : liste identique au précédent)','counter',lambda:{k:_diff_stats[k]for k in('ticks','unchanged')},('kind',))
+Collected('mossad_presence_changes_total','Connexions et déconnexions détectées','counter',lambda:{k:_diff_stats[k]for k in('joins','leaves')},('kind',))
+
+def diff_stats():return{**_diff_stats,'handlers':[h.__name__ for h in _diff_handlers]}
 async def check_country_watch(watch):
 	try:
 		server=watch['server'];country=watch['country'];members,name=await get_country_members(server,country)
@@ -1158,56 +2416,183 @@ async def check_country_watch(watch):
                                                                     
 		members,rank_map=await verify_members_with_ranks(server,members)
 		if not members:return
-		online_players=await get_online(server);online_members=[m for m in members if m in online_players]
+		online_players=(await online_snapshot(servers=[server])).sets.get(server,frozenset());online_members=[m for m in members if m in online_players]
 		if len(online_members)<2:watch['last_alert']=False;watch['members']=online_members;return
 		non_recruits=[(p,rank_map[p])for p in online_members if rank_map.get(p,'')!='recruit']
 		watch['members']=online_members;can_assault=len(online_members)>=2 and len(non_recruits)>=1
 		if can_assault and not watch.get('last_alert'):
-			watch['last_alert']=True;ch=client.get_channel(CH_PAYS)
-			if ch:await safe_send(ch,content=f"⚔ **ASSAUT POSSIBLE** — **{name}** sur **{server.upper()}**")
+			watch['last_alert']=True;notify(CH_PAYS,content=f"⚔ **ASSAUT POSSIBLE** — **{name}** sur **{server.upper()}**")
 		elif not can_assault and watch.get('last_alert'):
-			watch['last_alert']=False;ch=client.get_channel(CH_PAYS)
-			if ch:await safe_send(ch,content=f"✅ **PLUS POSSIBLE** — **{name}** sur **{server.upper()}** (moins de 2 membres ou que des recrues)")
+			watch['last_alert']=False;notify(CH_PAYS,content=f"✅ **PLUS POSSIBLE** — **{name}** sur **{server.upper()}** (moins de 2 membres ou que des recrues)")
 	except Exception as e:print(f"❌ CW scan {watch}: {e}",flush=True)
+# ════════════════════════════════════════════════════════
+# ⏱️ ORDONNANCEUR DU SCANNER (intervalle adaptatif par serveur)
+# ════════════════════════════════════════════════════════
+SCAN_MIN_INTERVAL=float(os.getenv('SCAN_MIN_INTERVAL','2'))  # serveurs chauds : joueurs surveillés en ligne ou très peuplés
+SCAN_BASE_INTERVAL=float(os.getenv('SCAN_BASE_INTERVAL','4'))
+SCAN_MAX_INTERVAL=float(os.getenv('SCAN_MAX_INTERVAL','30'))  # plafond pour les serveurs vides
+SCAN_ERROR_MAX_INTERVAL=float(os.getenv('SCAN_ERROR_MAX_INTERVAL','120'))
+SCAN_BUSY_PLAYERS=int(os.getenv('SCAN_BUSY_PLAYERS','40'))
+SCAN_BUDGET_RPS=float(os.getenv('SCAN_BUDGET_RPS','5'))  # budget global de polls dynmap par seconde
+SCAN_JITTER=0.15
+SCAN_TICK=0.25
+_poll={}  # {server: {'interval','next','fails','empty','count','task'}}
+_jobs={}  # {name: {'interval','next','fn','task','runs'}}
+
+def schedule_job(name,interval,fn):
+	"""Enregistre une tâche périodique (coroutine sans argument) dans l'ordonnanceur du scanner."""
+	_jobs[name]={'interval':interval,'next':0.0,'fn':fn,'task':None,'runs':0}
+
+def _busy(task):return task is not None and not task.done()
+
+async def _guarded(label,coro):
+	try:return await coro
+	except discord.errors.HTTPException as e:
+		if e.status==429:retry=e.retry_after if hasattr(e,'retry_after')else 30;print(f"⚠️ Rate limit ({label}), attente {retry}s",flush=True);await asyncio.sleep(retry)
+		else:print(f"❌ {label} HTTP: {e}",flush=True)
+	except Exception as e:print(f"❌ {label}: {e}",flush=True)
+	return None
+
+def _poll_interval(server,st):
+	if st['fails']:return min(SCAN_BASE_INTERVAL*2**st['fails'],SCAN_ERROR_MAX_INTERVAL)
+	online=last_states.get(server,frozenset());w=watch_index()
+	if st['count']>=SCAN_BUSY_PLAYERS:return SCAN_MIN_INTERVAL
+	if not online.isdisjoint(w.wl)or not online.isdisjoint(w.swords):return SCAN_MIN_INTERVAL
+	if server=='mocha'and WL_MOCHA:return SCAN_MIN_INTERVAL
+	if st['empty']:return min(SCAN_BASE_INTERVAL*1.5**st['empty'],SCAN_MAX_INTERVAL)
+	return SCAN_BASE_INTERVAL
+
+async def _poll_server(server):
+	st=_poll[server]
+	players=await _guarded(f"Scanner {server}",scan_server(server))
+	if players is None:st['fails']+=1
+	else:st['fails']=0;st['count']=len(players);st['empty']=st['empty']+1 if not players else 0
+	st['interval']=_poll_interval(server,st)
+	st['next']=time.monotonic()+st['interval']*random.uniform(1-SCAN_JITTER,1+SCAN_JITTER)
+
+def scheduler_stats():
+	return{'budget_rps':SCAN_BUDGET_RPS,'servers':{s:{'interval':round(st['interval'],2),'count':st['count'],'fails':st['fails']}for s,st in _poll.items()},'jobs':{n:{'interval':j['interval'],'runs':j['runs']}for n,j in _jobs.items()}}
+
+async def _job_country_watch():
+	if COUNTRY_WATCHES:await asyncio.gather(*[check_country_watch(w)for w in COUNTRY_WATCHES],return_exceptions=True);await save_cw(snapshot=False)
+
+async def _job_rapport():
+	ts=(discord.utils.utcnow()+timedelta(hours=1)).strftime('%H:%M:%S')
+	for name,channel_id,title,server,wl,on_color in(('rapport_lime',CH_RAPPORT,'🟢 RAPPORT TACTIQUE — LIME','lime',WL,discord.Color.green()),
+		('rapport_mocha',CH_M_RAPPORT,'🟤 RAPPORT TACTIQUE — MOCHA','mocha',WL_MOCHA,discord.Color.orange())):
+		pl=last_states.get(server,frozenset());status=_status_text(wl,pl);color=on_color if not pl.isdisjoint(wl)else discord.Color.greyple()
+		await pin_update(name,channel_id,_rapport_embed(title,len(pl),ts,status,color),(len(pl),status,color.value,mongo_ok),find=title)
+
+schedule_job('country_watch',6,_job_country_watch)
+schedule_job('rapport',30,_job_rapport)
+
+# ════════════════════════════════════════════════════════
+# 💾 ÉTAT DE SURVEILLANCE PERSISTANT (redémarrage rapide)
+# ════════════════════════════════════════════════════════
+STATE_PATH=os.getenv('STATE_PATH','mossad_state.json')
+STATE_VERSION=1
+STATE_SAVE_INTERVAL=30
+STATE_MAX_AGE=int(os.getenv('STATE_MAX_AGE','900'))  # au-delà, présences et sessions en cours ne sont pas reprises
+_state={'ready':False,'last':None,'at':0.0}  # ready : état chargé (sinon on n'écrase pas un bon snapshot) ; last/at : dernier JSON écrit
+_state_lock=asyncio.Lock()
+_state_stats={'saves':0,'skipped':0,'loaded_from':None,'loaded_age':None,'errors':0}
+
+def _dump_state():
+	"""Copie (conteneurs neufs) de tout l'état de surveillance : sérialisable hors de l'event loop."""
+	return{'v':STATE_VERSION,'saved_at':time.time(),'wl':list(WL),'wl_mocha':list(WL_MOCHA),'wl_msg_id':wl_msg_id,'wl_mocha_msg_id':wl_mocha_msg_id,
+		'cw':[dict(w)for w in COUNTRY_WATCHES],'referents':[dict(w)for w in REFERENT_WATCHES],'swords':[dict(w)for w in SWORDS],
+		'last_states':{s:sorted(v)for s,v in last_states.items()},'session_starts':[[p,s,dt]for(p,s),dt in _session_starts.items()],
+		'sword_online':dict(_sword_online),'sword_action_alerted':_sword_action_alerted}
+
+def _write_state_file(text):
+	tmp=STATE_PATH+'.tmp'
+	with open(tmp,'w',encoding='utf-8')as f:f.write(text)
+	os.replace(tmp,STATE_PATH)  # atomique : jamais de fichier à moitié écrit
+
+def _read_state_file():
+	try:
+		with open(STATE_PATH,encoding='utf-8')as f:return json_util.loads(f.read())
+	except(OSError,ValueError):return None
+
+async def save_state(force=False):
+	"""Fichier local + copie MongoDB (le disque Render ne survit pas à un redéploiement).
+	   Rien si inchangé, sauf pour rafraîchir saved_at avant qu'il ne dépasse STATE_MAX_AGE."""
+	if not _state['ready']:return
+	async with _state_lock:  # job périodique et sauvegardes sur modif : un seul écrivain du fichier à la fois
+		doc=_dump_state();text=json_util.dumps({k:v for k,v in doc.items()if k!='saved_at'})
+		if not force and text==_state['last']and doc['saved_at']-_state['at']<STATE_MAX_AGE/3:_state_stats['skipped']+=1;return
+		try:
+			await asyncio.get_running_loop().run_in_executor(_db_executor,_write_state_file,json_util.dumps(doc))
+			if mongo_ok:await adb.config.update_one({'key':'watch_state'},{'$set':{'value':doc}},upsert=True)
+			_state['last']=text;_state['at']=doc['saved_at'];_state_stats['saves']+=1
+		except Exception as e:_state_stats['errors']+=1;print(f"❌ Sauvegarde état: {e}",flush=True)
+
+async def load_state():
+	"""Lit en parallèle le fichier local et la copie MongoDB, applique la plus récente.
+	   Retourne None (rien d'utilisable), 'watch' (listes seules) ou 'full' (présences et sessions en cours reprises)."""
+	global wl_msg_id,wl_mocha_msg_id,COUNTRY_WATCHES,REFERENT_WATCHES,SWORDS,_sword_action_alerted
+	local,remote=await asyncio.gather(asyncio.get_running_loop().run_in_executor(_db_executor,_read_state_file),cfg_get('watch_state'),return_exceptions=True)
+	cands=[(d,src)for d,src in((local,'file'),(remote,'mongo'))if isinstance(d,dict)and d.get('v')==STATE_VERSION]
+	if not cands:return None
+	st,src=max(cands,key=lambda c:c[0]['saved_at'])
+	WL[:]=st['wl'];WL_MOCHA[:]=st['wl_mocha'];wl_msg_id=st['wl_msg_id'];wl_mocha_msg_id=st['wl_mocha_msg_id']  # en place : les commandes /addwatch gardent la même liste
+	COUNTRY_WATCHES=st['cw'];REFERENT_WATCHES=st['referents'];SWORDS=st['swords'];watch_changed()
+	age=time.time()-st['saved_at'];_state_stats['loaded_from']=src;_state_stats['loaded_age']=round(age)
+	if age>STATE_MAX_AGE:return'watch'
+	for s,v in st['last_states'].items():
+		if s in last_states:last_states[s]=frozenset(v)
+	for p,s,dt in st['session_starts']:_session_starts[(p,s)]=dt
+	_sword_online.update(st['sword_online']);_sword_action_alerted=st['sword_action_alerted']
+	return'full'
+
+def state_stats():return{**_state_stats,'ready':_state['ready']}
+
+schedule_job('state',STATE_SAVE_INTERVAL,save_state)
+
 async def scanner_loop():
-	global rapport_msg_id;await client.wait_until_ready();await load_watchlist();await load_watchlist_mocha();rapport_msg_id=await asyncio.get_running_loop().run_in_executor(None,cfg_get,'rapport_msg_id');await load_cw();await load_referents();await load_swords();print(f"📋 Country watches: {len(COUNTRY_WATCHES)}",flush=True);print(f"📋 Référents: {len(REFERENT_WATCHES)}",flush=True);print(f"📋 Rapport ID: {rapport_msg_id}",flush=True);ch_rapport=client.get_channel(CH_RAPPORT);ch_alerte=client.get_channel(CH_ALERTE);tick=0
-	# Pré-remplir _sword_online + last_states au démarrage
+	await client.wait_until_ready()
+	restored,_=await asyncio.gather(load_state(),load_pins())
+	if not restored:await asyncio.gather(load_watchlist(),load_watchlist_mocha(),load_cw(),load_referents(),load_swords())  # 1er démarrage : historique Discord + config
+	_state['ready']=True
+	print(f"📋 État: {restored or 'reconstruit'} ({_state_stats['loaded_from']}, {_state_stats['loaded_age']}s)",flush=True);print(f"📋 Country watches: {len(COUNTRY_WATCHES)}",flush=True);print(f"📋 Référents: {len(REFERENT_WATCHES)}",flush=True);print(f"📋 Messages de statut: {pin_stats()['messages']}",flush=True)
+	# Pré-remplir _sword_online + last_states au démarrage (inutile si présences et sessions reprises de l'état)
 	try:
-		init_res=await asyncio.gather(*[get_online(s)for s in SERVERS],return_exceptions=True)
-		sword_names={s['name']for s in SWORDS}
-		now_dt=datetime.utcnow()+timedelta(hours=1)
-		for srv,players in zip(SERVERS,init_res):
-			if isinstance(players,list):
-				for p in players:
-					last_states[srv][p]=True
-					if p in sword_names:_sword_online[p]=srv
-					_session_starts.setdefault((p,srv),now_dt)
+		if restored!='full':
+			snap=await online_snapshot(max_age=SCAN_MIN_INTERVAL)
+			sword_names=watch_index().swords
+			now_dt=datetime.utcnow()+timedelta(hours=1)
+			for srv in SERVERS:
+				if srv in snap.sets:
+					last_states[srv]=snap.sets[srv]
+					for p in snap.sets[srv]&sword_names:_sword_online[p]=srv
+					for p in snap.sets[srv]:_session_starts.setdefault((p,srv),now_dt)
 		print(f"⚔️  Swords online au démarrage: {list(_sword_online.keys())}",flush=True)
 		await _check_sword_action(discord.utils.utcnow())
 	except Exception as e:print(f"❌ Init scan: {e}",flush=True)
-	while True:
-		try:
-			results=await asyncio.gather(*[scan_server(s,ch_alerte)for s in SERVERS],return_exceptions=True);sp={s:r if isinstance(r,list)else[]for(s,r)in zip(SERVERS,results)}
-			if tick%3==0 and COUNTRY_WATCHES:await asyncio.gather(*[check_country_watch(w)for w in COUNTRY_WATCHES],return_exceptions=True);await save_cw()
-			if tick%15==0:
-				now=discord.utils.utcnow();ts=(now+timedelta(hours=1)).strftime('%H:%M:%S');lp=sp.get('lime',[]);e=_rapport_embed('🟢 RAPPORT TACTIQUE — LIME',len(lp),ts,_status_text(WL,lp),discord.Color.green()if any(p in lp for p in WL)else discord.Color.greyple());rapport_msg_id=await _update_rapport(ch_rapport,rapport_msg_id,e,lambda mid:cfg_set('rapport_msg_id',mid));mp=sp.get('mocha',[]);mocha_e=_rapport_embed('🟤 RAPPORT TACTIQUE — MOCHA',len(mp),ts,_status_text(WL_MOCHA,mp),discord.Color.orange()if any(p in mp for p in WL_MOCHA)else discord.Color.greyple());ch_mr=client.get_channel(CH_M_RAPPORT)
-				if ch_mr:
-					found=False
-					async for old in ch_mr.history(limit=10):
-						if old.author==client.user and old.embeds and'RAPPORT TACTIQUE — MOCHA'in(old.embeds[0].title or''):await safe_edit(old,embed=mocha_e);found=True;break
-					if not found:await safe_send(ch_mr,embed=mocha_e)
-			tick+=1
-		except discord.errors.HTTPException as e:
-			if e.status==429:retry=e.retry_after if hasattr(e,'retry_after')else 30;print(f"⚠️ Rate limit (loop), attente {retry}s",flush=True);await asyncio.sleep(retry)
-			else:print(f"❌ Scanner HTTP: {e}",flush=True)
-		except Exception as e:print(f"❌ Scanner: {e}",flush=True)
-		await asyncio.sleep(2)
-async def start_web():
-	app=web.Application()
+	# Polls étalés sur le premier intervalle, puis chaque serveur suit son propre rythme
+	t0=time.monotonic();tokens=1.0;last=t0
+	for idx,s in enumerate(SERVERS):_poll[s]={'interval':SCAN_BASE_INTERVAL,'next':t0+idx*SCAN_MIN_INTERVAL/len(SERVERS),'fails':0,'empty':0,'count':len(last_states[s]),'task':None}
+	for job in _jobs.values():job['next']=t0;job['task']=None
+	try:
+		while True:
+			now=time.monotonic();tokens=min(max(1.0,SCAN_BUDGET_RPS),tokens+(now-last)*SCAN_BUDGET_RPS);last=now
+			for _,s in sorted((st['next'],s)for s,st in _poll.items()if st['next']<=now and not _busy(st['task'])):
+				if tokens<1:break
+				tokens-=1;_poll[s]['task']=asyncio.create_task(_poll_server(s))
+			for name,job in _jobs.items():
+				if job['next']<=now and not _busy(job['task']):
+					job['next']=now+job['interval'];job['runs']+=1;job['task']=asyncio.create_task(_guarded(name,job['fn']()))
+			await asyncio.sleep(SCAN_TICK)
+	finally:
+		for t in[st['task']for st in _poll.values()]+[j['task']for j in _jobs.values()]:
+			if _busy(t):t.cancel()
+def make_app():
+	app=web.Application(middlewares=[compress_middleware])
 	routes=[
 	 ('GET','/',api_health),
  ('GET','/api/events',api_events),
 	 ('GET','/health',api_health),
+	 ('GET','/metrics',api_metrics),
 	 ('POST','/api/auth-check',api_auth_check),
 	 ('GET','/api/online/{server}',api_online),
 	 ('GET','/api/online_all',api_online_all),
@@ -1231,6 +2616,7 @@ async def start_web():
 	 ('GET','/api/grades/{player}',api_grades_all),
 	 ('GET','/api/history/{player}',api_history),
 	 ('GET','/api/debug/country/{server}/{country}',api_debug_country_desc),
+	 ('GET','/api/debug/profile',api_debug_profile),
 	 ('GET','/api/country_watches',api_cw_get),
 	 ('POST','/api/country_watches/add',api_cw_add),
 	 ('POST','/api/country_watches/remove',api_cw_remove),
@@ -1248,13 +2634,16 @@ async def start_web():
 	 ('POST','/api/swords/toggle_out',api_swords_toggle_out),
 	]
 	for(method,path,handler)in routes:app.router.add_route(method,path,handler)
-	app.router.add_route('OPTIONS','/{path_info:.*}',handle_options);runner=web.AppRunner(app);await runner.setup();port=int(os.getenv('PORT',10000));await web.TCPSite(runner,'0.0.0.0',port).start();print(f"🌐 API démarrée sur {port}",flush=True)
+	app.router.add_route('OPTIONS','/{path_info:.*}',handle_options)
+	return app
+async def start_web():
+	runner=web.AppRunner(make_app());await runner.setup();port=int(os.getenv('PORT',10000));await web.TCPSite(runner,'0.0.0.0',port).start();print(f"🌐 API démarrée sur {port}",flush=True)
 async def self_ping():
 	await asyncio.sleep(60);url=(RENDER_URL if RENDER_URL.startswith('http')else f"https://{RENDER_URL}")if RENDER_URL else None
 	while True:
 		if url:
 			try:
-				async with aiohttp.ClientSession()as s:await s.get(url,timeout=aiohttp.ClientTimeout(total=10))
+				async with http_get(url,'self')as resp:await resp.read()
 			except:pass
 		await asyncio.sleep(600)
 async def _start_discord():
@@ -1301,7 +2690,7 @@ async def api_swords_add(r):
 	await save_sword(sword)
 	# Vérif si déjà co au moment de l'ajout → check action possible
 	for srv,players in last_states.items():
-		if players.get(name):_sword_online[name]=srv;break
+		if name in players:_sword_online[name]=srv;break
 	await _check_sword_action(discord.utils.utcnow())
 	return cors({'ok':True,'swords':SWORDS})
 
@@ -1342,12 +2731,28 @@ async def api_swords_toggle_out(r):
 
 
 async def main():
-	print('🚀 Démarrage...',flush=True);init_mongo()
-	await asyncio.get_event_loop().run_in_executor(None,migrate_sessions_to_sessions2)
-	await asyncio.sleep(2)
-	asyncio.create_task(start_web())
-	if RENDER_URL:asyncio.create_task(self_ping())
-	await _start_discord()
+	print('🚀 Démarrage...',flush=True);http_session()
+	try:asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,asyncio.current_task().cancel)  # Render arrête le service en SIGTERM → flush propre
+	except(NotImplementedError,RuntimeError):pass
+	try:
+		await asyncio.get_running_loop().run_in_executor(_db_executor,init_mongo)
+		if MONGO_URL and not mongo_ok:journal_append('cutoff',{'ts':_BOOT_TS})  # en tête du journal : rejoué avant les pings de ce démarrage
+		await asyncio.sleep(2)
+		asyncio.create_task(start_web())
+		asyncio.create_task(dynmap_cache_loop())
+		asyncio.create_task(loop_lag_loop());start_loop_watchdog()
+		asyncio.create_task(write_behind_loop())
+		asyncio.create_task(journal_loop())
+		asyncio.create_task(backfill_histograms())
+		asyncio.create_task(backfill_activity_rollups())
+		asyncio.create_task(migrate_sessions_to_sessions2())
+		if RENDER_URL:asyncio.create_task(self_ping())
+		await _start_discord()
+	finally:
+		await save_state(force=True)
+		await wb_flush()
+		await journal_flush()
+		await http_close()
 @client.event
 async def on_ready():await tree.sync();print(f"✅ {client.user} | {len(SERVERS)} serveurs | MongoDB {'✅'if mongo_ok else'❌'}",flush=True)
 if __name__=='__main__':asyncio.run(main())
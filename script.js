@@ -306,6 +306,10 @@ function scStopBar(){if(scBarT){clearInterval(scBarT);scBarT=null;}}
 
 function _authHeader(){const t=sessionStorage.getItem('mg_token_v3');return t?{'Authorization':'Bearer '+t}:{};}
 async function api(p,opts={}){const r=await fetch(API+p,{...opts,headers:{..._authHeader(),'Content-Type':'application/json',...(opts.headers||{})}});if(!r.ok)throw new Error('HTTP '+r.status);return r.json();}
+// Réponses ?fmt=col : colonnes parallèles -> lignes, coordonnées delta -> absolues
+function _rows(c){if(!c||!c.cols)return c;const ks=Object.keys(c.cols);return Array.from({length:c.n},(_,i)=>{const o={};for(const k of ks){const v=c.cols[k][i];if(v!==null&&v!==undefined)o[k]=v;}return o;});}
+function _undelta(a){let v=0;return a.map(d=>v+=d);}
+function _actPoints(d){if(d.points||!d.columns)return d;const c=d.columns;d.points=c.ts.map((ts,i)=>{const data={};for(const s in c.avg){const v=c.avg[s][i];if(v!==null&&v!==undefined)data[s]=v;}return{ts,data};});return d;}
 async function apiP(p,b){const r=await fetch(API+p,{method:'POST',headers:{'Content-Type':'application/json',..._authHeader()},body:JSON.stringify(b)});if(!r.ok)throw new Error('HTTP '+r.status);return r.json();}
 
 async function nav(id,btn){sndNav();pageFlash();document.querySelector('.main').scrollTo({top:0,behavior:'instant'});document.querySelectorAll('.sec').forEach(s=>s.classList.remove('active'));document.querySelectorAll('.tab').forEach(t=>t.classList.remove('active'));$('s-'+id).classList.add('active');btn.classList.add('active');if(id==='watchlist')await switchWl('lime');if(id==='countrywatch'){cwRender();cwRefreshAll();}if(id==='online'){$('ol-body').innerHTML=ld();loadOnline();}if(id==='checkall')rAT('ca-pl','ppCA');if(id==='stats')rAT('st-pl','ppST');if(id==='referents'){loadReferents();}if(id==='activite'){initActivity();}if(id==='swords'){loadSwords();}else{if(_swordPollId){clearInterval(_swordPollId);_swordPollId=null;}}}
@@ -589,7 +593,7 @@ async function loadDashActivityChart(){
   const canvas=document.getElementById('activity-graph');
   if(!canvas)return;
   try{
-    const d=await api(`/api/activity?hours=${_dashPeriod}`);
+    const d=_actPoints(await api(`/api/activity?hours=${_dashPeriod}&fmt=col`));
     const pts=d.points||[];
     if(!pts.length){
       canvas.style.display='none';
@@ -675,16 +679,18 @@ function setDashPeriod(btn){
 function drawActivityGraph(){loadDashActivityChart();}
 
 // ── SSE — events temps réel ──────────────────────────────────────
-let _sseSource=null,_sseRetry=0;
+let _sseSource=null,_sseRetry=0,_sseLastId='';
 function _connectSSE(){
   if(_sseSource)_sseSource.close();
   const tok=sessionStorage.getItem('mg_token_v3');
   if(!tok)return;
-  const url=`${API}/api/events?token=${encodeURIComponent(tok)}`;
+  // EventSource est recréé à la main : on renvoie nous-mêmes le dernier id pour rattraper les events manqués
+  const url=`${API}/api/events?token=${encodeURIComponent(tok)}`+(_sseLastId?`&last_id=${encodeURIComponent(_sseLastId)}`:'');
   _sseSource=new EventSource(url);
   _sseSource.onopen=()=>{_sseRetry=0;console.log('[SSE] connecté');};
   _sseSource.onmessage=(e)=>{
     try{
+      if(e.lastEventId)_sseLastId=e.lastEventId;
       const d=JSON.parse(e.data);
       if(d.type==='ping')return;
       if(d.type==='connect'||d.type==='disconnect'){
@@ -1283,8 +1289,8 @@ async function loadRefHistory(){
   if(!body)return;
   body.innerHTML=`<div class="ld">Chargement<span class="ldd"><span>.</span><span>.</span><span>.</span></span></div>`;
   try{
-    const d=await fetch(`${API}/api/referents/history?server=${refCurSrv}&country=${encodeURIComponent(refCurCtry)}&limit=200&departures=1`,{headers:{..._authHeader()}}).then(r=>r.json());
-    const events=d.events||[];
+    const d=await fetch(`${API}/api/referents/history?server=${refCurSrv}&country=${encodeURIComponent(refCurCtry)}&limit=200&departures=1&fmt=col`,{headers:{..._authHeader()}}).then(r=>r.json());
+    const events=_rows(d.events)||[];
     if(!events.length){body.innerHTML='<div class="empty">Aucun événement enregistré — le tracking démarre au prochain scan (30 min)</div>';return;}
     const recruits=events.filter(e=>!e.departure);
     const departs=events.filter(e=>e.departure);
@@ -1419,14 +1425,15 @@ function _polyArea(xs,zs){
 // Passe par le backend pour éviter le CORS
 async function _fetchDimClaims(server,dim){
   try{
-    const dimUrl=`${API}/api/dim_markers/${server}/${encodeURIComponent(dim)}`;
+    const dimUrl=`${API}/api/dim_markers/${server}/${encodeURIComponent(dim)}?fmt=col`;
     const r=await fetch(dimUrl,{headers:{..._authHeader()}});
     if(!r.ok){console.warn('[dimClaims] HTTP',r.status,dimUrl);return{};}
     const areas=await r.json();
     // Si le backend retourne une erreur JSON, areas sera {error:...}
     if(!areas||typeof areas!=='object'||areas.error)return{};
+    const list=areas.fmt==='col'?areas.label.map((label,i)=>({label,x:_undelta(areas.x[i]),z:_undelta(areas.z[i])})):Object.values(areas);
     const map={};
-    for(const[k,v]of Object.entries(areas)){
+    for(const v of list){
       const label=v.label||'';
       if(!label)continue;
       const name=label.toLowerCase();
@@ -1454,12 +1461,12 @@ async function loadSouspower(){
   try{
     // Fetch main souspower data + all 3 dimension markers in parallel
     const [d, dimLune, dimMars, dimEdora] = await Promise.all([
-      api(`/api/souspower/${s}`),
+      api(`/api/souspower/${s}?fmt=col`),
       _fetchDimClaims(s,'DIM-28'),
       _fetchDimClaims(s,'DIM-29'),
       _fetchDimClaims(s,'DIM-31'),
     ]);
-    const pays=d.countries||[];
+    const pays=_rows(d.countries)||[];
     if(!pays.length){res.innerHTML='<div class="empty">Aucun pays trouvé</div>';return;}
     const sp=pays.filter(p=>p.marge<0);
     const proche=pays.filter(p=>p.marge>=0&&p.marge<200);
@@ -1602,7 +1609,7 @@ async function loadActivity(){
   $('act-loading').style.display='flex';
   $('act-empty').style.display='none';
   try{
-    const d=await api(`/api/activity?hours=${actPeriod}`);
+    const d=_actPoints(await api(`/api/activity?hours=${actPeriod}&fmt=col`));
     actData=d;
     if(!d.points||d.points.length===0){
       $('act-loading').style.display='none';
@@ -1764,7 +1771,8 @@ function renderActivityStats(d){
   const pts=d.points;
   const stats=SRV.map(s=>{
     const vals=pts.map(p=>p.data[s]||0);
-    const max=Math.max(...vals,0);
+    const peaks=d.columns?.max?.[s]?.map(v=>v||0)||vals;
+    const max=Math.max(...peaks,0);
     const avg=vals.length?Math.round(vals.reduce((a,b)=>a+b,0)/vals.length):0;
     const last=vals[vals.length-1]||0;
     return{s,max,avg,last};